@@ -1,7 +1,11 @@
 import pandas as pd
 import numpy as np
 import sys, json, h5py
-from pythologist.selection import SubsetLogic
+from pythologist.selection import SubsetLogic, CompiledSubsetLogic
+from pythologist.calls import CallMatrix, unique_objects
+from pythologist.adjacency import Adjacency, group_codes
+from pythologist import storage
+from pythologist.seeds import seed_sequence, region_key, stream
 from pythologist.measurements.counts import PercentageLogic
 from pythologist.measurements.counts import Counts
 from pythologist.measurements.spatial.contacts import Contacts
@@ -52,13 +56,13 @@ class CellDataFrame(pd.DataFrame):
 
     def copy(self,*args,**kw):
         """
-        Create a copy. Do like a regular dataframe, but then also make sure to show copy all the individual entries with objects.
+        Create a copy. Do like a regular dataframe.
+
+        The dictionaries in the object columns (regions, scored_calls, phenotype_calls, channel_values and neighbors) are shared
+        with the original rather than copied, and rows may share the same dictionary.  Treat them as immutable; to change them
+        build new dictionaries and assign the column.
         """
         output = super(CellDataFrame,self).copy(*args,**kw)
-        columns_with_objects = ['regions','scored_calls','phenotype_calls','channel_values','neighbors']
-        for col_name in columns_with_objects:
-            if col_name in self.columns:
-                output[col_name] = [x if not isinstance(x,dict) else x.copy() for x in self[col_name]]
         output.microns_per_pixel = self.microns_per_pixel
         output._version = self.version
         output.db = self.db
@@ -78,21 +82,12 @@ class CellDataFrame(pd.DataFrame):
         Returns:
             CellDataFrame: A CellDataFrame with only valid cell-cell contacts
         """
-        def _neighbor_check(neighbors,valid):
-            if not neighbors==neighbors: return np.nan
-            valid_keys = set(valid)&set(neighbors.keys())
-            d = dict([(k,v) for k,v in neighbors.items() if k in valid_keys])
-            return d
-        fixed = self.copy()
-        valid = self.get_valid_cell_indecies()
-        valid = pd.DataFrame(self).merge(valid,on=self.frame_columns).set_index(self.frame_columns+['cell_index'])
-        valid = valid.apply(lambda x: _neighbor_check(x['neighbors'],x['valid']),1).reset_index().\
-            rename(columns={0:'new_neighbors'})
-        fixed = fixed.merge(valid,on=self.frame_columns+['cell_index']).drop(columns='neighbors').\
-            rename(columns={'new_neighbors':'neighbors'})
+        adjacency = self.adjacency()
+        fixed = self.reset_index(drop=True)
+        # only cells that lost a contact get a new dictionary
+        fixed['neighbors'] = adjacency.to_series(fixed['cell_index'].to_numpy(),original=fixed['neighbors'])
         fixed.microns_per_pixel = self.microns_per_pixel
         fixed.db = self.db
-        #fixed.loc[:,'neighbors'] = list(new_neighbors)
         return fixed
 
     @property
@@ -117,74 +112,75 @@ class CellDataFrame(pd.DataFrame):
         """
         return ['project_id','project_name']
 
-    def to_hdf(self,path,key,mode='a'):
+    def to_hdf(self,path,key,mode='a',format='columnar',channel_values_dtype=np.float64):
         """
         Save the CellDataFrame to an hdf5 file.
 
+        The default 'columnar' format stores each column as typed arrays (see pythologist.storage).
+        The 'table' format is the older pandas table of json strings.
+
         Args:
             path (str): the path to save to
             key (str): the name of the location to save it to
             mode (str): write mode
-        """
-        pd.DataFrame(self.serialize()).to_hdf(path,key,mode=mode,format='table',complib='zlib',complevel=9)
-        f = h5py.File(path,'r+')
+            format (str): 'columnar' or 'table' (default 'columnar')
+            channel_values_dtype (numpy.dtype): the columnar dtype of channel_values (default float64, an exact round trip).
+                                                numpy.float32 halves its size but values come back rounded to single precision.
+        """
+        if format not in ['columnar','table']: raise ValueError("format must be 'columnar' or 'table'")
+        if format == 'table':
+            pd.DataFrame(self.serialize()).to_hdf(path,key=key,mode=mode,format='table',complib='zlib',complevel=9)
+            f = h5py.File(path,'r+')
+        else:
+            f = h5py.File(path,mode)
+            if key in f: del f[key]
+            storage.write_columns(f.create_group(key),pd.DataFrame(self),matrix_dtypes={'channel_values':channel_values_dtype})
         f[key].attrs["microns_per_pixel"] = float(self.microns_per_pixel) if self.microns_per_pixel is not None else np.nan
-        f[key].attrs["version"] = self.version
+        if self.version is not None: f[key].attrs["version"] = self.version
         f.close()
-    def frame_region_generator(cdf):
+    def frame_region_generator(cdf,copy=True):
         """
         Generator that produces individual regions of frames
 
+        Args:
+            copy (bool): if False yield the rows without copying them.  Treat these as read-only. (default True)
 
         Returns:
             CellDataFrame
         """
-        for project_id in cdf['project_id'].unique():
-            project = cdf.loc[cdf['project_id']==project_id]
-            for sample_id in project['sample_id'].unique():
-                sample = project.loc[project['sample_id']==sample_id,:]
-                for frame_id in sample['frame_id'].unique():
-                    #print(frame_id)
-                    frame = sample.loc[sample['frame_id']==frame_id,:]
-                    for region_label in frame['region_label'].unique():
-                        #print(region_label)
-                        region = frame.loc[frame['region_label']==region_label].copy()
-                        region.db = cdf.db
-                        region.microns_per_pixel = cdf.microns_per_pixel
-                        yield region
-    def frame_generator(cdf):
+        yield from cdf._group_generator(['project_id','sample_id','frame_id','region_label'],copy)
+    def frame_generator(cdf,copy=True):
         """
         Generator that produces individual frames
 
+        Args:
+            copy (bool): if False yield the rows without copying them.  Treat these as read-only. (default True)
 
         Returns:
             CellDataFrame
         """
-        for project_id in cdf['project_id'].unique():
-            project = cdf.loc[cdf['project_id']==project_id]
-            for sample_id in project['sample_id'].unique():
-                sample = project.loc[project['sample_id']==sample_id,:]
-                for frame_id in sample['frame_id'].unique():
-                    #print(frame_id)
-                    frame = sample.loc[sample['frame_id']==frame_id,:].copy()
-                    frame.db = cdf.db
-                    frame.microns_per_pixel = cdf.microns_per_pixel
-                    yield frame
-    def sample_generator(cdf):
+        yield from cdf._group_generator(['project_id','sample_id','frame_id'],copy)
+    def sample_generator(cdf,copy=True):
         """
-        Generator that produces individual frames
+        Generator that produces individual samples
 
+        Args:
+            copy (bool): if False yield the rows without copying them.  Treat these as read-only. (default True)
 
         Returns:
             CellDataFrame
         """
-        for project_id in cdf['project_id'].unique():
-            project = cdf.loc[cdf['project_id']==project_id]
-            for sample_id in project['sample_id'].unique():
-                sample = project.loc[project['sample_id']==sample_id,:].copy()
-                sample.db = cdf.db
-                sample.microns_per_pixel = cdf.microns_per_pixel
-                yield sample
+        yield from cdf._group_generator(['project_id','sample_id'],copy)
+    def _group_generator(self,columns,copy):
+        # one pass to index the groups, then each group is a slice of the sorted row positions
+        order, offsets = _group_index(self,columns)
+        contiguous = np.array_equal(order,np.arange(len(order)))
+        for start, stop in zip(offsets[:-1],offsets[1:]):
+            group = self.iloc[start:stop] if contiguous else self.take(order[start:stop])
+            if copy: group = group.copy()
+            group.db = self.db
+            group.microns_per_pixel = self.microns_per_pixel
+            yield group
     def add_zeroed_phenotype(self,phenotype_label):
         """
         Add a phenotype to the mutually exclusive phenotypes, but it is set to zero. Raises an error if the phenotype already exists
@@ -195,13 +191,10 @@ class CellDataFrame(pd.DataFrame):
         Returns:
             CellDataFrame
         """
-        def _add_item(x,phenotype_label):
-            d = x.copy()
-            d[phenotype_label] = 0
-            return d
         if phenotype_label in self.phenotypes: raise ValueError("phenotype '"+str(phenotype_label)+"' already exists")
         cdf = self.copy()
-        cdf['phenotype_calls'] = cdf['phenotype_calls'].apply(lambda x: _add_item(x,phenotype_label))
+        calls = cdf.call_matrix('phenotype_calls')
+        cdf['phenotype_calls'] = calls.assign(phenotype_label,np.zeros(calls.shape[0])).to_series(cdf.index)
         return cdf
 
 
@@ -259,25 +252,25 @@ class CellDataFrame(pd.DataFrame):
     @classmethod
     def read_hdf(cls,path,key=None):
         """
-        Read a CellDataFrame from an hdf5 file.
+        Read a CellDataFrame from an hdf5 file.  Reads both the 'columnar' and older 'table' formats.
 
         Args:
             path (str): the path to read from
-            key (str): the name of the location to read from
+            key (str): the name of the location to read from (can be omitted if the file holds only one)
 
         Returns:
             CellDataFrame
         """
-        df = pd.read_hdf(path,key)
-        df['scored_calls'] = df['scored_calls'].apply(lambda x: json.loads(x))
-        df['channel_values'] = df['channel_values'].apply(lambda x: json.loads(x))
-        df['regions'] = df['regions'].apply(lambda x: json.loads(x))
-        df['phenotype_calls'] = df['phenotype_calls'].apply(lambda x: json.loads(x))
-        df['neighbors'] = df['neighbors'].apply(lambda x: json.loads(x))
-        df['neighbors'] = df['neighbors'].apply(lambda x:
-                np.nan if not isinstance(x,dict) else dict(zip([int(y) for y in x.keys()],x.values()))
-            )
-        df['frame_shape'] = df['frame_shape'].apply(lambda x: tuple(json.loads(x)))
+        f = h5py.File(path,'r')
+        if key is None:
+            if len(f.keys()) != 1: 
+                f.close()
+                raise ValueError("key must be specified when the file holds more than one dataset")
+            key = list(f.keys())[0]
+        columnar = storage.is_columnar(f[key])
+        df = None if not columnar else storage.read_columns(f[key])
+        f.close()
+        if not columnar: df = _read_hdf_table(path,key)
         df = cls(df)
         f = h5py.File(path,'r')
         mpp = f[key].attrs["microns_per_pixel"]
@@ -322,18 +315,37 @@ class CellDataFrame(pd.DataFrame):
         """
         Check to make sure phenotype calls, or scored calls are consistent across all images / samples
         """
-        uni = pd.Series(self['phenotype_calls'].apply(lambda x: json.dumps(x)).unique()).\
-            apply(lambda x: json.loads(x)).apply(lambda x: tuple(sorted(x.keys()))).unique()
-        if len(uni) > 1: 
-            if verbose: sys.stderr.write("WARNING: phenotypes differ across the dataframe \n"+str(uni)+"\n")
-            return False
-        uni = pd.Series(self['scored_calls'].apply(lambda x: json.dumps(x)).unique()).\
-            apply(lambda x: json.loads(x)).apply(lambda x: tuple(sorted(x.keys()))).unique()
-        if len(uni) > 1: 
-            if verbose: sys.stderr.write("WARNING: scored_calls differ across the dataframe \n"+str(uni)+"\n")
+        for column_name, about in [('phenotype_calls','phenotypes'),('scored_calls','scored_calls')]:
+            calls = self.call_matrix(column_name)
+            if calls.is_uniform(): continue
+            if verbose:
+                uni = sorted(set([tuple(sorted([calls.names[i] for i in np.flatnonzero(row)])) 
+                                  for row in np.unique(calls.present[calls.defined],axis=0)]))
+                sys.stderr.write("WARNING: "+about+" differ across the dataframe \n"+str(uni)+"\n")
             return False
         return True
 
+    def call_matrix(self,column_name='phenotype_calls'):
+        """
+        Return a columnar view of the dictionaries in a calls column
+
+        Args:
+            column_name (str): 'phenotype_calls' (default) or 'scored_calls'
+
+        Returns:
+            CallMatrix: the call names and a (cells x names) int8 array of the calls
+        """
+        return CallMatrix.from_series(self[column_name])
+
+    def adjacency(self):
+        """
+        Return the cell-cell contacts as a sparse matrix over the rows
+
+        Returns:
+            Adjacency: CSR arrays of the contacts (row positions) and their shared pixel counts
+        """
+        return Adjacency.from_cellframe(self)
+
     @property
     def db(self):
         """
@@ -372,24 +384,22 @@ class CellDataFrame(pd.DataFrame):
             pandas.DataFrame: Output a dataframe with regions and region sizes
         """
         mergeon = self.frame_columns
-        temp = self.loc[:,mergeon+['regions']].\
-            set_index(mergeon)['regions'].apply(json.dumps).\
-            reset_index().drop_duplicates()
-        temp['regions'] = temp['regions'].apply(json.loads)
-        rows = []
-        for i,r in temp.iterrows():
-            for label in r['regions']:
-                a = list(r.index)
-                b = list(r.values)
-                a = a+['region_label','region_area_pixels']
-                b = b+[label,r['regions'][label]]
-                rows.append(dict(zip(a,b)))
-        rows = pd.DataFrame(rows).drop(columns='regions').\
-            drop_duplicates()[mergeon+['region_label','region_area_pixels']]
-        _cnt = self.groupby(self.frame_columns+['region_label']).count()[['cell_index']].reset_index().\
-            rename(columns={'cell_index':'region_cell_count'})
-        #rows = rows.loc[rows['region_area_pixels']>0].copy()
-        rows = rows.merge(_cnt,on=self.frame_columns+['region_label'],how='left').fillna(0)
+        frames = group_codes(self,mergeon)
+        objs = np.asarray(self['regions'],dtype=object)
+        codes, _ = unique_objects(objs)
+        # one row for each distinct regions dictionary in a frame
+        _, first = np.unique(pd.factorize(frames*(codes.max()+1 if len(codes) > 0 else 1)+codes)[0],return_index=True)
+        lengths = np.array([len(x) for x in objs[first]],dtype=np.int64)
+        source = np.repeat(first,lengths)
+        rows = pd.DataFrame(self[mergeon]).iloc[source].reset_index(drop=True)
+        rows['region_label'] = list(chain.from_iterable([x.keys() for x in objs[first]]))
+        rows['region_area_pixels'] = list(chain.from_iterable([x.values() for x in objs[first]]))
+        rows['_frame'] = frames[source]
+        rows = rows.drop_duplicates(subset=['_frame','region_label','region_area_pixels'])
+        _cnt = pd.DataFrame({'_frame':frames,'region_label':self['region_label'].to_numpy()}).\
+            groupby(['_frame','region_label']).size().rename('region_cell_count').reset_index()
+        rows = rows.merge(_cnt,on=['_frame','region_label'],how='left').fillna({'region_cell_count':0}).\
+            drop(columns='_frame')
         rows['region_cell_count'] = rows['region_cell_count'].astype(int)
         return rows
 
@@ -415,17 +425,15 @@ class CellDataFrame(pd.DataFrame):
         Args:
             verbose (bool): output more details if true
             per_phenotype_neighbors (int): number of neighbors of each phenotyhpe to find, default 50
+            n_processes (int): number of processes to spread the frame regions across, default 1
 
         Returns:
             NearestNeighbors: returns a class that holds nearest neighbor information for whatever phenotypes were in the CellDataFrame before execution.  This class is suitable for nearest neighbor and proximity operations.
         """
         if 'per_phenotype_neighbors' not in kwargs: kwargs['per_phenotype_neighbors'] = 50
         if 'max_neighbors' not in kwargs: kwargs['max_neighbors'] = None
+        if 'n_processes' not in kwargs: kwargs['n_processes'] = 1
         n = NearestNeighbors.read_cellframe(self,*args,**kwargs)
-        if 'measured_regions' in kwargs: n.measured_regions = kwargs['measured_regions']
-        else: n.measured_regions = self.get_measured_regions()
-        if 'measured_phenotypes' in kwargs: n.measured_phenotypes = kwargs['measured_phenotypes']
-        else: n.measured_phenotypes = self.phenotypes
         n.microns_per_pixel = self.microns_per_pixel
         return n
 
@@ -436,11 +444,9 @@ class CellDataFrame(pd.DataFrame):
         Returns:
             Contacts: returns a class that holds cell-to-cell contact information for whatever phenotypes were in the CellDataFrame before execution.  
         """
-        n = Contacts.read_cellframe(self,prune_neighbors=True)
-        if 'measured_regions' in kwargs: n.measured_regions = kwargs['measured_regions']
-        else: n.measured_regions = self.get_measured_regions()
-        if 'measured_phenotypes' in kwargs: n.measured_phenotypes = kwargs['measured_phenotypes']
-        else: n.measured_phenotypes = self.phenotypes
+        n = Contacts.read_cellframe(self,prune_neighbors=True,
+                                    measured_regions=kwargs.get('measured_regions',None),
+                                    measured_phenotypes=kwargs.get('measured_phenotypes',None))
         n.microns_per_pixel = self.microns_per_pixel
         return n
 
@@ -457,10 +463,6 @@ class CellDataFrame(pd.DataFrame):
             Cartesian: returns a class that holds the layout of the points to plot.
         """
         n = Cartesian.read_cellframe(self,subsets=subsets,step_pixels=step_pixels,max_distance_pixels=max_distance_pixels,prune_neighbors=False,*args,**kwargs)
-        if 'measured_regions' in kwargs: n.measured_regions = kwargs['measured_regions']
-        else: n.measured_regions = self.get_measured_regions()
-        if 'measured_phenotypes' in kwargs: n.measured_phenotypes = kwargs['measured_phenotypes']
-        else: n.measured_phenotypes = self.phenotypes
         n.microns_per_pixel = self.microns_per_pixel
         return n
 
@@ -473,15 +475,14 @@ class CellDataFrame(pd.DataFrame):
             measured_phenotypes (list): List of phenotypes present (defaults to all the phenotypes)
             minimum_region_size_pixels (int): Minimum region size to calculate counts on in pixels (Default: 1)
             minimum_denominator_count (int): Minimum denominator population count for percentage calculation (Default: 1)
+            region_groups (dict): {<region group label>:[<member region labels>]} count over groups of regions instead of the regions (see Counts.group_regions)
 
         Returns:
             Counts: returns a class that holds the counts.
         """
-        n = Counts.read_cellframe(self,prune_neighbors=False)
-        if 'measured_regions' in kwargs: n.measured_regions = kwargs['measured_regions']
-        else: n.measured_regions = self.get_measured_regions()
-        if 'measured_phenotypes' in kwargs: n.measured_phenotypes = kwargs['measured_phenotypes']
-        else: n.measured_phenotypes = self.phenotypes
+        n = Counts.read_cellframe(self,prune_neighbors=False,
+                                  measured_regions=kwargs.get('measured_regions',None),
+                                  measured_phenotypes=kwargs.get('measured_phenotypes',None))
         n.microns_per_pixel = self.microns_per_pixel
         if 'minimum_region_size_pixels' in kwargs: n.minimum_region_size_pixels = kwargs['minimum_region_size_pixels']
         else: n.minimum_region_size_pixels = 1
@@ -489,6 +490,8 @@ class CellDataFrame(pd.DataFrame):
         if 'minimum_denominator_count' in kwargs: n.minimum_denominator_count = kwargs['minimum_denominator_count']
         else: n.minimum_denominator_count = 1
         if n.minimum_denominator_count < 1: raise ValueError("minimum_denominator_count must be at least 1")
+        n.region_groups = None
+        if kwargs.get('region_groups',None) is not None: n = n.group_regions(kwargs['region_groups'])
         return n
 
     def qc(self,*args,**kwargs):
@@ -566,9 +569,7 @@ class CellDataFrame(pd.DataFrame):
             CellDataFrame: The CellDataFrame modified.
         """
         output = self.copy()
-        output['scored_calls'] = output.apply(lambda x:
-          _dict_rename(x['scored_calls'],change)
-          ,1)
+        output['scored_calls'] = output.call_matrix('scored_calls').rename(change).to_series(output.index)
         return output
 
     def zero_fill_missing_phenotypes(self):
@@ -657,14 +658,10 @@ class CellDataFrame(pd.DataFrame):
         Returns:
             CellDataFrame: The CellDataFrame modified.
         """
-        def _remove(calls,names):
-            d = dict([(k,v) for k,v in calls.items() if k not in names])
-            return d
         if isinstance(names, str):
             names = [names]
         output = self.copy()
-        output['scored_calls'] = output['scored_calls'].\
-            apply(lambda x: _remove(x,names))
+        output['scored_calls'] = output.call_matrix('scored_calls').drop(names).to_series(output.index)
         return output
 
 
@@ -682,29 +679,37 @@ class CellDataFrame(pd.DataFrame):
         Returns:
             CellDataFrame: The CellDataFrame modified.
         """
-        pnames = self.phenotypes
-        snames = self.scored_names
-        data = self.copy()
-        values = []
-        phenotypes = logic.phenotypes
-        if len(phenotypes)==0: phenotypes = pnames
-        removing = set(self.phenotypes)-set(phenotypes)
-        for k in phenotypes:
-            if k not in pnames: raise ValueError("phenotype must exist in defined")
-            temp = data.loc[data['phenotype_calls'].apply(lambda x: x[k]==1)].copy()
-            if len(removing) > 0 and temp.shape[0] > 0:
-                temp['phenotype_calls'] = temp.apply(lambda x:
-                    dict([(k,v) for k,v in x['phenotype_calls'].items() if k not in removing])
-                    ,1)
-            values.append(temp)
-        data = pd.concat(values)
-        for k,v in logic.scored_calls.items():
-            if k not in snames: raise ValueError("Scored name must exist in defined")
-            myfilter = 0 if v == '-' else 1
-            data = data.loc[data['scored_calls'].apply(lambda x: x[k]==myfilter)]
+        pcalls = self.call_matrix('phenotype_calls')
+        scalls = self.call_matrix('scored_calls')
+        mask = logic.compile(pcalls.names,scalls.names)(pcalls,scalls)
+        return self._subset_from_mask(logic,mask,update,pcalls)
+
+    def subset_masks(self,logics):
+        """
+        Evaluate many SubsetLogic in one pass over the calls.  Each column is the set of cells subset would return for that logic.
+
+        Args:
+            logics (list): a list of SubsetLogic
+
+        Returns:
+            numpy.array: (cells x logics) boolean array
+        """
+        pcalls = self.call_matrix('phenotype_calls')
+        scalls = self.call_matrix('scored_calls')
+        return CompiledSubsetLogic(logics,pcalls.names,scalls.names).masks(pcalls,scalls)
+
+    def _subset_from_mask(self,logic,mask,update=False,pcalls=None):
+        # finish a subset from the cells passing the logic
+        data = self.loc[mask].copy()
         data.microns_per_pixel = self.microns_per_pixel
-        if update: 
-            data['phenotype_calls'] = data['phenotype_calls'].apply(lambda x: {logic.label:1})
+        if update:
+            data['phenotype_calls'] = pd.Series([{logic.label:1}]*data.shape[0],index=data.index,dtype=object)
+        else:
+            if pcalls is None: pcalls = self.call_matrix('phenotype_calls')
+            phenotypes = logic.phenotypes if len(logic.phenotypes) > 0 else pcalls.names
+            removing = set(pcalls.names)-set(phenotypes)
+            if len(removing) > 0:
+                data['phenotype_calls'] = pcalls.take(mask).drop(removing).to_series(data.index)
         data.fill_phenotype_label(inplace=True)
         data.db = self.db
         return data
@@ -726,37 +731,28 @@ class CellDataFrame(pd.DataFrame):
         """
         if positive_label is None and negative_label is not None or \
            negative_label is None and positive_label is not None: raise ValueError("Error if you want to specify labels, give both positive and negative")
-        if phenotype not in self.phenotypes: raise ValueError("Error phenotype "+str(phenotype)+" is not in the data.")
-        if scored_name not in self.scored_names: raise ValueError("Error scored_name "+str(scored_name)+" is not in the data.")
+        pcalls = self.call_matrix('phenotype_calls')
+        scalls = self.call_matrix('scored_calls')
+        if phenotype not in pcalls.names: raise ValueError("Error phenotype "+str(phenotype)+" is not in the data.")
+        if scored_name not in scalls.names: raise ValueError("Error scored_name "+str(scored_name)+" is not in the data.")
         if positive_label is None and negative_label is None:
             positive_label = phenotype+' '+scored_name+'+'
             negative_label = phenotype+' '+scored_name+'-'
         elif positive_label == negative_label: raise ValueError("Cant have the same label for positive and negative.")
-        def _swap_in(d,pheno,scored,phenotype_calls,scored_calls,pos,neg):
-            if pheno not in phenotype_calls.keys(): return d
-            keepers = [(k,v) for k,v in phenotype_calls.items() if k!=phenotype]
-            if scored not in scored_calls.keys(): raise ValueError("Error scored calls are not unified across samples")
-            scored_value = scored_calls[scored]
-            phenotype_value = phenotype_calls[pheno]
-            if phenotype_value == 0:
-                keepers += [(pos,0),(neg,0)]
-            elif scored_value == 1:
-                keepers += [(pos,1),(neg,0)]
-            elif scored_value == 0:
-                keepers += [(pos,0),(neg,1)]
-            else: raise ValueError("Format error.  These values should only ever be zero or one.")
-            return dict(keepers)
+        # only cells that have the phenotype defined get split
+        has_phenotype = pcalls.has(phenotype)
+        if (has_phenotype&~scalls.has(scored_name)).any(): raise ValueError("Error scored calls are not unified across samples")
+        phenotype_on = has_phenotype&(pcalls.column(phenotype)!=0)
+        scored_value = scalls.column(scored_name)
+        if (phenotype_on&(scored_value!=0)&(scored_value!=1)).any():
+            raise ValueError("Format error.  These values should only ever be zero or one.")
+        pcalls = pcalls.drop([phenotype]).\
+            assign(positive_label,phenotype_on&(scored_value==1),has_phenotype).\
+            assign(negative_label,phenotype_on&(scored_value==0),has_phenotype)
         data = self.copy()
-        data['phenotype_calls'] = self.apply(lambda x:
-                _swap_in(x,phenotype,scored_name,x['phenotype_calls'],x['scored_calls'],positive_label,negative_label)
-            ,1)
-        def _set_label(d):
-            vals = [k for k,v in d.items() if v==1]
-            return np.nan if len(vals) == 0 else vals[0]
-        data['phenotype_label'] = data.apply(lambda x:
-                _set_label(x['phenotype_calls'])
-            ,1)
-        return data.copy()
+        data['phenotype_calls'] = pcalls.to_series(data.index)
+        data['phenotype_label'] = pcalls.first_label()
+        return data
 
     def collapse_phenotypes(self,input_phenotype_labels,output_phenotype_label,verbose=True):
         """
@@ -775,23 +771,15 @@ class CellDataFrame(pd.DataFrame):
         if len(bad_phenotypes) > 0: raise ValueError("Error phenotype(s) "+str(bad_phenotypes)+" are not in the data.")
         data = self.copy()
         if len(input_phenotype_labels) == 0: return data
-        def _swap_in(d,inputs,output):
-            # Get the keys we need to merge together
-            overlap = set(d.keys()).intersection(inputs)
-            # if there are none to merge we're done already
-            if len(overlap) == 0: return d
-            keepers = [(k,v) for k,v in d.items() if k not in inputs]
-            # combine anything thats not a keeper
-            return dict(keepers+\
-                        [(output_phenotype_label,max([d[x] for x in overlap]))])
-        data['phenotype_calls'] = data.apply(lambda x:
-            _swap_in(x['phenotype_calls'],input_phenotype_labels,output_phenotype_label)
-            ,1)
-        def _set_label(d):
-            vals = [k for k,v in d.items() if v==1]
-            return np.nan if len(vals) == 0 else vals[0]
-        data['phenotype_label'] = data.apply(lambda x:
-                _set_label(x['phenotype_calls']),1)
+        pcalls = data.call_matrix('phenotype_calls')
+        merging = pcalls.select(input_phenotype_labels)
+        # combine the inputs by taking the max of the ones each cell has defined
+        overlap = merging.present.any(axis=1)
+        combined = np.where(merging.present,merging.values,np.iinfo(merging.values.dtype).min).max(axis=1)
+        pcalls = pcalls.drop(input_phenotype_labels).\
+            assign(output_phenotype_label,combined,overlap)
+        data['phenotype_calls'] = pcalls.to_series(data.index)
+        data['phenotype_label'] = pcalls.first_label()
         return data
 
     def rename_phenotype(self,*args,**kwargs): 
@@ -837,16 +825,13 @@ class CellDataFrame(pd.DataFrame):
         """
         Set the phenotype_label column according to our rules for mutual exclusion
         """
-        def _get_phenotype(d):
-            vals = [k for k,v in d.items() if v ==  1]
-            return np.nan if len(vals) == 0 else vals[0]
         if inplace:
             if self.shape[0] == 0: return self
-            self['phenotype_label'] = self.apply(lambda x: _get_phenotype(x['phenotype_calls']),1)
+            self['phenotype_label'] = self.call_matrix('phenotype_calls').first_label()
             return
         fixed = self.copy()
         if fixed.shape[0] == 0: return fixed
-        fixed['phenotype_label'] = fixed.apply(lambda x: _get_phenotype(x['phenotype_calls']),1)
+        fixed['phenotype_label'] = fixed.call_matrix('phenotype_calls').first_label()
         return fixed
     def fill_phenotype_calls(self,phenotypes=None,inplace=False):
         """
@@ -991,52 +976,49 @@ class CellDataFrame(pd.DataFrame):
     def permute_phenotype_labels(self,phenotypes=None,
                                       channel_values=True,
                                       scored_calls=True,
-                                      random_state=None):
+                                      random_state=None,
+                                      permutation=0):
         """
         Shuffle phenotype labels.  Defaults to shuffleling all labels within a frames regions.  Adjust this by modifying group_strategy.
 
+        Each frame region is shuffled with its own random stream, keyed by the frame region and the permutation index,
+        so a permutation is the same whichever frames are present and wherever it is run.
+
         Args:
             phenotypes (list): a list of phenotype_labels to shuffle amongst eachother if None shuffle all
             channel_values (bool): include the channel_values in the shuffle
             scored_calls (bool): include the scored_calls in the shuffle
-            random_state (int or numpy random state): pass to the pandas shuffle function
+            random_state (int, numpy.random.SeedSequence or numpy.random.Generator): the root of the random streams (default None, fresh entropy)
+            permutation (int): the permutation index, to draw a different shuffle from the same random_state (default 0)
 
         Returns:
             CellDataFrame
         """
         phenotypes = phenotypes if phenotypes is not None else self.phenotypes 
-        keepers = set(self.phenotypes)-set(phenotypes)
         if len(set(phenotypes)-set(self.phenotypes))>0:
             raise ValueError("Phenotypes must be defined.")
-        keepers = self.loc[self['phenotype_label'].isin(keepers),:]
-        permute = self.loc[self['phenotype_label'].isin(phenotypes),:]
-        complete = []
-        for i,block in enumerate(permute.frame_region_generator()):
-            # we want to swap the labels of our phenotype_label
-            # we also want to swap the scored calls if set to true
-            # we also want to swap the channel_values if set to true
-            mergeon = block.loc[:,['phenotype_label','phenotype_calls','scored_calls','channel_values']].\
-                rename(columns={'phenotype_label':'plab',
-                        'phenotype_calls':'pcall',
-                        'scored_calls':'scall',
-                        'channel_values':'cvalue'}).\
-                reset_index(drop=True).\
-                sample(frac=1,random_state=None if random_state is None else random_state+i).\
-                reset_index(drop=True)
-            block = block.reset_index(drop=True)
-            block = block.merge(mergeon,left_index=True,right_index=True)
-            block['phenotype_label'] = block['plab']
-            block['phenotype_calls'] = block['pcall']
-            if scored_calls:
-                block['scored_calls'] = block['scall']
-            if channel_values:
-                block['channel_values'] = block['cvalue']
-            block = block.drop(columns=['plab','pcall','scall','cvalue'])
-            block.microns_per_pixel = self.microns_per_pixel
-            block.db = self.microns_per_pixel
-            complete.append(block)
-        complete = self.__class__.concat(complete+[keepers]).\
-            sort_values(['project_name','project_id','sample_name','sample_id','frame_name','frame_id','cell_index'])
+        seeds = seed_sequence(random_state)
+        group_columns = ['project_id','sample_id','frame_id','region_label']
+        complete = self.loc[self['phenotype_label'].isin(self.phenotypes),:].reset_index(drop=True)
+        # we want to swap the labels of our phenotype_label
+        # we also want to swap the scored calls if set to true
+        # we also want to swap the channel_values if set to true
+        columns = ['phenotype_label','phenotype_calls']+(['scored_calls'] if scored_calls else [])+(['channel_values'] if channel_values else [])
+        rows = np.flatnonzero(complete['phenotype_label'].isin(phenotypes).to_numpy())
+        order, offsets = _group_index(complete.iloc[rows],group_columns)
+        order = rows[order]
+        source = order.copy()
+        keys = complete[group_columns].to_numpy(dtype=object)
+        for start, stop in zip(offsets[:-1].tolist(),offsets[1:].tolist()):
+            if stop-start < 2: continue
+            members = order[start:stop]
+            rng = stream(seeds,permutation,region_key(keys[members[0]]))
+            source[start:stop] = members[rng.permutation(stop-start)]
+        for column in columns:
+            values = complete[column].to_numpy(dtype=object).copy()
+            values[order] = values[source]
+            complete[column] = values
+        complete = complete.sort_values(['project_name','project_id','sample_name','sample_id','frame_name','frame_id','cell_index'])
         complete.db = self.db
         complete.microns_per_pixel = self.microns_per_pixel
         return complete.reset_index(drop=True)
@@ -1115,16 +1097,46 @@ class CellDataFrame(pd.DataFrame):
             apply(lambda x: do_conv(x,cascading_scored_calls,ordinal_labels))
         return ndf
 
+def _read_hdf_table(path,key):
+    # read the older pandas table of json strings
+    df = pd.read_hdf(path,key)
+    df['scored_calls'] = df['scored_calls'].apply(lambda x: json.loads(x))
+    df['channel_values'] = df['channel_values'].apply(lambda x: json.loads(x))
+    df['regions'] = df['regions'].apply(lambda x: json.loads(x))
+    df['phenotype_calls'] = df['phenotype_calls'].apply(lambda x: json.loads(x))
+    df['neighbors'] = df['neighbors'].apply(lambda x: json.loads(x))
+    df['neighbors'] = df['neighbors'].apply(lambda x:
+            np.nan if not isinstance(x,dict) else dict(zip([int(y) for y in x.keys()],x.values()))
+        )
+    df['frame_shape'] = df['frame_shape'].apply(lambda x: tuple(json.loads(x)))
+    return df
+
+def _group_index(df,columns):
+    # Order rows by nested groups of columns (i.e. frames within samples within projects).
+    # Groups keep the order they are first seen in, and rows keep their order within a group.
+    # Rows with a missing value in any of the columns are left out.
+    #
+    # Returns the sorted row positions and the offsets where each group starts (plus the end).
+    levels = []
+    codes = np.zeros(df.shape[0],dtype=np.int64)
+    keep = np.ones(df.shape[0],dtype=bool)
+    for column in columns:
+        c, uniques = pd.factorize(df[column])
+        keep &= c>=0
+        codes, _ = pd.factorize(codes*(len(uniques)+1)+c)
+        levels.append(codes)
+    rows = np.flatnonzero(keep)
+    if len(levels) == 0 or rows.shape[0] == 0: return rows, np.zeros(1,dtype=np.int64)
+    order = rows[np.lexsort([x[rows] for x in levels[::-1]])]
+    final = levels[-1][order]
+    offsets = np.concatenate([[0],np.flatnonzero(final[1:]!=final[:-1])+1,[order.shape[0]]])
+    return order, offsets
+
 def _extract_unique_keys_from_series(s):
-    v = [set(list(x.keys())) for x in s]
+    # rows often share the same dictionary object so only look at each one once
+    objs = np.asarray(s,dtype=object)
+    v = [set(list(x.keys())) for x in objs[unique_objects(objs)[1]]]
     return sorted(list(set(chain.from_iterable(v))))
     #uni = pd.Series(s.apply(lambda x: json.dumps(x)).unique()).\
     #        apply(lambda x: json.loads(x)).apply(lambda x: set(sorted(x.keys())))
     #return sorted(list(set().union(*list(uni))))
-def _dict_rename(old,change):
-    new_keys = [x if x not in change else change[x] for x in old.keys()]
-    return dict(zip(new_keys, old.values()))
-
-
-
-
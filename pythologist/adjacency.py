@@ -0,0 +1,191 @@
+import pandas as pd
+import numpy as np
+from itertools import chain
+
+class Adjacency(object):
+    """
+    The cell-cell contacts of a CellDataFrame (its **neighbors** column) as a sparse (cells x cells) matrix in CSR form.
+
+    Rows and columns are row positions in the CellDataFrame and the weights are the pixel counts of shared edge.
+    Contacts are only resolved within a frame, and contacts to cells that are not in the CellDataFrame are left out.
+
+    Params:
+        indptr (numpy.array): row offsets into indices and data (length cells+1)
+        indices (numpy.array): row position of the neighboring cell for each contact
+        data (numpy.array): pixel count of shared edge for each contact
+        defined (numpy.array): boolean array, False for cells that have no neighbors dictionary (i.e. NaN)
+        complete (numpy.array): boolean array, True for cells where every neighbor was resolved
+    """
+    def __init__(self,indptr,indices,data,defined,complete=None):
+        self._indptr = indptr
+        self._indices = indices
+        self._data = data
+        self._defined = defined
+        self._complete = complete if complete is not None else np.ones(defined.shape[0],dtype=bool)
+
+    @classmethod
+    def from_cellframe(cls,cdf):
+        """
+        Build the adjacency from the neighbors column of a CellDataFrame.
+
+        Args:
+            cdf (CellDataFrame): the cells
+
+        Returns:
+            Adjacency
+        """
+        rows, keys, weights, defined = neighbor_arrays(cdf['neighbors'])
+        keys = keys.astype(np.int64)
+        n = cdf.shape[0]
+        # look up each neighbor's cell_index within the frame of the cell that lists it
+        frames = group_codes(cdf,cdf.frame_columns)
+        cell_index = cdf['cell_index'].to_numpy().astype(np.int64)
+        width = max(int(cell_index.max())+1 if n > 0 else 1,1)
+        cell_keys = frames*width+cell_index
+        order = np.argsort(cell_keys,kind='stable')
+        sorted_keys = cell_keys[order]
+        edge_keys = frames[rows]*width+keys
+        found = (keys>=0)&(keys<width)
+        cols = np.zeros(keys.shape[0],dtype=np.int64)
+        if n > 0:
+            pos = np.minimum(np.searchsorted(sorted_keys,edge_keys),n-1)
+            found &= sorted_keys[pos]==edge_keys
+            cols = order[pos]
+        missing = np.bincount(rows[~found],minlength=n)
+        counts = np.bincount(rows[found],minlength=n)
+        indptr = np.concatenate([[0],np.cumsum(counts)]).astype(np.int64)
+        return cls(indptr,cols[found].astype(np.int64),weights[found],defined,missing==0)
+
+    @property
+    def indptr(self):
+        return self._indptr
+    @property
+    def indices(self):
+        return self._indices
+    @property
+    def data(self):
+        return self._data
+    @property
+    def defined(self):
+        return self._defined
+    @property
+    def complete(self):
+        """
+        Return the boolean array of cells where every listed neighbor is present
+        """
+        return self._complete
+    @property
+    def shape(self):
+        return (self._defined.shape[0],self._defined.shape[0])
+
+    def edges(self):
+        """
+        Returns:
+            numpy.array, numpy.array, numpy.array: the row position of the cell, the row position of its neighbor and the shared pixel count for every contact
+        """
+        rows = np.repeat(np.arange(self._defined.shape[0]),np.diff(self._indptr))
+        return rows, self._indices, self._data
+
+    def to_series(self,cell_index,original=None,index=None):
+        """
+        Build neighbors dictionaries {<neighbor cell_index>:<shared pixel count>}.
+
+        Args:
+            cell_index (numpy.array): the cell_index of every row
+            original (pandas.Series): if set, the dictionary is reused for cells where every neighbor was resolved
+            index (pandas.Index): index to give the series
+
+        Returns:
+            pandas.Series: a series of dictionaries (NaN where the cell had no neighbors dictionary)
+        """
+        n = self._defined.shape[0]
+        output = np.empty(n,dtype=object)
+        output[:] = np.nan
+        rebuild = self._defined.copy()
+        if original is not None:
+            reuse = self._defined&self._complete
+            output[reuse] = np.asarray(original,dtype=object)[reuse]
+            rebuild &= ~reuse
+        keys = np.asarray(cell_index)[self._indices].tolist()
+        values = self._data.tolist()
+        indptr = self._indptr.tolist()
+        for i in np.flatnonzero(rebuild).tolist():
+            output[i] = dict(zip(keys[indptr[i]:indptr[i+1]],values[indptr[i]:indptr[i+1]]))
+        return pd.Series(output,index=index,dtype=object)
+
+def neighbor_arrays(s):
+    """
+    Flatten a column of neighbors dictionaries into contact arrays.
+
+    Args:
+        s (pandas.Series): series of {<neighbor cell_index>:<shared pixel count>} dictionaries (or NaN)
+
+    Returns:
+        numpy.array, numpy.array, numpy.array, numpy.array: the row position, neighbor cell_index and pixel count of every contact, and which rows have a dictionary
+    """
+    objs = np.asarray(s,dtype=object)
+    defined = np.fromiter((isinstance(x,dict) for x in objs),dtype=bool,count=len(objs))
+    lengths = np.fromiter((len(x) if isinstance(x,dict) else 0 for x in objs),dtype=np.int64,count=len(objs))
+    rows = np.repeat(np.arange(len(objs)),lengths)
+    keys = np.array(list(chain.from_iterable([x.keys() for x in objs[defined]])))
+    weights = np.array(list(chain.from_iterable([x.values() for x in objs[defined]])))
+    if keys.shape[0] == 0:
+        keys = np.zeros(0,dtype=np.int64)
+        weights = np.zeros(0,dtype=np.int64)
+    return rows, keys, weights, defined
+
+def neighbor_dicts(cell_index,neighbor_cell_index,pixel_count,cells):
+    """
+    Build neighbors dictionaries from a table of contacts like cell_interactions.
+
+    Args:
+        cell_index (numpy.array): the cell of each contact
+        neighbor_cell_index (numpy.array): the neighboring cell of each contact
+        pixel_count (numpy.array): the shared pixel count of each contact
+        cells (numpy.array): the cell indices to build a dictionary for
+
+    Returns:
+        list: a dictionary for each of the cells, empty if it has no contacts
+    """
+    cell_index = np.asarray(cell_index)
+    order = np.argsort(cell_index,kind='stable')
+    sorted_cells = cell_index[order]
+    keys = np.asarray(neighbor_cell_index)[order].tolist()
+    values = np.asarray(pixel_count)[order].tolist()
+    cells = np.asarray(cells)
+    starts = np.searchsorted(sorted_cells,cells,side='left').tolist()
+    stops = np.searchsorted(sorted_cells,cells,side='right').tolist()
+    return [dict(zip(keys[a:b],values[a:b])) for a,b in zip(starts,stops)]
+
+def group_codes(df,columns):
+    """
+    Args:
+        df (pandas.DataFrame): the data
+        columns (list): columns that together identify a group
+
+    Returns:
+        numpy.array: an integer code for each row's group, numbered in the order groups are first seen (missing values are treated as equal to each other)
+    """
+    n = df.shape[0]
+    codes = np.zeros(n,dtype=np.int64)
+    if n == 0: return codes
+    size = 1
+    for column in columns:
+        c, k = _column_codes(np.asarray(df[column]))
+        # keep the combined code from overflowing
+        if size*(k+1) >= 2**62:
+            codes, uniques = pd.factorize(codes)
+            size = len(uniques)
+        codes = codes*(k+1)+c
+        size = size*(k+1)
+    return pd.factorize(codes)[0].astype(np.int64)
+
+def _column_codes(values):
+    # factorize a column, only looking at the first value of each run of equal values (columns like frame_id come in long runs)
+    n = values.shape[0]
+    change = np.ones(n,dtype=bool)
+    change[1:] = values[1:]!=values[:-1]
+    heads = np.flatnonzero(change)
+    c, uniques = pd.factorize(values[heads],use_na_sentinel=False)
+    if heads.shape[0] == n: return c.astype(np.int64), len(uniques)
+    return np.repeat(c.astype(np.int64),np.diff(np.append(heads,n))), len(uniques)
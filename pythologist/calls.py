@@ -0,0 +1,280 @@
+import pandas as pd
+import numpy as np
+
+class CallMatrix(object):
+    """
+    A columnar view of a column of per-cell dictionaries like **phenotype_calls** or **scored_calls**.
+
+    Rather than a python dictionary on every row, calls are held as a schema of names
+    and a (cells x names) array of values.  Dictionaries are only built when asked for,
+    and then only once for each distinct pattern of calls with rows sharing that dictionary.
+
+    Params:
+        names (list): the call names, one for each column of values
+        values (numpy.array): (cells x names) array of call values
+        present (numpy.array): (cells x names) boolean array, True where the cell's dictionary has the name
+        defined (numpy.array): boolean array, False for cells that had no dictionary at all (i.e. NaN)
+    """
+    def __init__(self,names,values,present=None,defined=None):
+        self._names = list(names)
+        self._values = values
+        self._present = present if present is not None else np.ones(values.shape,dtype=bool)
+        self._defined = defined if defined is not None else np.ones(values.shape[0],dtype=bool)
+
+    @classmethod
+    def from_series(cls,s,dtype=np.int8):
+        """
+        Build the matrix from a series of dictionaries.  Each distinct dictionary object is only read once.
+
+        Args:
+            s (pandas.Series): series of dictionaries (or NaN)
+            dtype (numpy.dtype): type to store values as (default int8)
+
+        Returns:
+            CallMatrix
+        """
+        objs = np.asarray(s,dtype=object)
+        codes, first = unique_objects(objs)
+        uobjs = objs[first]
+        udefined = np.fromiter((isinstance(x,dict) for x in uobjs),dtype=bool,count=len(uobjs))
+        rows = np.flatnonzero(udefined)
+        dicts = uobjs[rows]
+        # group the distinct dictionaries by their keys so each block of the matrix is filled at once
+        kcodes, kuniques = pd.factorize(pd.Series([tuple(d.keys()) for d in dicts],dtype=object))
+        names = {}
+        for keys in kuniques:
+            for k in keys:
+                if k not in names: names[k] = len(names)
+        uvalues = np.zeros((len(first),len(names)),dtype=dtype)
+        upresent = np.zeros((len(first),len(names)),dtype=bool)
+        for g,keys in enumerate(kuniques):
+            if len(keys) == 0: continue
+            members = np.flatnonzero(kcodes==g)
+            cells = np.ix_(rows[members],[names[k] for k in keys])
+            uvalues[cells] = np.array([list(d.values()) for d in dicts[members]],dtype=dtype)
+            upresent[cells] = True
+        return cls(list(names.keys()),uvalues[codes],upresent[codes],udefined[codes])
+
+    def to_series(self,index=None):
+        """
+        Build the dictionaries.  Rows with the same calls share the same dictionary object.
+
+        Args:
+            index (pandas.Index): index to give the series
+
+        Returns:
+            pandas.Series: a series of dictionaries (NaN where the row had no dictionary)
+        """
+        n = self._values.shape[0]
+        output = np.empty(n,dtype=object)
+        output[:] = np.nan
+        if n > 0:
+            rows = np.ascontiguousarray(np.hstack([self._defined[:,None].view(np.uint8),
+                                                   self._present.view(np.uint8),
+                                                   np.ascontiguousarray(self._values).view(np.uint8).reshape(n,-1)]))
+            _, first, codes = np.unique(rows.view(np.dtype((np.void,rows.shape[1]))).ravel(),
+                                        return_index=True,return_inverse=True)
+            dicts = np.empty(len(first),dtype=object)
+            dicts[:] = np.nan
+            patterns = np.flatnonzero(self._defined[first])
+            # patterns that share the same names are built together
+            pcodes, puniques = pd.factorize(pd.Series([x.tobytes() for x in self._present[first[patterns]]],dtype=object))
+            for p in range(len(puniques)):
+                members = patterns[pcodes==p]
+                cols = np.flatnonzero(self._present[first[members[0]]])
+                keys = [self._names[c] for c in cols]
+                for j,row in zip(members,self._values[np.ix_(first[members],cols)].tolist()):
+                    dicts[j] = dict(zip(keys,row))
+            output = dicts[codes.ravel()]
+        return pd.Series(output,index=index,dtype=object)
+
+    @property
+    def names(self):
+        """
+        Return the list of call names
+        """
+        return self._names.copy()
+    @property
+    def values(self):
+        """
+        Return the (cells x names) array of values
+        """
+        return self._values
+    @property
+    def present(self):
+        """
+        Return the (cells x names) boolean array of which names are present for each cell
+        """
+        return self._present
+    @property
+    def defined(self):
+        """
+        Return the boolean array of which cells have a dictionary
+        """
+        return self._defined
+    @property
+    def shape(self):
+        return self._values.shape
+
+    def _column_index(self,name):
+        if name not in self._names: raise ValueError("call name '"+str(name)+"' is not present")
+        return self._names.index(name)
+
+    def has(self,name):
+        """
+        Args:
+            name (str): call name
+
+        Returns:
+            numpy.array: boolean array of which cells define the call name
+        """
+        if name not in self._names: return np.zeros(self._values.shape[0],dtype=bool)
+        return self._present[:,self._names.index(name)]
+
+    def column(self,name):
+        """
+        Args:
+            name (str): call name
+
+        Returns:
+            numpy.array: the values of the call (zero where not present)
+        """
+        i = self._column_index(name)
+        return np.where(self._present[:,i],self._values[:,i],0)
+
+    def equals(self,name,value):
+        """
+        Args:
+            name (str): call name
+            value (int): value to match
+
+        Returns:
+            numpy.array: boolean array of cells where the call is present and equal to the value
+        """
+        if name not in self._names: return np.zeros(self._values.shape[0],dtype=bool)
+        i = self._names.index(name)
+        return self._present[:,i]&(self._values[:,i]==value)
+
+    def any_equals(self,names,value=1):
+        """
+        Args:
+            names (list): call names
+            value (int): value to match (default 1)
+
+        Returns:
+            numpy.array: boolean array of cells where any of the calls are present and equal to value
+        """
+        cols = [self._names.index(x) for x in names if x in self._names]
+        return (self._present[:,cols]&(self._values[:,cols]==value)).any(axis=1)
+
+    def first_label(self,value=1):
+        """
+        Return the first call name set to value for each cell (NaN if none are set)
+
+        Returns:
+            numpy.array: object array of labels
+        """
+        hits = self._present&(self._values==value)
+        output = np.empty(self._values.shape[0],dtype=object)
+        output[:] = np.nan
+        found = hits.any(axis=1)
+        if len(self._names) > 0:
+            output[found] = np.array(self._names,dtype=object)[hits.argmax(axis=1)[found]]
+        return output
+
+    def take(self,rows):
+        """
+        Args:
+            rows (numpy.array): boolean mask or integer positions of cells to keep
+
+        Returns:
+            CallMatrix
+        """
+        return self.__class__(self._names,self._values[rows],self._present[rows],self._defined[rows])
+
+    def select(self,names):
+        """
+        Args:
+            names (list): call names to keep, in the order given
+
+        Returns:
+            CallMatrix
+        """
+        cols = [self._column_index(x) for x in names]
+        return self.__class__([self._names[c] for c in cols],self._values[:,cols],self._present[:,cols],self._defined)
+
+    def drop(self,names):
+        """
+        Args:
+            names (list): call names to remove (names not present are ignored)
+
+        Returns:
+            CallMatrix
+        """
+        return self.select([x for x in self._names if x not in names])
+
+    def assign(self,name,values,present=None):
+        """
+        Set the values for a call name, adding it if it does not exist.
+        Where present is False the current value (if any) is kept.
+
+        Args:
+            name (str): call name
+            values (numpy.array): value for every cell
+            present (numpy.array): boolean array of which cells get the call (default all defined cells)
+
+        Returns:
+            CallMatrix
+        """
+        if present is None: present = self._defined.copy()
+        present = present&self._defined
+        values = np.asarray(values).astype(self._values.dtype)
+        if name in self._names:
+            i = self._names.index(name)
+            newvalues = self._values.copy()
+            newpresent = self._present.copy()
+            newvalues[:,i] = np.where(present,values,self._values[:,i])
+            newpresent[:,i] = present|self._present[:,i]
+            return self.__class__(self._names,newvalues,newpresent,self._defined)
+        return self.__class__(self._names+[name],
+                              np.hstack([self._values,values.reshape(-1,1)]),
+                              np.hstack([self._present,present.reshape(-1,1)]),
+                              self._defined)
+
+    def rename(self,change):
+        """
+        Args:
+            change (dict): {<current name>:<new name>}.  If a new name collides with another name the later column wins.
+
+        Returns:
+            CallMatrix
+        """
+        output = self.__class__([],np.zeros((self._values.shape[0],0),dtype=self._values.dtype),
+                                np.zeros((self._values.shape[0],0),dtype=bool),self._defined)
+        for i,name in enumerate(self._names):
+            output = output.assign(change.get(name,name),self._values[:,i],self._present[:,i])
+        return output
+
+    def is_uniform(self):
+        """
+        Returns:
+            bool: True if every cell with calls has the same set of call names
+        """
+        present = self._present[self._defined]
+        if present.shape[0] == 0: return True
+        return bool((present==present[0]).all())
+
+def unique_objects(s):
+    """
+    Find the distinct python objects in a series.  Rows of dictionary columns often share the same object.
+
+    Args:
+        s (pandas.Series): series of objects
+
+    Returns:
+        numpy.array, numpy.array: code of the distinct object for each row, and the first row position of each distinct object
+    """
+    objs = np.asarray(s,dtype=object)
+    codes, _ = pd.factorize(np.fromiter((id(x) for x in objs),dtype=np.int64,count=len(objs)))
+    _, first = np.unique(codes,return_index=True)
+    return codes, first
@@ -98,7 +98,7 @@ class SegmentationImages(Measurement):
         ems = self.get_segmentation_maps(type=type)
         subset = self.cdf
         if subset_logic is not None: 
-            subset = self.cdf.subset(subset_logic)
+            subset = self.cdf.loc[self.cdf.subset_masks([subset_logic])[:,0]]
             ems = ems.merge(subset.loc[:,subset.frame_columns+['cell_index']],on=subset.frame_columns+['cell_index'])
         #edf = ems.set_index(list(self.columns))
         imgs = []
@@ -273,7 +273,8 @@ def _get_new_regions(cdf,sample,frame_id,unset_label='undefined',gaussian_sigma=
     fid = sub.iloc[0]['frame_id']
     proc = cdf.db.get_sample(sid).get_frame(fid).processed_image
     present = sub['phenotype_label'].unique()
-    for p in sub.phenotypes:
+    masks = sub.subset_masks([SL(phenotypes=[p]) for p in sub.phenotypes])
+    for i,p in enumerate(sub.phenotypes):
         empty = np.zeros(shape)
         if p not in present:
             dfs[p] = empty.copy().astype(float)
@@ -282,7 +283,7 @@ def _get_new_regions(cdf,sample,frame_id,unset_label='undefined',gaussian_sigma=
         emap.columns = ['y','x','id']
         emap = emap.drop(columns='id')
         
-        sel = sub.subset(SL(phenotypes=[p]))[['x','y']].drop_duplicates()
+        sel = sub.loc[masks[:,i],['x','y']].drop_duplicates()
         sel['id'] = 1
         sel = emap.merge(sel,on=['x','y'],how='left').fillna(0).pivot(columns='x',index='y',values='id')
         sel = np.array(sel).astype(float)
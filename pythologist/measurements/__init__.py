@@ -20,10 +20,11 @@ class Measurement(pd.DataFrame):
         # measured_regions
         # measured_phenotypes
         #
+        if measured_regions is None: measured_regions = cdf.get_measured_regions() # pruning does not change the regions
         if prune_neighbors: cdf = cdf.prune_neighbors()
         v = cls(cls._preprocess_dataframe(cdf,verbose=verbose,**kwargs))
-        if measured_regions is None: v.measured_regions = cdf.get_measured_regions()
-        if measured_phenotypes is None: v.measured_phenotypes = cdf.phenotypes
+        v.measured_regions = measured_regions
+        v.measured_phenotypes = cdf.phenotypes if measured_phenotypes is None else measured_phenotypes
         v.microns_per_pixel = cdf.microns_per_pixel
         v.verbose = verbose
         v.cdf = cdf.copy() 
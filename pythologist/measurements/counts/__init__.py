@@ -4,21 +4,62 @@ import numpy as np
 import math
 from pythologist.measurements import Measurement
 from collections import namedtuple
-from scipy.stats import sem
+from scipy import sparse
+from pythologist.adjacency import group_codes
 
 _degrees_of_freedom = 1
 
 PercentageLogic = namedtuple('PercentageLogic',('numerator','denominator','label'))
 
 class Counts(Measurement):
+    _metadata = Measurement._metadata+['region_groups']
+    region_groups = None # set by group_regions
     @staticmethod
     def _preprocess_dataframe(cdf,*args,**kwargs):
         # set our phenotype labels
         data = pd.DataFrame(cdf) # we don't need to do anything special with the dataframe for counting
-        data['phenotype_label'] = data.apply(lambda x: 
-                [k for k,v in x['phenotype_calls'].items() if v==1]
-            ,1).apply(lambda x: np.nan if len(x)==0 else x[0])
+        # the first phenotype called 1, or NaN if there is none
+        calls = cdf.call_matrix('phenotype_calls')
+        positive = calls.present&(calls.values==1)
+        labels = np.empty(data.shape[0],dtype=object)
+        labels[:] = np.nan
+        has = positive.any(axis=1)
+        if has.any(): labels[has] = np.array(calls.names,dtype=object)[positive[has].argmax(axis=1)]
+        data['phenotype_label'] = labels
         return data
+    def group_regions(self,region_groups):
+        """
+        Count over groups of regions rather than the regions themselves.  The cells are not copied or processed again,
+        and a region can be a member of more than one group, so every grouping of interest can be counted at once.
+
+        Args:
+            region_groups (dict): {<region group label>:[<member region labels>]}
+
+        Returns:
+            Counts: counts where region_label is the region group and region areas are the sums of the measured member region areas
+        """
+        members = []
+        for label,regions in region_groups.items():
+            if isinstance(regions,str): regions = [regions]
+            members += [(x,label) for x in regions]
+        members = pd.DataFrame(members,columns=['region_label','_region_group'])
+        bad_regions = set(members['region_label'])-set(self.cdf.regions)
+        if len(bad_regions) > 0: raise ValueError("Error regions(s) "+str(bad_regions)+" are not in the data.")
+        mergeon = self.cdf.frame_columns
+        mr = self.measured_regions.merge(members,on='region_label').\
+            groupby(mergeon+['_region_group'],sort=False)[['region_area_pixels','region_cell_count']].sum().reset_index().\
+            rename(columns={'_region_group':'region_label'})
+        v = self.__class__(self)
+        v.measured_regions = mr
+        v.measured_phenotypes = self.measured_phenotypes
+        v.microns_per_pixel = self.microns_per_pixel
+        v.verbose = self.verbose
+        v.cdf = self.cdf
+        v.minimum_region_size_pixels = self.minimum_region_size_pixels
+        v.minimum_denominator_count = self.minimum_denominator_count
+        v.region_groups = members
+        return v
+
     def frame_counts(self,subsets=None,_apply_filter=True):
         """
         Frame counts is the core of all the counting operations.  It counts on a per-frame/per-region basis.
@@ -30,25 +71,19 @@ class Counts(Measurement):
         Returns:
             pandas.DataFrame: A dataframe of count data
         """
+        return self._finish_frame_counts(self._frame_counts(subsets),subsets,_apply_filter)
+
+    def _frame_counts(self,subsets):
+        # Count every population in every measured region in one pass, before any filter is applied.
+        # Each cell gets a row of a (cells x populations) membership matrix, the phenotypes or the subsets,
+        # and counts and cell areas are summed for each frame region and population in one grouped aggregation.
         mergeon = self.cdf.frame_columns+['region_label']
         if subsets is None:
-            #cnts = self.groupby(mergeon+['phenotype_label']).count()[['cell_index']].\
-            #    rename(columns={'cell_index':'count'})
-            cnts = self.groupby(mergeon+['phenotype_label']).\
-                apply(lambda x: pd.Series(dict(zip(
-                    ['count','cell_area_pixels'],
-                    [len(x['cell_index']),sum(x['cell_area'])]
-                )))).reset_index()
-            mr = self.measured_regions
-            mr['_key'] =  1
-            mp = pd.DataFrame({'phenotype_label':self.measured_phenotypes})
-            mp['_key'] = 1
-            mr = mr.merge(mp,on='_key').drop(columns='_key')
-            cnts = mr.merge(cnts,on=mergeon+['phenotype_label'],how='left').fillna(0)
+            cells = self
+            labels = list(self.measured_phenotypes)
+            codes = pd.Categorical(self['phenotype_label'],categories=labels).codes.astype(np.int64)
         else:
-             # Use subsets
             if isinstance(subsets,SL): subsets=[subsets]
-            cnts = []
             labels = set([s.label for s in subsets])
             for x in subsets: 
                 if x.label is None: raise ValueError("Subsets must be named")
@@ -57,35 +92,69 @@ class Counts(Measurement):
             for sl in subsets:
                 if sl.label in seen_labels: raise ValueError("cannot use the same label twice in the subsets list")
                 seen_labels.append(sl.label)
+            cells = self.cdf
+            labels = [sl.label for sl in subsets]
+            masks = self.cdf.subset_masks(subsets)
+        n = len(labels)
+        # the frame region of each cell
+        groups = group_codes(cells,mergeon)
+        n_groups = groups.max()+1 if groups.shape[0] > 0 else 0
+        first = np.zeros(n_groups,dtype=np.int64)
+        first[groups[::-1]] = np.arange(groups.shape[0])[::-1]
+        heads = pd.DataFrame(cells.iloc[first][mergeon]).reset_index(drop=True)
+        heads['_group'] = np.arange(n_groups)
+        heads = heads.loc[~heads[mergeon].isna().any(axis=1)]
+        area = cells['cell_area'].to_numpy().astype(np.float64)
+        count = np.zeros((n_groups+1,n),dtype=np.int64)
+        cell_area = np.zeros((n_groups+1,n),dtype=np.float64)
+        if subsets is None:
+            keep = codes>=0
+            count[:n_groups] = np.bincount(groups[keep]*n+codes[keep],minlength=n_groups*n).reshape(n_groups,n)
+            cell_area[:n_groups] = np.bincount(groups[keep]*n+codes[keep],weights=area[keep],minlength=n_groups*n).reshape(n_groups,n)
+        else:
+            count[:n_groups], cell_area[:n_groups] = _population_sums(groups,n_groups,masks,area)
+        if self.region_groups is not None:
+            # roll the frame regions up into every region group they are a member of
+            rolled = heads.merge(self.region_groups,on='region_label')
+            rolled_groups = group_codes(rolled,self.cdf.frame_columns+['_region_group'])
+            n_groups = rolled_groups.max()+1 if rolled_groups.shape[0] > 0 else 0
+            source = rolled['_group'].to_numpy()
+            count, rolled_count = np.zeros((n_groups+1,n),dtype=np.int64), count
+            cell_area, rolled_area = np.zeros((n_groups+1,n),dtype=np.float64), cell_area
+            np.add.at(count,rolled_groups,rolled_count[source])
+            np.add.at(cell_area,rolled_groups,rolled_area[source])
+            first = np.zeros(n_groups,dtype=np.int64)
+            first[rolled_groups[::-1]] = np.arange(rolled_groups.shape[0])[::-1]
+            heads = rolled.iloc[first].drop(columns=['region_label','_group']).\
+                rename(columns={'_region_group':'region_label'}).reset_index(drop=True)
+            heads['_group'] = np.arange(n_groups)
+        # the frame region of each measured region (the extra last row is for regions without cells)
+        mr = self.measured_regions.reset_index(drop=True)
+        region = mr[mergeon].merge(heads,on=mergeon,how='left')['_group'].fillna(n_groups).to_numpy().astype(np.int64)
+        mr = mr.fillna(0)
+        if subsets is None:
+            # regions by phenotypes
+            rows = np.repeat(np.arange(mr.shape[0]),n)
+            pops = np.tile(np.arange(n),mr.shape[0])
+        else:
+            # subsets by regions
+            rows = np.tile(np.arange(mr.shape[0]),n)
+            pops = np.repeat(np.arange(n),mr.shape[0])
+        cnts = mr[mergeon+['region_area_pixels']].iloc[rows].reset_index(drop=True)
+        cnts['phenotype_label'] = np.array(labels,dtype=object)[pops]
+        cnts['count'] = count[region[rows],pops]
+        cnts['cell_area_pixels'] = cell_area[region[rows],pops]
+        cnts['region_area_mm2'] = (cnts['region_area_pixels']/1000000)*(self.microns_per_pixel*self.microns_per_pixel)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            cnts['density_mm2'] = np.where(cnts['region_area_mm2']==0,np.nan,cnts['count']/cnts['region_area_mm2'])
+            totals = group_codes(cnts,mergeon)
+            cnts['frame_total_count'] = np.bincount(totals,weights=cnts['count'],minlength=totals.max()+1 if totals.shape[0] > 0 else 0)[totals].astype(np.int64)
+            cnts['population_percent'] = np.where(cnts['frame_total_count']==0,np.nan,100*cnts['count']/cnts['frame_total_count'])
+            cnts['area_coverage_percent'] = np.where(cnts['region_area_pixels']<self.minimum_region_size_pixels,np.nan,100*cnts['cell_area_pixels']/cnts['region_area_pixels'])
+        return cnts
 
-                df = self.cdf.subset(sl)
-                #df = df.groupby(mergeon).count()[['cell_index']].\
-                #    rename(columns={'cell_index':'count'}).reset_index()
-                if df.shape[0] > 0:
-                    df = df.groupby(mergeon).\
-                    apply(lambda x: pd.Series(dict(zip(
-                        ['count','cell_area_pixels'],
-                        [len(x['cell_index']),sum(x['cell_area'])]
-                    )))).reset_index()
-                else:
-                    df = self.measured_regions[mergeon].copy()
-                    df.loc[:,'count'] = 0
-                    df.loc[:,'cell_area_pixels'] = 0
-                df = self.measured_regions.merge(df,on=mergeon,how='left').fillna(0)
-                df['phenotype_label'] = sl.label
-                cnts.append(df)
-            cnts = pd.concat(cnts)
-        cnts = cnts[mergeon+['region_area_pixels','phenotype_label','count','cell_area_pixels']]
-        cnts['region_area_mm2'] = cnts.apply(lambda x: 
-            (x['region_area_pixels']/1000000)*(self.microns_per_pixel*self.microns_per_pixel),1)
-        cnts['density_mm2'] = cnts.apply(lambda x: np.nan if x['region_area_mm2'] == 0 else x['count']/x['region_area_mm2'],1)
-
-        totals = cnts.groupby(mergeon).sum(numeric_only=True)[['count']].\
-            rename(columns={'count':'frame_total_count'}).reset_index()
-        cnts = cnts.merge(totals,on=mergeon)
-        cnts['population_percent'] = cnts.apply(lambda x: np.nan if x['frame_total_count']==0 else 100*x['count']/x['frame_total_count'],1)
-        cnts['area_coverage_percent'] = cnts.apply(lambda x: np.nan if x['region_area_pixels'] <  self.minimum_region_size_pixels else 100*x['cell_area_pixels']/x['region_area_pixels'],1)
-
+    def _finish_frame_counts(self,cnts,subsets,_apply_filter):
+        cnts = cnts.copy()
         # make sure regions of size zero have counts of np.nan
         if _apply_filter:
             cnts.loc[cnts['frame_total_count']<self.minimum_denominator_count,['population_percent']] = np.nan
@@ -94,7 +163,7 @@ class Counts(Measurement):
 
         cnts['count'] = cnts['count'].astype(int)
         cnts['cell_area_pixels'] = cnts['cell_area_pixels'].astype(int)
-        cnts['measured'] = cnts['density_mm2'].apply(lambda x: x==x)
+        cnts['measured'] = ~cnts['density_mm2'].isna()
 
         if subsets is not None:
             # if we are doing subsets we've lost any relevent reference counts in the subsetting process
@@ -109,57 +178,38 @@ class Counts(Measurement):
             count()[['frame_id']].rename(columns={'frame_id':'region_count'}).\
             reset_index()
 
+        # Count once, then finish with and without the filter
+        raw = self._frame_counts(subsets)
+
         # Take one pass through where we apply the minimum pixel count
-        cnts1 = self.frame_counts(subsets=subsets).\
-            groupby(mergeon+['phenotype_label']).\
-            apply(lambda x:
-                pd.Series(dict(zip(
-                    [
-                     'mean_density_mm2',
-                     'stddev_density_mm2',
-                     'stderr_density_mm2',
-                     'mean_area_coverage_percent',
-                     'stddev_area_coverage_percent',
-                     'stderr_area_coverage_percent',
-                     'measured_count'
-                    ],
-                    [
-                     x['density_mm2'].mean(),
-                     np.nan if len([y for y in x['density_mm2'] if y==y]) <=1 else x['density_mm2'].std(ddof=_degrees_of_freedom,skipna=True),
-                     np.nan if len([y for y in x['density_mm2'] if y==y]) <=1 else sem(x['density_mm2'],ddof=_degrees_of_freedom,nan_policy='omit'),
-                     x['area_coverage_percent'].mean(),
-                     np.nan if len([y for y in x['area_coverage_percent'] if y==y]) <=1 else x['area_coverage_percent'].std(ddof=_degrees_of_freedom,skipna=True),
-                     np.nan if len([y for y in x['area_coverage_percent'] if y==y]) <=1 else sem(x['area_coverage_percent'],ddof=_degrees_of_freedom,nan_policy='omit'),
-                     len([y for y in x['density_mm2'] if y==y])
-                    ]
-                )))
-            ).reset_index()
+        keys = mergeon+['phenotype_label']
+        filtered = self._finish_frame_counts(raw,subsets,True)
+        density = _sample_statistics(filtered,keys,'density_mm2')
+        coverage = _sample_statistics(filtered,keys,'area_coverage_percent')
+        cnts1 = pd.DataFrame({
+                     'mean_density_mm2':density['mean'],
+                     'stddev_density_mm2':density['stddev'],
+                     'stderr_density_mm2':density['stderr'],
+                     'mean_area_coverage_percent':coverage['mean'],
+                     'stddev_area_coverage_percent':coverage['stddev'],
+                     'stderr_area_coverage_percent':coverage['stderr'],
+                     'measured_count':density['count'].astype(float)
+            }).reset_index()
         cnts1= cnts1.merge(fc,on=mergeon)
         #cnts1['measured_frame_count'] = cnts1['measured_frame_count'].astype(int)
 
         # Take one pass through ignoring the minimum pixel count at the frame level and applying it to the whole sample for cumulative measures
-        cnts2 = self.frame_counts(subsets=subsets,_apply_filter=False).\
-            groupby(mergeon+['phenotype_label']).\
-            apply(lambda x:
-                pd.Series(dict(zip(
-                    [
-                     'cumulative_region_area_pixels',
-                     'cumulative_region_area_mm2',
-                     'cumulative_count',
-                     'cumulative_density_mm2',
-                     'cumulative_cell_area_pixels',
-                     'cumulative_area_coverage_percent'
-                    ],
-                    [
-                     x['region_area_pixels'].sum(),
-                     x['region_area_mm2'].sum(),
-                     x['count'].sum(),
-                     np.nan if x['region_area_pixels'].sum() < self.minimum_region_size_pixels else x['count'].sum()/x['region_area_mm2'].sum(),
-                     x['cell_area_pixels'].sum(),
-                     np.nan if x['region_area_pixels'].sum() < self.minimum_region_size_pixels else 100*x['cell_area_pixels'].sum()/x['region_area_pixels'].sum()
-                    ]
-                )))
-            ).reset_index()
+        sums = self._finish_frame_counts(raw,subsets,False).groupby(keys)[['region_area_pixels','region_area_mm2','count','cell_area_pixels']].sum().astype(float)
+        small = sums['region_area_pixels'] < self.minimum_region_size_pixels
+        with np.errstate(divide='ignore',invalid='ignore'):
+            cnts2 = pd.DataFrame({
+                     'cumulative_region_area_pixels':sums['region_area_pixels'],
+                     'cumulative_region_area_mm2':sums['region_area_mm2'],
+                     'cumulative_count':sums['count'],
+                     'cumulative_density_mm2':np.where(small,np.nan,sums['count']/sums['region_area_mm2']),
+                     'cumulative_cell_area_pixels':sums['cell_area_pixels'],
+                     'cumulative_area_coverage_percent':np.where(small,np.nan,100*sums['cell_area_pixels']/sums['region_area_pixels'])
+                },index=sums.index).reset_index()
         cnts2= cnts2.merge(fc,on=mergeon)
         cnts = cnts2.merge(cnts1,on=mergeon+['phenotype_label','region_count'])
 
@@ -168,7 +218,8 @@ class Counts(Measurement):
         totals = cnts.groupby(mergeon).sum(numeric_only=True)[['cumulative_count']].\
             rename(columns={'cumulative_count':'sample_total_count'}).reset_index()
         cnts = cnts.merge(totals,on=mergeon)
-        cnts['population_percent'] = cnts.apply(lambda x: np.nan if x['sample_total_count']==0 else 100*x['cumulative_count']/x['sample_total_count'],1)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            cnts['population_percent'] = np.where(cnts['sample_total_count']==0,np.nan,100*cnts['cumulative_count']/cnts['sample_total_count'])
 
         cnts['measured_count'] = cnts['measured_count'].astype(int)
 
@@ -182,7 +233,7 @@ class Counts(Measurement):
 
         cnts['cumulative_region_area_pixels'] = cnts['cumulative_region_area_pixels'].astype(int)
         cnts['cumulative_cell_area_pixels'] = cnts['cumulative_cell_area_pixels'].astype(int)
-        cnts['measured'] = cnts['measured_count'].apply(lambda x: x>0)
+        cnts['measured'] = cnts['measured_count']>0
 
         # get the frame counts
         _fc = self.loc[:,['project_id','project_name','sample_id','sample_name','frame_id']].drop_duplicates().\
@@ -218,24 +269,25 @@ class Counts(Measurement):
 
     def frame_percentages(self,percentage_logic_list):
         criteria = self.cdf.frame_columns+['region_label']
-        results = []
         seen_labels = []
         for entry in percentage_logic_list:
             if entry.label in seen_labels: raise ValueError("cannot use the same label twice in the percentage logic list")
             seen_labels.append(entry.label)
-            entry.numerator.label = 'numerator'
-            entry.denominator.label = 'denominator'
-            numerator = self.frame_counts(subsets=[entry.numerator])
-            denominator = self.frame_counts(subsets=[entry.denominator])
-            numerator = numerator[criteria+['count']].rename(columns={'count':'numerator'})
-            denominator = denominator[criteria+['count']].rename(columns={'count':'denominator'})
+        # count each distinct population once, whether it is a numerator or denominator and however many percentages use it
+        logics, slots = _distinct_logics([x for entry in percentage_logic_list for x in [entry.numerator,entry.denominator]])
+        counts = dict(list(self.frame_counts(subsets=logics)[criteria+['phenotype_label','count']].\
+            groupby('phenotype_label',sort=False)))
+        results = []
+        for i,entry in enumerate(percentage_logic_list):
+            numerator = counts[logics[slots[2*i]].label][criteria+['count']].rename(columns={'count':'numerator'})
+            denominator = counts[logics[slots[2*i+1]].label][criteria+['count']].rename(columns={'count':'denominator'})
             combo = numerator.merge(denominator,on=criteria, how='outer')
-            combo['percent'] = combo.\
-                apply(lambda x: np.nan if x['denominator']<self.minimum_denominator_count else 100*x['numerator']/x['denominator'],1)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                combo['percent'] = np.where(combo['denominator']<self.minimum_denominator_count,np.nan,100*combo['numerator']/combo['denominator'])
             combo['phenotype_label'] = entry.label
             results.append(combo)
         df = pd.concat(results)
-        df['measured'] = df['denominator'].apply(lambda x: x>=self.minimum_denominator_count)
+        df['measured'] = df['denominator']>=self.minimum_denominator_count
         return df
     def sample_percentages(self,percentage_logic_list):
         #mergeon = self.cdf.sample_columns+['region_label']
@@ -280,23 +332,24 @@ class Counts(Measurement):
         fc = fc.merge(mfc,on=self.cdf.sample_columns+['region_label','phenotype_label'],how='left').fillna(0)
 
 
-        cnts = fp.groupby(self.cdf.sample_columns+['phenotype_label','region_label']).\
-           apply(lambda x:
-           pd.Series(dict({
-               'cumulative_numerator':x['numerator'].sum(),
-               'cumulative_denominator':x['denominator'].sum(),
-               'cumulative_percent':np.nan if x['denominator'].sum()!=x['denominator'].sum() or x['denominator'].sum()<self.minimum_denominator_count else 100*x['numerator'].sum()/x['denominator'].sum(),
-               'mean_percent':x['percent'].mean(),
-               'stddev_percent':np.nan if len([y for y in x['percent'] if y==y]) <= 1 else x['percent'].std(ddof=_degrees_of_freedom,skipna=True),
-               'stderr_percent':np.nan if len([y for y in x['percent'] if y==y]) <= 1 else sem(x['percent'],ddof=_degrees_of_freedom,nan_policy='omit'),
+        keys = self.cdf.sample_columns+['phenotype_label','region_label']
+        sums = fp.groupby(keys)[['numerator','denominator']].sum().astype(float)
+        percent = _sample_statistics(fp,keys,'percent')
+        with np.errstate(divide='ignore',invalid='ignore'):
+            cnts = pd.DataFrame({
+               'cumulative_numerator':sums['numerator'],
+               'cumulative_denominator':sums['denominator'],
+               'cumulative_percent':np.where(sums['denominator']<self.minimum_denominator_count,np.nan,100*sums['numerator']/sums['denominator']),
+               'mean_percent':percent['mean'],
+               'stddev_percent':percent['stddev'],
+               'stderr_percent':percent['stderr'],
                #'measured_frame_count':len([y for y in x['percent'] if y==y]),
-           }))
-           ).reset_index()
+            },index=sums.index).reset_index()
         cnts = cnts.merge(fc,on=self.cdf.sample_columns+['region_label','phenotype_label'])
         cnts['measured_count'] = cnts['measured_count'].astype(int)
         cnts['cumulative_numerator'] = cnts['cumulative_numerator'].astype(int)
         cnts['cumulative_denominator'] = cnts['cumulative_denominator'].astype(int)
-        cnts['measured'] = cnts['cumulative_denominator'].apply(lambda x: x>=self.minimum_denominator_count)
+        cnts['measured'] = cnts['cumulative_denominator']>=self.minimum_denominator_count
         #stc = fp.groupby(self.cdf.sample_columns+['region_label']).sum()[['denominator']]
         #cnts['sample_total_count'] = cnts['sample_total_count'].astype(int)
 
@@ -346,3 +399,43 @@ class Counts(Measurement):
 
         return pp
 
+def _population_sums(groups,n_groups,masks,area,chunk_size=200000):
+    # cell counts and cell area sums for each group and population of a (cells x populations) boolean matrix
+    # as a (groups x cells) one-hot matrix product, a chunk of cells at a time to bound the memory of the float copy
+    count = np.zeros((n_groups,masks.shape[1]),dtype=np.float64)
+    cell_area = np.zeros((n_groups,masks.shape[1]),dtype=np.float64)
+    for start in range(0,masks.shape[0],chunk_size):
+        stop = min(start+chunk_size,masks.shape[0])
+        m = masks[start:stop].astype(np.float64)
+        cols = np.arange(stop-start)
+        count += sparse.csr_matrix((np.ones(stop-start),(groups[start:stop],cols)),shape=(n_groups,stop-start)).dot(m)
+        cell_area += sparse.csr_matrix((area[start:stop],(groups[start:stop],cols)),shape=(n_groups,stop-start)).dot(m)
+    return np.rint(count).astype(np.int64), cell_area
+
+def _distinct_logics(subsets):
+    # the distinct populations among a list of SubsetLogic, as new logics with their own labels (the originals are left untouched)
+    # and the position of each input's population in that list
+    logics = []
+    keys = {}
+    slots = []
+    for sl in subsets:
+        key = (tuple(sorted(set(sl.phenotypes))),tuple(sorted(sl.scored_calls.items())))
+        if key not in keys:
+            keys[key] = len(logics)
+            logics.append(SL(phenotypes=list(key[0]),scored_calls=dict(key[1]),label='_population_'+str(len(logics))))
+        slots.append(keys[key])
+    return logics, slots
+
+def _sample_statistics(df,keys,column):
+    # mean, standard deviation and standard error of a column for each group, skipping NaN, from grouped sums
+    # the deviations are squared about the group mean so the closed form keeps its precision
+    # (groups with one or fewer values get no deviation or error)
+    grouped = df.groupby(keys)[column]
+    output = grouped.agg(['count','sum'])
+    output['mean'] = output['sum']/output['count'].where(output['count']>0)
+    deviation = (df[column]-grouped.transform('mean'))**2
+    output['squares'] = deviation.groupby([df[k] for k in keys]).sum()
+    spread = output['count']>1
+    output['stddev'] = np.sqrt((output['squares']/(output['count']-_degrees_of_freedom)).where(spread).clip(lower=0))
+    output['stderr'] = output['stddev']/np.sqrt(output['count'])
+    return output
@@ -35,8 +35,11 @@ class Cartesian(Measurement):
 
         ### Capture distances
         full = []
-        for frame_id in allcoords['frame_id'].unique():
-            fcdf = cdf.loc[cdf['frame_id']==frame_id]
+        # frames are keyed the way frame_generator groups them since a frame_id can repeat across samples or projects
+        frame_keys = ['project_id','sample_id','frame_id']
+        frame_cdfs = dict([(tuple(x.iloc[0][frame_keys]),x) for x in cdf.frame_generator(copy=False)])
+        for frame_key, coords in allcoords.groupby(frame_keys,sort=False):
+            fcdf = frame_cdfs[frame_key]
             fcdf = fcdf.dropna(subset=['phenotype_label'])
             primary = fcdf.copy()
             phenotypes = cdf.phenotypes
@@ -44,13 +47,14 @@ class Cartesian(Measurement):
             if subsets is not None:
                 phenotypes = []
                 subs = []
-                for subset_logic in subsets:
-                    sub = fcdf.subset(subset_logic,update=True)
+                masks = fcdf.subset_masks(subsets)
+                for i,subset_logic in enumerate(subsets):
+                    sub = fcdf._subset_from_mask(subset_logic,masks[:,i],update=True)
                     subs.append(sub)
                     phenotypes.append(subset_logic.label)
                 fcdf = pd.concat(subs)
             # get the frame's hex coordinates
-            coords = allcoords.loc[allcoords['frame_id']==frame_id].copy().reset_index()
+            coords = coords.copy().reset_index()
             counts = _get_proximal_points(fcdf,coords,
                                           fcdf.frame_columns,
                                           phenotypes,
@@ -1,66 +1,60 @@
 import pandas as pd
 import numpy as np
-from itertools import chain
 from pythologist.measurements import Measurement
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
 import json, sys, math
-
-def _find_one(d):
-    for k in d.keys():
-        if d[k] == 1: return k
-    return np.nan
+from scipy.stats import beta
+from pythologist.seeds import seed_sequence, region_key, stream
+from pythologist.adjacency import group_codes
 
 class Contacts(Measurement):
     @staticmethod
     def _preprocess_dataframe(cdf,*args,**kwargs):
         mergeon = ['project_id','project_name','sample_id','sample_name','frame_id','frame_name','region_label','cell_index']
-        subset = cdf.loc[~cdf['neighbors'].isna()].copy().reset_index(drop=True)
-        present = subset[mergeon].drop_duplicates()
-        def _get_items(x):
-            v = x['neighbors'].items()
-            return ([x.name]*len(v),list(x['neighbors'].keys()),list(x['neighbors'].values()))
-        data = subset.dropna(subset=['neighbors']).apply(_get_items,1) 
-        myindex = list(chain(*[x[0] for x in data]))
-        myneighbor = list(chain(*[x[1] for x in data]))
-        myshared = list(chain(*[x[2] for x in data]))
-        data = pd.DataFrame({'db_id':myindex,'neighbor_cell_index':myneighbor,'edge_shared_pixels':myshared})
-        base = subset[['project_id','project_name',
-                   'sample_id','sample_name',
-                   'frame_id','frame_name',
-                   'cell_index','region_label',
-                   ]].merge(data,left_index=True,right_on='db_id').\
-                   drop(columns='db_id')
-        temp = cdf[mergeon +['edge_length','phenotype_calls']].copy()
-        temp['phenotype_calls'] = temp['phenotype_calls'].apply(lambda x: _find_one(x))
-        temp = temp.loc[~temp['phenotype_calls'].isna()].rename(columns={'phenotype_calls':'phenotype_label'})
-        merged = temp.merge(base,on=mergeon)
-        temp2 = temp.copy().rename(columns={'phenotype_label':'neighbor_phenotype_label',
-                                            'edge_length':'neighbor_edge_length',
-                                            'cell_index':'neighbor_cell_index'})
-        merged = merged.merge(temp2,on=[x for x in mergeon if x!='cell_index'] + ['neighbor_cell_index'])
+        rows, cols, shared = cdf.adjacency().edges()
+        # both cells need a phenotype and contacts are only counted within a region
+        labels = cdf.call_matrix('phenotype_calls').first_label()
+        regions = group_codes(cdf,['region_label'])
+        keep = (~pd.isna(labels[rows]))&(~pd.isna(labels[cols]))&(regions[rows]==regions[cols])
+        rows, cols, shared = rows[keep], cols[keep], shared[keep]
+        merged = pd.DataFrame(cdf[mergeon+['edge_length']]).iloc[rows].reset_index(drop=True)
+        merged['phenotype_label'] = labels[rows]
+        merged['neighbor_cell_index'] = cdf['cell_index'].to_numpy()[cols]
+        merged['edge_shared_pixels'] = shared
+        merged['neighbor_edge_length'] = cdf['edge_length'].to_numpy()[cols]
+        merged['neighbor_phenotype_label'] = labels[cols]
         return merged
 
     def frame_counts(self):
         mergeon = self.cdf.frame_columns+['region_label']
-        mr = self.measured_regions.copy()
-        mr['_key'] = 1
-        cnts = self.groupby(mergeon+['phenotype_label','neighbor_phenotype_label']).\
-            count()[['cell_index']].rename(columns={'cell_index':'contact_count'})
-        cnts = cnts.reset_index()
-        pheno1 = pd.DataFrame({'phenotype_label':self.measured_phenotypes})
-        pheno1['_key'] = 1
-        pheno2 = pheno1.copy().rename(columns={'phenotype_label':'neighbor_phenotype_label'})
-        blank = mr.merge(pheno1,on='_key').merge(pheno2,on='_key').drop(columns='_key')
-        cnts = blank.merge(cnts,on=mergeon+['phenotype_label','neighbor_phenotype_label'],how='left').fillna(0)
-        cnts['region_area_mm2'] = cnts.apply(lambda x: 
-            (x['region_area_pixels']/1000000)*(self.microns_per_pixel*self.microns_per_pixel),1)
-        cnts['density_mm2'] = cnts.apply(lambda x: x['contact_count']/x['region_area_mm2'],1)
-        cnts['contact_count'] = cnts['contact_count'].astype(int)
-        _tot = cnts[mergeon+['phenotype_label','contact_count']].groupby(self.cdf.frame_columns+['region_label','phenotype_label']).sum().\
-            rename(columns={'contact_count':'contact_total'})
-        cnts = cnts.merge(_tot,on=self.cdf.frame_columns+['region_label','phenotype_label'])
-        cnts['fraction'] = cnts.apply(lambda x: np.nan if x['contact_total']==0 else x['contact_count']/x['contact_total'],1)
-        cnts['percent'] = cnts.apply(lambda x: np.nan if x['contact_total']==0 else 100*x['contact_count']/x['contact_total'],1)
+        mr = self.measured_regions.reset_index(drop=True)
+        phenotypes = np.array(list(self.measured_phenotypes),dtype=object)
+        n = phenotypes.shape[0]
+        # count contacts into (measured region x phenotype x neighbor phenotype) cells with one bincount
+        # frame regions are identified by their ids, the names come along from the first contact of each
+        groups = group_codes(self,['project_id','sample_id','frame_id','region_label'])
+        first = np.zeros(groups.max()+1 if groups.shape[0] > 0 else 0,dtype=np.int64)
+        first[groups[::-1]] = np.arange(groups.shape[0])[::-1]
+        keys = mr[mergeon].copy()
+        keys['_region'] = np.arange(mr.shape[0])
+        heads = pd.DataFrame(self.iloc[first][mergeon]).reset_index(drop=True)
+        found = heads.merge(keys,on=mergeon,how='left')['_region'].fillna(-1).to_numpy().astype(np.int64)
+        found[heads.isna().any(axis=1).to_numpy()] = -1
+        region = found[groups] if groups.shape[0] > 0 else groups
+        p1 = _category_codes(self['phenotype_label'],phenotypes)
+        p2 = _category_codes(self['neighbor_phenotype_label'],phenotypes)
+        keep = (region>=0)&(p1>=0)&(p2>=0)
+        counts = np.bincount((region[keep]*n+p1[keep])*n+p2[keep],minlength=mr.shape[0]*n*n)
+        cnts = mr.fillna(0).iloc[np.repeat(np.arange(mr.shape[0]),n*n)].reset_index(drop=True)
+        cnts['phenotype_label'] = np.tile(np.repeat(phenotypes,n),mr.shape[0])
+        cnts['neighbor_phenotype_label'] = np.tile(phenotypes,mr.shape[0]*n)
+        cnts['contact_count'] = counts
+        cnts['region_area_mm2'] = (cnts['region_area_pixels']/1000000)*(self.microns_per_pixel*self.microns_per_pixel)
+        cnts['density_mm2'] = cnts['contact_count']/cnts['region_area_mm2']
+        cnts['contact_total'] = np.repeat(counts.reshape(-1,n).sum(axis=1),n) if n > 0 else counts
+        with np.errstate(divide='ignore',invalid='ignore'):
+            cnts['fraction'] = np.where(cnts['contact_total']==0,np.nan,cnts['contact_count']/cnts['contact_total'])
+            cnts['percent'] = np.where(cnts['contact_total']==0,np.nan,100*cnts['contact_count']/cnts['contact_total'])
         return cnts
 
     def sample_counts(self):
@@ -68,47 +62,30 @@ class Contacts(Measurement):
         fc = self.measured_regions[self.cdf.frame_columns].\
             drop_duplicates().groupby(self.cdf.sample_columns).\
             count()[['frame_id']].rename(columns={'frame_id':'frame_count'})
-        cnts = self.frame_counts().groupby(mergeon).\
-            apply(lambda x:
-                pd.Series(dict(zip(
-                    ['cumulative_contact_count',
-                     'cumulative_region_area_pixels',
-                     'cumulative_region_area_mm2',
-                     'cumulative_density_mm2',
-                     'mean_density_mm2',
-                     'stddev_density_mm2',
-                     'stderr_density_mm2',
-                     'measured_frame_count'
-                    ],
-                    [
-                     x['contact_count'].sum(),
-                     x['region_area_pixels'].sum(),
-                     x['region_area_mm2'].sum(),
-                     x['contact_count'].sum()/x['region_area_mm2'].sum(),
-                     x['density_mm2'].mean(),
-                     x['density_mm2'].std(),
-                     x['density_mm2'].std()/np.sqrt(len(x['density_mm2'])),
-                     len(x['density_mm2'])
-                    ]
-                )))
-            ).reset_index()
-        #print(cnts)
+        cnts = self.frame_counts()
+        cnts = cnts.groupby(mergeon).agg(cumulative_contact_count=('contact_count','sum'),
+                                         cumulative_region_area_pixels=('region_area_pixels','sum'),
+                                         cumulative_region_area_mm2=('region_area_mm2','sum'),
+                                         mean_density_mm2=('density_mm2','mean'),
+                                         stddev_density_mm2=('density_mm2','std'),
+                                         measured_frame_count=('density_mm2','size')).reset_index()
+        cnts.insert(len(mergeon)+3,'cumulative_density_mm2',cnts['cumulative_contact_count']/cnts['cumulative_region_area_mm2'])
+        cnts.insert(len(mergeon)+6,'stderr_density_mm2',cnts['stddev_density_mm2']/np.sqrt(cnts['measured_frame_count']))
         cnts = cnts.merge(fc,on=self.cdf.sample_columns)
         cnts['cumulative_contact_count'] = cnts['cumulative_contact_count'].astype(int)
         cnts['measured_frame_count'] = cnts['measured_frame_count'].astype(int)
         cnts['cumulative_region_area_pixels'] = cnts['cumulative_region_area_pixels'].astype(int)
-        #return cnts[mergeon+['cumulative_contact_count']].groupby(self.cdf.sample_columns+['region_label','phenotype_label']).sum()[['cumulative_contact_count']]
-        #return cnts
-        _tot = cnts[mergeon+['cumulative_contact_count']].groupby(self.cdf.sample_columns+['region_label','phenotype_label']).sum()[['cumulative_contact_count']].\
-            rename(columns={'cumulative_contact_count':'cumulative_contact_total'}).reset_index()
-        cnts = cnts.merge(_tot,on=self.cdf.sample_columns+['region_label','phenotype_label'])
-        cnts['cumulative_fraction'] = cnts.apply(lambda x: np.nan if x['cumulative_contact_total']==0 else x['cumulative_contact_count']/x['cumulative_contact_total'],1)
-        cnts['cumulative_percent'] = cnts.apply(lambda x: np.nan if x['cumulative_contact_total']==0 else 100*x['cumulative_contact_count']/x['cumulative_contact_total'],1)
+        _tot = cnts.groupby(self.cdf.sample_columns+['region_label','phenotype_label'])['cumulative_contact_count'].transform('sum')
+        cnts['cumulative_contact_total'] = _tot
+        with np.errstate(divide='ignore',invalid='ignore'):
+            cnts['cumulative_fraction'] = np.where(_tot==0,np.nan,cnts['cumulative_contact_count']/_tot)
+            cnts['cumulative_percent'] = np.where(_tot==0,np.nan,100*cnts['cumulative_contact_count']/_tot)
         return cnts
 
     def threshold(self,phenotype,contact_label=None):
         if contact_label is None: contact_label = phenotype+'/contact'
         def _add_score(d,value,label):
+            d = d.copy()
             d[label] = int(value)
             return d
         # for the given phenotype, define whether a cell is touching or not 
@@ -124,10 +101,10 @@ class Contacts(Measurement):
         cdf.microns_per_pixel = self.microns_per_pixel
         cdf.db = self.cdf.db
         return cdf.drop(columns='_threshold')
-    def permute(self,phenotypes=None,random_state=None):
+    def permute(self,phenotypes=None,random_state=None,permutation=0):
         mergeon = ['project_name','project_id','sample_name','sample_id','frame_name','frame_id','region_label']
         phenotypes = self.cdf.phenotypes if phenotypes is None else phenotypes
-        cdf2 = self.cdf.permute_phenotype_labels(phenotype_labels = phenotypes, random_state=random_state)
+        cdf2 = self.cdf.permute_phenotype_labels(phenotypes = phenotypes, random_state=random_state, permutation=permutation)
         data = pd.DataFrame(cdf2.loc[:,mergeon+['cell_index','phenotype_label']].rename(columns={'phenotype_label':'shuffled_phenotype_label'}))
         nn2 = self.copy().merge(data,on=mergeon+['cell_index']).\
             merge(data.rename(columns={'cell_index':'neighbor_cell_index'}),on=mergeon+['neighbor_cell_index'])
@@ -143,112 +120,447 @@ class Contacts(Measurement):
         return nn2
 
 
-    def permute_frame_counts(self,n_permutations=500,phenotypes=None,random_state=None,verbose=False,n_processes=1):
-        if n_processes > 1 and random_state is None:
-            raise ValueError("must provide a random state when multiprocessing")
+    def permute_frame_counts(self,n_permutations=500,phenotypes=None,random_state=None,verbose=False,n_processes=1,
+                                    min_exceedances=None,alpha=0.05,confidence=0.99,batch_size=50):
+        """
+        Compare the contact counts of each frame region to counts after shuffling the phenotype labels within the frame region.
+
+        Args:
+            n_permutations (int): number of shuffles (default 500)
+            phenotypes (list): the phenotype labels to shuffle amongst eachother, if None shuffle all
+            random_state (int, numpy.random.SeedSequence or numpy.random.Generator): the root of the random streams,
+                permutation i of each frame region matches permute(random_state=random_state,permutation=i) (default None, fresh entropy)
+            verbose (bool): write progress to stderr
+            n_processes (int): number of processes to split the permutations across (default 1)
+            min_exceedances (int): if set, stop permuting a row early (Besag-Clifford) once this many permutations are at least as extreme as the observed count,
+                                   or once the confidence interval of its p-value is below alpha.  n_permutations is then the most that are drawn. (default None, always draw n_permutations)
+            alpha (float): significance level for stopping early (default 0.05)
+            confidence (float): confidence level of the Clopper-Pearson interval used for stopping early (default 0.99)
+            batch_size (int): the most permutations drawn at once, and between checks for stopping early (default 50)
+
+        Returns:
+            pandas.DataFrame
+        """
         if phenotypes is None: phenotypes = self.cdf.phenotypes
         if verbose: sys.stderr.write("Calculating base contacts\n")
         base = self.frame_counts()
         if verbose: sys.stderr.write("Finished base contacts\n")
-        perms = None
-        if n_processes<=1:
-            perms = pd.concat([_get_frame_perm((self,random_state,phenotypes,j,verbose)) for j in range(0,n_permutations)])
-        else: 
-            with Pool(processes=n_processes) as pool:
-                perms = pd.concat([x for x in pool.imap_unordered(_get_frame_perm,[(self,random_state,phenotypes,j,verbose) for j in range(0,n_permutations)])])
-        if verbose: sys.stderr.write("\n")
         mergeon = ['project_id','project_name','sample_id','sample_name','frame_id','frame_name','region_label']
-        _perms = perms.groupby(mergeon+['phenotype_label','neighbor_phenotype_label']).\
-            apply(lambda x: [y for y in x['contact_count']]).reset_index().\
-                rename(columns={0:'perms'})
-        _df = base.merge(_perms,on=mergeon+['phenotype_label','neighbor_phenotype_label'])
-        _df = _df.set_index(mergeon+['phenotype_label',
-                                     'neighbor_phenotype_label',
-                                     'region_area_pixels',
-                                     'region_area_mm2',
-                                     'contact_total',
-                                     'fraction',
-                                     'percent',
-                                     'density_mm2']).\
-            apply(lambda x: _analyze_perm(x['contact_count'],x['perms']),1).reset_index()
+        permuter = _ContactPermuter.from_contacts(self,phenotypes)
+        perms, n_perms = _permute_counts(permuter,base,'contact_count',mergeon,n_permutations,random_state,verbose,n_processes,
+                                         min_exceedances,alpha,confidence,batch_size)
+        if verbose: sys.stderr.write("\n")
+        _df = base[mergeon+['phenotype_label',
+                            'neighbor_phenotype_label',
+                            'region_area_pixels',
+                            'region_area_mm2',
+                            'contact_total',
+                            'fraction',
+                            'percent',
+                            'density_mm2']].reset_index(drop=True)
+        _df = pd.concat([_df,_analyze_perms(base['contact_count'].to_numpy(),perms,n_perms)],axis=1)
         #_df.loc[_df['contact_total']==0,'n_perms'] = np.nan
         _df.loc[_df['contact_total']==0,'pvalue'] = np.nan
         _df.loc[_df['contact_total']==0,'fold'] = np.nan
-        _df['perm_low_count'] = _df['perm_low_count'].astype(int)
-        _df['perm_high_count'] = _df['perm_high_count'].astype(int)
-        _df['n_perms'] = _df['n_perms'].astype(int)
+        _df.loc[_df['contact_total']==0,'zscore'] = np.nan
         return _df
 
-    def permute_sample_counts(self,n_permutations=500,phenotypes=None,random_state=None,verbose=False,n_processes=1):
-        if n_processes > 1 and random_state is None:
-            raise ValueError("must provide a random state when multiprocessing")
+    def permute_sample_counts(self,n_permutations=500,phenotypes=None,random_state=None,verbose=False,n_processes=1,
+                                     min_exceedances=None,alpha=0.05,confidence=0.99,batch_size=50):
+        """
+        Compare the cumulative contact counts of each sample region to counts after shuffling the phenotype labels within each frame region.
+
+        Args:
+            n_permutations (int): number of shuffles (default 500)
+            phenotypes (list): the phenotype labels to shuffle amongst eachother, if None shuffle all
+            random_state (int, numpy.random.SeedSequence or numpy.random.Generator): the root of the random streams,
+                permutation i of each frame region matches permute(random_state=random_state,permutation=i) (default None, fresh entropy)
+            verbose (bool): write progress to stderr
+            n_processes (int): number of processes to split the permutations across (default 1)
+            min_exceedances (int): if set, stop permuting a row early (Besag-Clifford) once this many permutations are at least as extreme as the observed count,
+                                   or once the confidence interval of its p-value is below alpha.  n_permutations is then the most that are drawn. (default None, always draw n_permutations)
+            alpha (float): significance level for stopping early (default 0.05)
+            confidence (float): confidence level of the Clopper-Pearson interval used for stopping early (default 0.99)
+            batch_size (int): the most permutations drawn at once, and between checks for stopping early (default 50)
+
+        Returns:
+            pandas.DataFrame
+        """
         if phenotypes is None: phenotypes = self.cdf.phenotypes
         if verbose: sys.stderr.write("Calculating base contacts\n")
         base = self.sample_counts()
         if verbose: sys.stderr.write("Finished base contacts\n")
-        perms = None
-        if n_processes<=1:
-            perms = pd.concat([_get_sample_perm((self,random_state,phenotypes,j,verbose)) for j in range(0,n_permutations)])
-        else: 
-            with Pool(processes=n_processes) as pool:
-                perms = pd.concat([x for x in pool.imap_unordered(_get_sample_perm,[(self,random_state,phenotypes,j,verbose) for j in range(0,n_permutations)])])
         mergeon = ['project_id','project_name','sample_id','sample_name','region_label']
-        #print(perms.groupby(mergeon+['phenotype_label','neighbor_phenotype_label']).first().columns)
-        _perms = perms.groupby(mergeon+['phenotype_label','neighbor_phenotype_label']).\
-            apply(lambda x: [y for y in x['cumulative_contact_count']]).reset_index().\
-                rename(columns={0:'perms'})
-        _df = base.merge(_perms,on=mergeon+['phenotype_label','neighbor_phenotype_label'])
-        _df = _df.set_index(mergeon+['phenotype_label',
-                                     'neighbor_phenotype_label',
-                                     'cumulative_region_area_pixels',
-                                     'cumulative_region_area_mm2',
-                                     'cumulative_contact_total',
-                                     'cumulative_density_mm2',
-                                     'mean_density_mm2',
-                                     'stddev_density_mm2',
-                                     'stderr_density_mm2',
-                                     'measured_frame_count',
-                                     'frame_count',
-                                     'cumulative_fraction',
-                                     'cumulative_percent']).\
-            apply(lambda x: _analyze_perm(x['cumulative_contact_count'],x['perms']),1).reset_index()
+        permuter = _ContactPermuter.from_contacts(self,phenotypes)
+        # a sample's counts are the sums over its frames
+        perms, n_perms = _permute_counts(permuter,base,'cumulative_contact_count',mergeon,n_permutations,random_state,verbose,n_processes,
+                                         min_exceedances,alpha,confidence,batch_size)
+        if verbose: sys.stderr.write("\n")
+        _df = base[mergeon+['phenotype_label',
+                            'neighbor_phenotype_label',
+                            'cumulative_region_area_pixels',
+                            'cumulative_region_area_mm2',
+                            'cumulative_contact_total',
+                            'cumulative_density_mm2',
+                            'mean_density_mm2',
+                            'stddev_density_mm2',
+                            'stderr_density_mm2',
+                            'measured_frame_count',
+                            'frame_count',
+                            'cumulative_fraction',
+                            'cumulative_percent']].reset_index(drop=True)
+        _df = pd.concat([_df,_analyze_perms(base['cumulative_contact_count'].to_numpy(),perms,n_perms)],axis=1)
         #_df.loc[_df['cumulative_contact_total']==0,'n_perms'] = np.nan
         _df.loc[_df['cumulative_contact_total']==0,'pvalue'] = np.nan
         _df.loc[_df['cumulative_contact_total']==0,'fold'] = np.nan
-        _df['perm_low_count'] = _df['perm_low_count'].astype(int)
-        _df['perm_high_count'] = _df['perm_high_count'].astype(int)
-        _df['n_perms'] = _df['n_perms'].astype(int)
+        _df.loc[_df['cumulative_contact_total']==0,'zscore'] = np.nan
         _df = _df.rename(columns={'contact_count':'cumulative_contact_count'})
-        _df['cumulative_contact_count'] = _df['cumulative_contact_count'].astype(int)
         return _df
 
+class _ContactPermuter(object):
+    """
+    The contacts and phenotype labels of a Contacts measurement encoded as integer arrays,
+    so shuffled contact counts can be drawn without building new CellDataFrames.
+
+    Cells are the rows of the CellDataFrame.  Labels of the cells whose phenotype is being shuffled
+    are permuted within each frame region, and the contacts of every frame region are counted
+    for each pair of phenotypes with one bincount.
+
+    Params:
+        arrays (dict): the integer arrays named in _ContactPermuter.arrays.  members and the contacts are in blocks by frame region
+                       with member_offsets and edge_offsets giving where each frame region's block starts
+        phenotypes (list): the phenotype label of each phenotype code
+        n_groups (int): number of frame regions
+        keys (pandas.DataFrame): the frame region columns of each frame region (optional)
+    """
+    arrays = ['labels','members','member_groups','member_offsets','cells','neighbors','edge_groups','edge_offsets','group_keys']
+    def __init__(self,arrays,phenotypes,n_groups,keys=None):
+        for name in self.arrays: setattr(self,name,arrays[name])
+        self.phenotypes = phenotypes
+        self.n_groups = n_groups
+        self.keys = keys
+
+    @classmethod
+    def from_contacts(cls,contacts,phenotypes):
+        """
+        Args:
+            contacts (Contacts): the contacts to permute
+            phenotypes (list): the phenotype labels to shuffle amongst eachother
+
+        Returns:
+            _ContactPermuter
+        """
+        cdf = contacts.cdf
+        if len(set(phenotypes)-set(cdf.phenotypes))>0:
+            raise ValueError("Phenotypes must be defined.")
+        frame_region = ['project_id','project_name','sample_id','sample_name','frame_id','frame_name','region_label']
+        labels = cdf['phenotype_label'].to_numpy(dtype=object)
+        plabs = sorted(list(set(labels[~pd.isna(labels)])))
+        codes = np.full(labels.shape[0],-1,dtype=np.int64)
+        if len(plabs) > 0:
+            codes[~pd.isna(labels)] = np.searchsorted(np.array(plabs,dtype=object),labels[~pd.isna(labels)])
+        groups = group_codes(cdf,frame_region)
+        keys = pd.DataFrame(cdf[frame_region]).iloc[np.unique(groups,return_index=True)[1]].reset_index(drop=True)
+        # the cells to shuffle, in blocks by frame region
+        members = np.flatnonzero(pd.Series(labels).isin(phenotypes).to_numpy())
+        members = members[np.argsort(groups[members],kind='stable')]
+        # each contact as the row positions of the cell and its neighbor
+        pos = pd.DataFrame(cdf[cdf.frame_columns+['cell_index']]).reset_index(drop=True)
+        pos['_pos'] = np.arange(pos.shape[0])
+        edges = pd.DataFrame(contacts[cdf.frame_columns+['cell_index','neighbor_cell_index']]).reset_index(drop=True)
+        cells = edges.merge(pos,on=cdf.frame_columns+['cell_index'],how='left')['_pos'].to_numpy()
+        neighbors = edges.merge(pos.rename(columns={'cell_index':'neighbor_cell_index'}),
+                                on=cdf.frame_columns+['neighbor_cell_index'],how='left')['_pos'].to_numpy()
+        found = (~pd.isna(cells))&(~pd.isna(neighbors))
+        cells = cells[found].astype(np.int64)
+        neighbors = neighbors[found].astype(np.int64)
+        order = np.argsort(groups[cells],kind='stable')
+        cells, neighbors = cells[order], neighbors[order]
+        arrays = {'labels':codes,
+                  'members':members,
+                  'member_groups':groups[members],
+                  'member_offsets':_offsets(groups[members],keys.shape[0]),
+                  'cells':cells,
+                  'neighbors':neighbors,
+                  'edge_groups':groups[cells],
+                  'edge_offsets':_offsets(groups[cells],keys.shape[0]),
+                  'group_keys':np.array([region_key(x) for x in keys[['project_id','sample_id','frame_id','region_label']].to_numpy(dtype=object)],dtype=np.uint32).reshape(-1,4)}
+        return cls(arrays,plabs,keys.shape[0],keys)
+
+    def share(self):
+        """
+        Copy the arrays into shared memory so worker processes can use them without pickling.
+        The caller must close and unlink the blocks when the workers are finished.
+
+        Returns:
+            dict, list: the description to pass to _attach_permuter, and the SharedMemory blocks
+        """
+        spec = {'phenotypes':self.phenotypes,'n_groups':self.n_groups,'arrays':{}}
+        blocks = []
+        for name in self.arrays:
+            array = getattr(self,name)
+            block, shared = _shared_array(array.shape,array.dtype)
+            shared[:] = array
+            spec['arrays'][name] = (block.name,array.shape,array.dtype.str)
+            blocks.append(block)
+        return spec, blocks
+
+    def permuted_labels(self,seeds,permutation,groups=None):
+        """
+        Shuffle the labels within each frame region, with the same streams as CellDataFrame.permute_phenotype_labels.
+
+        Args:
+            seeds (numpy.random.SeedSequence): the root of the random streams
+            permutation (int): the permutation index
+            groups (numpy.array): the frame regions to shuffle (default all)
+
+        Returns:
+            numpy.array: phenotype code of every cell after shuffling within frame regions
+        """
+        labels = self.labels.copy()
+        for g in (range(self.n_groups) if groups is None else groups.tolist()):
+            start, stop = int(self.member_offsets[g]), int(self.member_offsets[g+1])
+            if stop-start < 2: continue
+            members = self.members[start:stop]
+            rng = stream(seeds,permutation,self.group_keys[g])
+            labels[members] = self.labels[members[rng.permutation(stop-start)]]
+        return labels
+
+    def counts(self,labels,groups=None):
+        """
+        Args:
+            labels (numpy.array): phenotype code of every cell
+            groups (numpy.array): the frame regions to count (default all)
+
+        Returns:
+            numpy.array: (frame regions x phenotypes x phenotypes) contact counts, zero for frame regions that were not counted
+        """
+        n = len(self.phenotypes)
+        cells, neighbors, edge_groups = self.cells, self.neighbors, self.edge_groups
+        if groups is not None:
+            selected = _ranges(self.edge_offsets,groups)
+            cells, neighbors, edge_groups = cells[selected], neighbors[selected], edge_groups[selected]
+        code = (edge_groups*n+labels[cells])*n+labels[neighbors]
+        return np.bincount(code,minlength=self.n_groups*n*n).reshape(self.n_groups,n,n).astype(np.int32)
+
+    def units(self,columns):
+        """
+        Args:
+            columns (list): columns that identify a unit of frame regions (i.e. the sample columns and region_label)
+
+        Returns:
+            pandas.DataFrame, numpy.array: the columns for each unit, and the unit of each frame region
+        """
+        codes = group_codes(self.keys,columns)
+        keys = self.keys[columns].iloc[np.unique(codes,return_index=True)[1]].reset_index(drop=True)
+        return keys, codes
+
+    def index(self,df,columns,keys):
+        """
+        Args:
+            df (pandas.DataFrame): rows with the columns, phenotype_label and neighbor_phenotype_label
+            columns (list): columns that identify a unit
+            keys (pandas.DataFrame): the columns for each unit
+
+        Returns:
+            numpy.array, numpy.array, numpy.array: the unit, phenotype and neighbor phenotype of each row of df.
+                                                  Units and phenotypes without cells are given the next code after the last.
+        """
+        n = len(self.phenotypes)
+        keys = keys.copy()
+        keys['_unit'] = np.arange(keys.shape[0])
+        units = pd.DataFrame(df[columns]).reset_index(drop=True).merge(keys,on=columns,how='left')['_unit']
+        units = units.fillna(keys.shape[0]).to_numpy().astype(np.int64)
+        lookup = dict(zip(self.phenotypes,range(n)))
+        p1 = np.array([lookup.get(x,n) for x in df['phenotype_label']],dtype=np.int64)
+        p2 = np.array([lookup.get(x,n) for x in df['neighbor_phenotype_label']],dtype=np.int64)
+        return units, p1, p2
+
+class _PermutationWorkers(object):
+    """
+    Draws batches of permuted counts, in this process or in a pool of workers.
+
+    Each permutation's counts are reduced to the requested rows as soon as they are drawn (see _reduce_counts),
+    so a batch only holds (permutations x rows) counts.
+    With more than one process the encoded contacts are staged in shared memory once and a Pool initializer
+    maps them in each worker.  Counts are written into a shared output, so tasks only carry the
+    output position, the permutation indices, the root seed sequence and the frame regions to permute.
+
+    Params:
+        permuter (_ContactPermuter): the encoded contacts
+        reduction (dict): the order, starts, rows, p1 and p2 arrays for _reduce_counts
+        n_processes (int): number of processes
+        batch_size (int): the most permutations drawn in one batch
+        verbose (bool): write progress to stderr
+    """
+    def __init__(self,permuter,reduction,n_processes,batch_size,verbose):
+        self.permuter = permuter
+        self.reduction = reduction
+        self.n_processes = n_processes
+        self.verbose = verbose
+        self.shape = (batch_size,reduction['rows'].shape[0])
+        self.blocks = []
+        self.pool = None
+    def __enter__(self):
+        if self.n_processes <= 1:
+            self.output = np.zeros(self.shape,dtype=np.int32)
+            return self
+        spec, self.blocks = self.permuter.share()
+        for name, array in self.reduction.items():
+            block, shared = _shared_array(array.shape,array.dtype)
+            shared[:] = array
+            spec['arrays']['reduce_'+name] = (block.name,array.shape,array.dtype.str)
+            self.blocks.append(block)
+        block, self.output = _shared_array(self.shape,np.int32)
+        self.blocks.append(block)
+        spec['arrays']['output'] = (block.name,self.shape,self.output.dtype.str)
+        self.pool = Pool(processes=self.n_processes,initializer=_attach_permuter,initargs=(spec,))
+        return self
+    def __exit__(self,*args):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.output = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+    def run(self,start,size,seeds,groups=None):
+        """
+        Args:
+            start (int): index of the first permutation
+            size (int): number of permutations
+            seeds (numpy.random.SeedSequence): the root of the random streams
+            groups (numpy.array): the frame regions to permute (default all)
+
+        Returns:
+            numpy.array: (permutations x rows) counts
+        """
+        if self.pool is None:
+            _fill_perms(self.permuter,self.reduction,self.output,0,start,size,seeds,groups,self.verbose)
+        else:
+            chunks = [x for x in np.array_split(np.arange(size),4*self.n_processes) if x.shape[0]>0]
+            tasks = [(int(x[0]),start+int(x[0]),x.shape[0],seeds,groups,self.verbose) for x in chunks]
+            for _ in self.pool.imap_unordered(_get_perms,tasks): pass
+        return self.output[:size].copy()
+
+def _permute_counts(permuter,df,count_column,columns,n_permutations,random_state,verbose,n_processes,
+                    min_exceedances=None,alpha=0.05,confidence=0.99,batch_size=50):
+    # The (rows x permutations) permuted counts for each row of df and the number of permutations each row uses,
+    # permutation i of each frame region drawn from its own stream of random_state.
+    # Rows are counts of a unit of frame regions (given by columns) for a pair of phenotypes.
+    # Permutations are drawn in batches of at most batch_size.  Unless min_exceedances is set every row gets n_permutations.
+    # Otherwise batches are only drawn for units that still have an unsettled row, and each row keeps the permutations
+    # drawn up to when it settled.
+    seeds = seed_sequence(random_state)
+    keys, units = permuter.units(columns)
+    rows, p1, p2 = permuter.index(df,columns,keys)
+    observed = df[count_column].to_numpy()
+    reduction = {'order':np.argsort(units,kind='stable'),
+                 'starts':_offsets(units,keys.shape[0])[:-1],
+                 'rows':rows,'p1':p1,'p2':p2}
+    batch_size = max(1,min(batch_size,n_permutations))
+    # grown as batches arrive so stopping early also saves the memory of the permutations never drawn
+    totals = np.zeros((batch_size,rows.shape[0]),dtype=np.int32)
+    done = np.zeros(observed.shape[0],dtype=bool)
+    n_perms = np.full(observed.shape[0],n_permutations,dtype=np.int64)
+    drawn = 0
+    with _PermutationWorkers(permuter,reduction,n_processes,batch_size,verbose) as workers:
+        while drawn < n_permutations and not done.all():
+            size = min(batch_size,n_permutations-drawn)
+            if drawn+size > totals.shape[0]:
+                grown = np.zeros((min(n_permutations,max(2*totals.shape[0],drawn+size)),rows.shape[0]),dtype=np.int32)
+                grown[:drawn] = totals[:drawn]
+                totals = grown
+            active = np.zeros(keys.shape[0]+1,dtype=bool)
+            active[rows[~done]] = True
+            groups = np.flatnonzero(active[units])
+            totals[drawn:drawn+size] = workers.run(drawn,size,seeds,None if groups.shape[0]==permuter.n_groups else groups)
+            drawn += size
+            if min_exceedances is None: continue
+            values = totals[:drawn]
+            tail = np.minimum((values<=observed).sum(axis=0),(values>=observed).sum(axis=0))
+            settled = (~done)&((tail>=min_exceedances)|(_upper_bound(tail,drawn,confidence)<alpha))
+            n_perms[settled] = drawn
+            done |= settled
+    n_perms[~done] = drawn
+    return totals[:drawn].T, n_perms
+def _upper_bound(k,n,confidence):
+    # upper limit of the Clopper-Pearson interval for k successes in n trials
+    upper = beta.ppf(1-(1-confidence)/2,k+1,np.maximum(n-k,1))
+    return np.where(k>=n,1.0,upper)
+def _offsets(codes,n):
+    # where each code's block starts in codes sorted by code, plus the end
+    return np.concatenate([[0],np.cumsum(np.bincount(codes,minlength=n))]).astype(np.int64)
+def _ranges(offsets,groups):
+    # positions of the blocks of the given groups
+    starts = offsets[groups]
+    lengths = offsets[groups+1]-starts
+    shift = np.repeat(starts-np.concatenate([[0],np.cumsum(lengths)[:-1]]),lengths)
+    return np.arange(lengths.sum())+shift
+def _shared_array(shape,dtype):
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True,size=max(1,int(np.prod(shape))*dtype.itemsize))
+    return block, np.ndarray(shape,dtype=dtype,buffer=block.buf)
+def _reduce_counts(counts,reduction):
+    # sum the (frame regions x phenotypes x phenotypes) counts of each unit and pick out the count of each row,
+    # rows for a unit or phenotype without contacts point at the zero padding
+    n = counts.shape[1]
+    n_units = reduction['starts'].shape[0]
+    totals = np.zeros((n_units+1,n+1,n+1),dtype=np.int32)
+    if n_units > 0: totals[:n_units,:n,:n] = np.add.reduceat(counts[reduction['order']],reduction['starts'],axis=0)
+    return totals[reduction['rows'],reduction['p1'],reduction['p2']]
+def _fill_perms(permuter,reduction,perms,position,start,size,seeds,groups,verbose):
+    for i in range(size):
+        perms[position+i] = _reduce_counts(permuter.counts(permuter.permuted_labels(seeds,start+i,groups),groups),reduction)
+        if verbose: sys.stderr.write("Finished perm "+str(start+i)+"\r")
+_shared = {}
+def _attach_permuter(spec):
+    # Pool initializer: map the shared arrays and keep the blocks open for the life of the worker
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec['arrays'].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared.setdefault('blocks',[]).append(block)
+        arrays[name] = np.ndarray(shape,dtype=np.dtype(dtype),buffer=block.buf)
+    _shared['permuter'] = _ContactPermuter(arrays,spec['phenotypes'],spec['n_groups'])
+    _shared['reduction'] = {name[len('reduce_'):]:array for name, array in arrays.items() if name.startswith('reduce_')}
+    _shared['output'] = arrays['output']
+def _get_perms(myvars):
+    position, start, size, seeds, groups, verbose = myvars
+    _fill_perms(_shared['permuter'],_shared['reduction'],_shared['output'],position,start,size,seeds,groups,verbose)
+def _analyze_perms(counts,perms,n_perms):
+    """
+    Summarize the permutations of every row at once.
+
+    Args:
+        counts (numpy.array): the observed count of each row
+        perms (numpy.array): (rows x permutations) permuted counts
+        n_perms (numpy.array): the number of permutations each row uses (its first n_perms columns)
 
-def _get_frame_perm(myvars):
-    contacts, random_state, phenotypes, i, verbose = myvars
-    perm = contacts.permute(
-        phenotypes= phenotypes,
-        random_state = None if random_state is None else random_state+i
-    ).frame_counts()
-    perm['perm'] = i
-    if verbose: sys.stderr.write("Finished perm "+str(i)+"\r")
-    return perm
-def _get_sample_perm(myvars):
-    contacts, random_state, phenotypes, i, verbose = myvars
-    perm = contacts.permute(
-        phenotypes=phenotypes,
-        random_state = None if random_state is None else random_state+i
-    ).sample_counts()
-    perm['perm'] = i
-    if verbose: sys.stderr.write("Finished perm "+str(i)+"\r")
-    return perm
-def _analyze_perm(count,perms):
-    perm_low_count = len([x for x in perms if x <= count])
-    low_break = perm_low_count/len(perms)
-    perm_high_count = len([x for x in perms if x >= count])
-    high_break = perm_high_count/len(perms)
-    mean = np.mean(perms)
-    fold = math.log(count+1,2)-math.log(mean+1,2)
-    return pd.Series(dict(zip(
-        ['contact_count','n_perms','perm_low_count','perm_high_count','pvalue','fold'],
-        (count,len(perms),perm_low_count,perm_high_count,min(low_break,high_break),fold)
-    )))
+    Returns:
+        pandas.DataFrame: contact_count, n_perms, perm_low_count, perm_high_count, pvalue, fold,
+                          and the mean, stddev and zscore of the count against the permutations
+    """
+    counts = np.asarray(counts)
+    used = np.arange(perms.shape[1])[None,:]<n_perms[:,None]
+    low = (used&(perms<=counts[:,None])).sum(axis=1)
+    high = (used&(perms>=counts[:,None])).sum(axis=1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mean = np.where(used,perms,0).sum(axis=1)/n_perms
+        stddev = np.sqrt((np.where(used,perms-mean[:,None],0)**2).sum(axis=1)/(n_perms-1))
+        stddev[n_perms<2] = np.nan
+        zscore = np.where(stddev>0,(counts-mean)/stddev,np.nan)
+        pvalue = np.minimum(low,high)/n_perms
+    return pd.DataFrame({'contact_count':counts,
+                         'n_perms':n_perms.astype(int),
+                         'perm_low_count':low.astype(int),
+                         'perm_high_count':high.astype(int),
+                         'pvalue':pvalue,
+                         'fold':np.log2(counts+1)-np.log2(mean+1),
+                         'perm_mean':mean,
+                         'perm_stddev':stddev,
+                         'zscore':zscore})
+def _category_codes(values,categories):
+    # position of each value in categories, -1 if it is not one of them
+    codes, uniques = pd.factorize(values)
+    lookup = np.append(pd.Categorical(uniques,categories=categories).codes.astype(np.int64),-1)
+    return lookup[codes]
@@ -3,42 +3,99 @@ import sys, json
 from pythologist.measurements import Measurement
 import numpy as np
 from sklearn.neighbors import KDTree
+from multiprocessing import Pool
+from pythologist.adjacency import group_codes
 
-def _clean_neighbors(left,right,k_neighbors):
-    def _get_coords(cell_index,x,y):
-        return pd.Series(dict(zip(
-            ['cell_index','neighbor_cell_coord'],
-            [cell_index,(x,y)]
-        )))
-    rcoords = right.apply(lambda x: 
-         _get_coords(x['cell_index'],x['x'],x['y'])
-    ,1).reset_index(drop=True)
-    lcoords = left.apply(lambda x: 
-        _get_coords(x['cell_index'],x['x'],x['y'])
-    ,1).reset_index(drop=True)
-    kdt = KDTree(rcoords['neighbor_cell_coord'].tolist(), leaf_size=40, metric='minkowski')
-    dists, idxs = kdt.query(lcoords['neighbor_cell_coord'].tolist(),min(right.shape[0],k_neighbors+1))
-    dists = pd.DataFrame(dists,index = lcoords['cell_index']).stack().reset_index().\
-        rename(columns = {'level_1':'_neighbor_rank',0:'neighbor_distance_px'})
-    idxs = pd.DataFrame(idxs,index = lcoords['cell_index']).stack().reset_index().\
-        rename(columns = {'level_1':'_neighbor_rank',0:'neighbor_dbid'})
-    dists = dists.merge(idxs,on=['_neighbor_rank','cell_index']).\
-        merge(rcoords.rename(columns={'cell_index':'neighbor_cell_index'}),left_on='neighbor_dbid',right_index=True)
-    dists = dists.loc[dists['cell_index']!=dists['neighbor_cell_index'],:].\
-        sort_values(['cell_index','_neighbor_rank']).\
-        reset_index(drop=True).drop(columns=['neighbor_dbid'])
-    if dists.shape[0] == 0: return None
-    _rank_code = dists.groupby('cell_index').\
-        apply(lambda x:
-          pd.Series(dict(zip(
-              range(0,len(x['_neighbor_rank'])),
-              x['_neighbor_rank']
-          )))
-         ).stack().reset_index().\
-        rename(columns={'level_1':'neighbor_rank',0:'_neighbor_rank'})
-    dists = dists.merge(_rank_code,on=['cell_index','_neighbor_rank']).drop(columns=['_neighbor_rank'])
-    dists = dists.loc[dists['neighbor_rank']<k_neighbors,:] # make sure we are limited to our number
-    return dists
+def _region_neighbors(labels,coords,cell_index,k_neighbors):
+    """
+    Find the k nearest neighbors of each phenotype for every cell of a frame region.
+
+    One KDTree is built for each phenotype and is queried with every cell of the region at once.
+
+    Args:
+        labels (numpy.array): phenotype_label of each cell
+        coords (numpy.array): (cells x 2) array of x,y coordinates
+        cell_index (numpy.array): cell_index of each cell
+        k_neighbors (int): number of neighbors of each phenotype to keep
+
+    Returns:
+        dict: arrays (one entry per neighbor) of 'cell' and 'neighbor' (positions in the region), 'neighbor_phenotype_label',
+              'neighbor_distance_px', 'neighbor_rank' and 'overall_rank', ordered by phenotype, neighbor phenotype, cell and rank
+    """
+    plabs = sorted(list(set(labels)))
+    pcodes = np.searchsorted(np.array(plabs,dtype=object),labels) if len(plabs) > 0 else np.zeros(0,dtype=np.int64)
+    n = labels.shape[0]
+    # each cell can have at most k_neighbors of each phenotype
+    size = n*len(plabs)*k_neighbors
+    cell = np.empty(size,dtype=np.int64)
+    neighbor = np.empty(size,dtype=np.int64)
+    neighbor_code = np.empty(size,dtype=np.int64)
+    distance = np.empty(size,dtype=np.float64)
+    rank = np.empty(size,dtype=np.int64)
+    filled = 0
+    for j in range(len(plabs)):
+        members = np.flatnonzero(pcodes==j)
+        kdt = KDTree(coords[members], leaf_size=40, metric='minkowski')
+        dists, idxs = kdt.query(coords,min(members.shape[0],k_neighbors+1))
+        idxs = members[idxs]
+        # a cell is not its own neighbor, and ranks count the neighbors that remain
+        keep = cell_index[idxs]!=cell_index[:,None]
+        ranks = np.cumsum(keep,axis=1)-1
+        keep &= ranks<k_neighbors
+        rows, cols = np.nonzero(keep)
+        m = rows.shape[0]
+        cell[filled:filled+m] = rows
+        neighbor[filled:filled+m] = idxs[rows,cols]
+        neighbor_code[filled:filled+m] = j
+        distance[filled:filled+m] = dists[rows,cols]
+        rank[filled:filled+m] = ranks[rows,cols]
+        filled += m
+    cell, neighbor, neighbor_code, distance, rank = [x[:filled] for x in [cell,neighbor,neighbor_code,distance,rank]]
+    order = np.lexsort((rank,cell,neighbor_code,pcodes[cell]))
+    cell, neighbor, neighbor_code, distance, rank = [x[order] for x in [cell,neighbor,neighbor_code,distance,rank]]
+    # overall rank is the order by distance among all of a cell's neighbors, ties kept in the order above
+    by_distance = np.lexsort((np.arange(filled),distance,cell))
+    starts = np.searchsorted(cell[by_distance],cell[by_distance],side='left')
+    overall_rank = np.empty(filled,dtype=np.int64)
+    overall_rank[by_distance] = np.arange(filled)-starts
+    return {'cell':cell,
+            'neighbor':neighbor,
+            'neighbor_phenotype_label':np.array(plabs,dtype=object)[neighbor_code] if filled > 0 else np.zeros(0,dtype=object),
+            'neighbor_distance_px':distance,
+            'neighbor_rank':rank,
+            'overall_rank':overall_rank}
+
+def _region_proximity(pcodes,coords,n_phenotypes,radius_px):
+    """
+    Count the cells of each phenotype closer than a radius to every cell of a frame region.
+
+    One KDTree is built for each phenotype and is queried with every cell of the region at once.
+
+    Args:
+        pcodes (numpy.array): phenotype code of each cell (0 to n_phenotypes-1)
+        coords (numpy.array): (cells x 2) array of x,y coordinates
+        n_phenotypes (int): number of phenotype codes
+        radius_px (float): the radius in pixels
+
+    Returns:
+        numpy.array: (cells x phenotypes) counts of the other cells within the radius
+    """
+    counts = np.zeros((pcodes.shape[0],n_phenotypes),dtype=np.int64)
+    if radius_px <= 0: return counts
+    # query_radius includes cells at exactly the radius, but proximity is strictly closer
+    r = np.nextafter(radius_px,-np.inf)
+    for j in range(n_phenotypes):
+        members = np.flatnonzero(pcodes==j)
+        if members.shape[0] == 0: continue
+        kdt = KDTree(coords[members], leaf_size=40, metric='minkowski')
+        counts[:,j] = kdt.query_radius(coords,r,count_only=True)
+        # a cell is not its own neighbor
+        counts[members,j] -= 1
+    return counts
+
+def _region_neighbors_task(task):
+    labels, coords, cell_index, k_neighbors = task
+    return _region_neighbors(labels,coords,cell_index,k_neighbors)
 
 class NearestNeighbors(Measurement):
     def to_hdf(self,path):
@@ -76,8 +133,11 @@ class NearestNeighbors(Measurement):
         if 'per_phenotype_neighbors' not in kwargs: raise ValueError('per_phenotype_neighbors must be defined')
         if 'max_neighbors' not in kwargs: raise ValueError('max_neighbors must be defined')
         k_neighbors = kwargs['per_phenotype_neighbors']
-        nn = None
-        for rdf in cdf.frame_region_generator():
+        n_processes = kwargs.get('n_processes',1)
+        columns = ['project_id','project_name','sample_name','sample_id','frame_name','frame_id','region_label','phenotype_label','cell_index']
+        blocks = []
+        tasks = []
+        for rdf in cdf.frame_region_generator(copy=False):
             if kwargs['verbose'] and rdf.shape[0]>0:
                 row = rdf.iloc[0]
                 sys.stderr.write("Extracting NN from "+str((row['project_id'],
@@ -89,50 +149,32 @@ class NearestNeighbors(Measurement):
                                                                     row['region_label']
                             ))+"\n")
             rdf = rdf.loc[~rdf['phenotype_label'].isna(),:]
-            plabs = sorted(list(rdf['phenotype_label'].unique()))
-            for phenotype_label1 in plabs:
-                #if kwargs['verbose']: sys.stderr.write("  "+str(phenotype_label1)+" vs "+str(rdf['phenotype_label'].unique().shape[0])+"\n")
-                for phenotype_label2 in plabs:
-                    left = rdf.loc[rdf['phenotype_label']==phenotype_label1,:]
-                    right= rdf.loc[rdf['phenotype_label']==phenotype_label2,:]
-                    if left.shape[0]==0 or right.shape[0]==0: 
-                        continue
-                    dists = _clean_neighbors(left,right,k_neighbors)
-                    if dists is None: 
-                        continue
-                    _df = pd.DataFrame(left[['project_id','project_name','sample_name','sample_id','frame_name','frame_id','region_label','phenotype_label','cell_index']])
-                    _df['neighbor_phenotype_label'] = phenotype_label2
-                    _df = _df.merge(dists,on='cell_index')
-                    if nn is not None: 
-                        nn = pd.concat([nn,_df.copy()])
-                    else: 
-                        nn = _df.copy()
-                    if kwargs['verbose']:
-                        sys.stderr.write("  "+phenotype_label1+" vs "+phenotype_label2+" "+str(_df.shape[0])+"\n")
-            if kwargs['verbose']: sys.stderr.write("nn size is: "+str(nn.shape)+"\n")
+            blocks.append(pd.DataFrame(rdf[columns+['x','y']]))
+            # workers only get the arrays they need
+            tasks.append((rdf['phenotype_label'].to_numpy(),
+                          np.column_stack([rdf['x'].to_numpy(),rdf['y'].to_numpy()]).astype(float),
+                          rdf['cell_index'].to_numpy(),
+                          k_neighbors))
+        if n_processes <= 1:
+            found = [_region_neighbors_task(x) for x in tasks]
+        else:
+            with Pool(processes=n_processes) as pool:
+                found = [x for x in pool.imap(_region_neighbors_task,tasks,chunksize=max(1,len(tasks)//(4*n_processes)))]
+        nn = []
+        for block, f in zip(blocks,found):
+            x = block['x'].to_numpy()
+            y = block['y'].to_numpy()
+            cell_index = block['cell_index'].to_numpy()
+            _df = block[columns].iloc[f['cell']].reset_index(drop=True)
+            _df['neighbor_phenotype_label'] = f['neighbor_phenotype_label']
+            _df['neighbor_distance_px'] = f['neighbor_distance_px']
+            _df['neighbor_cell_index'] = cell_index[f['neighbor']]
+            _df['neighbor_cell_coord'] = list(zip(x[f['neighbor']].tolist(),y[f['neighbor']].tolist()))
+            _df['neighbor_rank'] = f['neighbor_rank']
+            _df['overall_rank'] = f['overall_rank']
+            nn.append(_df)
         if kwargs['verbose']: sys.stderr.write("finished concatonating nn blocks\n")
-        nn.reset_index(drop=True,inplace=True)
-        #nn = pd.concat(nn).reset_index(drop=True)
-        # add on the total rank
-        def _add_index(x):
-            df = pd.DataFrame({
-              'overall_rank':range(0,len(x['neighbor_distance_px'])),
-              'neighbor_distance_px':x['neighbor_distance_px'],
-              'neighbor_cell_index':x['neighbor_cell_index']
-            })
-            df['project_id'] = x.name[0]
-            df['sample_id'] = x.name[1]
-            df['frame_id'] = x.name[2]
-            df['region_label'] = x.name[3]
-            df['cell_index'] = x.name[4]
-            return df
-        _rnks = nn.sort_values(['project_id','sample_id','frame_id','region_label','cell_index','neighbor_distance_px']).\
-            reset_index(drop=True).\
-            groupby(['project_id','sample_id','frame_id','region_label','cell_index'],group_keys=False).\
-            apply(lambda x: 
-                _add_index(x)
-                ).drop(columns='neighbor_distance_px')
-        nn = nn.merge(_rnks,on=['project_id','sample_id','frame_id','region_label','cell_index','neighbor_cell_index'])
+        nn = pd.concat(nn).reset_index(drop=True)
         nn['per_phenotype_neighbors'] = k_neighbors
         if kwargs['max_neighbors'] is not None:
             return nn.loc[nn['overall_rank']<kwargs['max_neighbors'],:].reset_index(drop=True)
@@ -237,15 +279,91 @@ class NearestNeighbors(Measurement):
         data.loc[data['measured_frame_count'].isna(),'measured_frame_count'] = 0
         return data
 
-    def frame_proximity(self,threshold_um,phenotype):
+    def _proximity(self,radius_pixels):
+        # Radius counts for every cell of the CellDataFrame in row order.
+        # Returns the phenotype labels, which cells have a phenotype, and (cells x phenotypes) arrays of
+        # the cells closer than the radius (near) and the rest of that phenotype's cells in the frame region (far)
+        cdf = self.cdf
+        labels = cdf['phenotype_label'].to_numpy(dtype=object)
+        measured = ~pd.isna(labels)
+        plabs = sorted(list(set(labels[measured])))
+        pcodes = np.full(labels.shape[0],-1,dtype=np.int64)
+        if len(plabs) > 0: pcodes[measured] = np.searchsorted(np.array(plabs,dtype=object),labels[measured])
+        coords = np.column_stack([cdf['x'].to_numpy(),cdf['y'].to_numpy()]).astype(float)
+        near = np.zeros((labels.shape[0],len(plabs)),dtype=np.int64)
+        far = np.zeros((labels.shape[0],len(plabs)),dtype=np.int64)
+        codes = group_codes(cdf,['project_id','sample_id','frame_id','region_label'])
+        rows = np.flatnonzero(measured)
+        rows = rows[np.argsort(codes[rows],kind='stable')]
+        for members in np.split(rows,np.flatnonzero(np.diff(codes[rows]))+1):
+            if members.shape[0] == 0: continue
+            if self.verbose:
+                row = cdf.iloc[members[0]]
+                sys.stderr.write("Counting proximity in "+str((row['sample_name'],row['frame_name'],row['region_label']))+"\n")
+            near[members] = _region_proximity(pcodes[members],coords[members],len(plabs),radius_pixels)
+            own = np.zeros((members.shape[0],len(plabs)),dtype=np.int64)
+            own[np.arange(members.shape[0]),pcodes[members]] = 1
+            far[members] = own.sum(axis=0)[None,:]-own-near[members]
+        return plabs, measured, near, far
+    def proximity_counts(self,radius_um=None,radius_pixels=None):
+        """
+        Count the cells of each phenotype near every cell of its frame region.
+
+        Counts come from a radius query of one KDTree per phenotype,
+        so they are not limited by the per_phenotype_neighbors used to build the NearestNeighbors object.
+
+        Args:
+            radius_um (float): the radius in microns
+            radius_pixels (float): the radius in pixels (used over radius_um if both are set)
+
+        Returns:
+            pandas.DataFrame: one row for each cell and neighbor phenotype with 'near_count', the cells closer than the radius,
+                              and 'far_count', the rest of the cells of that phenotype in the frame region
+        """
+        if radius_um is not None and radius_pixels is None:
+            radius_pixels = radius_um/self.microns_per_pixel
+        if radius_pixels is None: raise ValueError("must set radius_um or radius_pixels")
+        plabs, measured, near, far = self._proximity(radius_pixels)
+        columns = self.cdf.frame_columns+['region_label','phenotype_label','cell_index']
+        rows = np.flatnonzero(measured)
+        df = pd.DataFrame(self.cdf[columns]).iloc[np.repeat(rows,len(plabs))].reset_index(drop=True)
+        df['neighbor_phenotype_label'] = np.tile(np.array(plabs,dtype=object),rows.shape[0])
+        df['near_count'] = near[rows].ravel()
+        df['far_count'] = far[rows].ravel()
+        return df
+    def frame_proximity(self,threshold_um,phenotype,mode='neighbors'):
+        """
+        Count the cells of each phenotype that are near to (closer than threshold_um) or far from the cells of one phenotype.
+
+        Args:
+            threshold_um (float): the distance in microns
+            phenotype (str): the phenotype to measure proximity to
+            mode (str): 'neighbors' counts the per_phenotype_neighbors nearest neighbors of each cell,
+                        'radius' counts every cell in the frame region (default 'neighbors')
+
+        Returns:
+            pandas.DataFrame
+        """
+        if mode not in ['neighbors','radius']: raise ValueError("mode must be 'neighbors' or 'radius'")
         threshold  = threshold_um/self.microns_per_pixel
         mergeon = self.cdf.frame_columns+['region_label']
-        df = self.loc[(self['neighbor_phenotype_label']==phenotype)
-                 ].copy()
-        df.loc[df['neighbor_distance_px']>=threshold,'location'] = 'far'
-        df.loc[df['neighbor_distance_px']<threshold,'location'] = 'near'
-        df = df.groupby(mergeon+['phenotype_label','neighbor_phenotype_label','location']).count()[['cell_index']].\
-            rename(columns={'cell_index':'count'}).reset_index()[mergeon+['phenotype_label','location','count']]
+        if mode == 'radius':
+            plabs, measured, near, far = self._proximity(threshold)
+            rows = np.flatnonzero(measured)
+            j = plabs.index(phenotype) if phenotype in plabs else None
+            df = pd.DataFrame(self.cdf[mergeon+['phenotype_label']]).iloc[np.tile(rows,2)].reset_index(drop=True)
+            df['location'] = np.repeat(np.array(['near','far'],dtype=object),rows.shape[0])
+            df['count'] = np.concatenate([near[rows,j],far[rows,j]]) if j is not None else 0
+            df = df.groupby(mergeon+['phenotype_label','location']).sum()[['count']].reset_index()
+            # like the neighbors mode, only report locations that have cells
+            df = df.loc[df['count']>0,mergeon+['phenotype_label','location','count']]
+        else:
+            df = self.loc[(self['neighbor_phenotype_label']==phenotype)
+                     ].copy()
+            df.loc[df['neighbor_distance_px']>=threshold,'location'] = 'far'
+            df.loc[df['neighbor_distance_px']<threshold,'location'] = 'near'
+            df = df.groupby(mergeon+['phenotype_label','neighbor_phenotype_label','location']).count()[['cell_index']].\
+                rename(columns={'cell_index':'count'}).reset_index()[mergeon+['phenotype_label','location','count']]
         mr = self.measured_regions[mergeon].copy()
         mr['_key'] = 1
         mp = pd.DataFrame({'phenotype_label':self.measured_phenotypes})
@@ -257,34 +375,61 @@ class NearestNeighbors(Measurement):
         df['fraction'] = df.apply(lambda x: x['count']/x['total'],1)
         df = df.sort_values(mergeon+['location','phenotype_label'])
         return df
-    def sample_proximity(self,threshold_um,phenotype):
+    def sample_proximity(self,threshold_um,phenotype,mode='neighbors'):
         mergeon = self.cdf.sample_columns+['region_label']
-        fp = self.frame_proximity(threshold_um,phenotype)
+        fp = self.frame_proximity(threshold_um,phenotype,mode=mode)
         cnt = fp.groupby(mergeon+['phenotype_label','location']).sum()[['count']].reset_index()
         total = cnt.groupby(mergeon+['location']).sum()[['count']].rename(columns={'count':'total'}).\
              reset_index()
         cnt = cnt.merge(total,on=mergeon+['location']).sort_values(mergeon+['location','phenotype_label'])
         cnt['fraction'] = cnt.apply(lambda x: x['count']/x['total'],1)
         return cnt
-    def project_proximity(self,threshold_um,phenotype):
+    def project_proximity(self,threshold_um,phenotype,mode='neighbors'):
         mergeon = self.cdf.project_columns+['region_label']
-        fp = self.sample_proximity(threshold_um,phenotype)
+        fp = self.sample_proximity(threshold_um,phenotype,mode=mode)
         cnt = fp.groupby(mergeon+['phenotype_label','location']).sum()[['count']].reset_index()
         total = cnt.groupby(mergeon+['location']).sum()[['count']].rename(columns={'count':'total'}).\
              reset_index()
         cnt = cnt.merge(total,on=mergeon+['location']).sort_values(mergeon+['location','phenotype_label'])
         cnt['fraction'] = cnt.apply(lambda x: x['count']/x['total'],1)
         return cnt
-    def threshold(self,phenotype,proximal_label,k_neighbors=1,distance_um=None,distance_pixels=None):
-        if k_neighbors > self.iloc[0]['per_phenotype_neighbors']:
+    def threshold(self,phenotype,proximal_label,k_neighbors=1,distance_um=None,distance_pixels=None,mode='neighbors'):
+        """
+        Add a scored call for cells that have at least k_neighbors cells of a phenotype closer than a distance.
+
+        Args:
+            phenotype (str): the phenotype to measure proximity to
+            proximal_label (str): name of the scored call to add
+            k_neighbors (int): number of cells of the phenotype that must be near (default 1)
+            distance_um (float): the distance in microns
+            distance_pixels (float): the distance in pixels (used over distance_um if both are set)
+            mode (str): 'neighbors' uses the nearest neighbors so k_neighbors can be at most per_phenotype_neighbors,
+                        'radius' counts every cell in the frame region (default 'neighbors')
+
+        Returns:
+            CellDataFrame
+        """
+        if mode not in ['neighbors','radius']: raise ValueError("mode must be 'neighbors' or 'radius'")
+        if mode == 'radius' and distance_um is None and distance_pixels is None:
+            raise ValueError("mode 'radius' needs a distance_um or distance_pixels")
+        if mode == 'neighbors' and k_neighbors > self.iloc[0]['per_phenotype_neighbors']:
             raise ValueError("must select a k_neighbors smaller or equal to the min_neighbors used to generate the NearestNeighbors object")
         if phenotype not in self.cdf.phenotypes: raise ValueError("Can only threshold on one of the pre-established phenotypes (before calling nearestneighbors")
         def _add_score(d,value,label):
+            d = d.copy()
             d[label] = 0 if value!=value else int(value)
             return d
         if distance_um is not None and distance_pixels is None:
             distance_pixels = distance_um/self.microns_per_pixel
 
+        if mode == 'radius':
+            plabs, measured, near, far = self._proximity(distance_pixels)
+            value = measured&(near[:,plabs.index(phenotype)]>=k_neighbors) if phenotype in plabs else np.zeros(measured.shape[0],dtype=bool)
+            cdf = self.cdf.copy().reset_index(drop=True)
+            cdf['scored_calls'] = [_add_score(d,v,proximal_label) for d,v in zip(cdf['scored_calls'],value.astype(int).tolist())]
+            cdf.microns_per_pixel = self.microns_per_pixel
+            return cdf
+
         nn1 = self.loc[(self['neighbor_phenotype_label']==phenotype)&\
                (self['neighbor_rank']==k_neighbors-1)
               ].copy()
@@ -347,6 +492,7 @@ class NearestNeighbors(Measurement):
             CellDataFrame: Returns a series from the CellDataFrame which is the cell this region is referenced from, and the CellDataFrame.
         """
         def _set_ref(scored_calls,value):
+            scored_calls = scored_calls.copy()
             scored_calls['reference_cell'] = value
             return scored_calls
         if cell_indecies is not None and self.loc[:,['project_id','project_name','sample_id','sample_name','frame_id','frame_name']].drop_duplicates().shape[0] != 1:
@@ -357,7 +503,7 @@ class NearestNeighbors(Measurement):
         if max_distance_um is not None:
             max_distance_px = max_distance_um/self.cdf.microns_per_pixel
         mergeon = ['project_id','project_name','sample_id','sample_name','frame_id','frame_name','region_label']
-        for block in self.cdf.frame_region_generator():
+        for block in self.cdf.frame_region_generator(copy=False):
             if verbose and block.shape[0] > 0: sys.stderr.write("Processing block "+str((block.iloc[0]['sample_name'],block.iloc[0]['frame_name'],block.iloc[0]['region_label']))+"\n")
             block = block.prune_neighbors()
             block_idx = block.set_index('cell_index')
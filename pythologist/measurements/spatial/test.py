@@ -0,0 +1,123 @@
+# Test the spatial measurements on a small synthetic CellDataFrame
+import unittest, warnings
+import numpy as np
+import pandas as pd
+from pythologist import CellDataFrame
+
+def synthetic_cdf(n_frames=3,n_cells=60,seed=0,assortative=False):
+    # Pre: Take a number of frames, cells per frame, a random seed and if cells should only touch their own phenotype
+    # Post: Return a CellDataFrame of random cells in two samples with symmetric neighbors
+    rng = np.random.RandomState(seed)
+    phenotypes = ['CD8','TUMOR','OTHER']
+    rows = []
+    for f in range(n_frames):
+        sid = 's'+str(f%2)
+        regions = {'Tumor':int(rng.randint(5000,20000)),'Stroma':int(rng.randint(5000,20000))}
+        labels = rng.choice(phenotypes,n_cells)
+        neighbors = [{} for i in range(n_cells)]
+        for i in range(n_cells):
+            candidates = np.flatnonzero(labels==labels[i]) if assortative else np.arange(n_cells)
+            for j in rng.choice(candidates,3,replace=False):
+                if j == i: continue
+                v = int(rng.randint(1,10))
+                neighbors[i][int(j)+1] = v
+                neighbors[j][i+1] = v
+        for i in range(n_cells):
+            rows.append({'project_id':'p0','project_name':'project','sample_id':sid,'sample_name':'S'+sid,
+                         'frame_id':'f'+str(f),'frame_name':'F'+str(f),'cell_index':i+1,
+                         'x':float(rng.uniform(0,500)),'y':float(rng.uniform(0,400)),
+                         'cell_area':int(rng.randint(20,80)),'edge_length':int(rng.randint(5,30)),
+                         'regions':regions,'region_label':['Tumor','Stroma'][i%2],
+                         'phenotype_label':labels[i],'phenotype_calls':dict([(p,int(p==labels[i])) for p in phenotypes]),
+                         'scored_calls':{'PDL1':int(rng.rand()<0.4)},'channel_values':{'a':float(rng.rand())},
+                         'neighbors':neighbors[i],'frame_shape':(400,500)})
+    cdf = CellDataFrame(pd.DataFrame(rows))
+    cdf.microns_per_pixel = 0.5
+    return cdf
+
+class NearestNeighborsProximityTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        warnings.simplefilter('ignore')
+        # enough neighbors per phenotype that every cell of a frame region is a neighbor
+        self.nn = synthetic_cdf().nearestneighbors(per_phenotype_neighbors=100)
+    # radius mode counts every cell so it should match neighbors mode here
+    def test_frame_proximity_radius(self):
+        pd.testing.assert_frame_equal(self.nn.frame_proximity(20,'CD8',mode='neighbors').reset_index(drop=True),
+                                      self.nn.frame_proximity(20,'CD8',mode='radius').reset_index(drop=True),
+                                      check_dtype=False)
+    def test_sample_proximity_radius(self):
+        pd.testing.assert_frame_equal(self.nn.sample_proximity(20,'CD8',mode='neighbors').reset_index(drop=True),
+                                      self.nn.sample_proximity(20,'CD8',mode='radius').reset_index(drop=True),
+                                      check_dtype=False)
+    def test_project_proximity_radius(self):
+        pd.testing.assert_frame_equal(self.nn.project_proximity(20,'CD8',mode='neighbors').reset_index(drop=True),
+                                      self.nn.project_proximity(20,'CD8',mode='radius').reset_index(drop=True),
+                                      check_dtype=False)
+    def test_threshold_radius_needs_distance(self):
+        with self.assertRaises(ValueError):
+            self.nn.threshold('CD8','near',mode='radius')
+
+class ContactPermutationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        warnings.simplefilter('ignore')
+        self.contacts = synthetic_cdf().contacts()
+    # the array engine draws the same shuffles as Contacts.permute
+    def test_engine_matches_permute(self):
+        from pythologist.measurements.spatial.contacts import _ContactPermuter
+        from pythologist.seeds import seed_sequence
+        permuter = _ContactPermuter.from_contacts(self.contacts,['CD8','TUMOR'])
+        codes = dict([(x,i) for i,x in enumerate(permuter.phenotypes)])
+        keys = permuter.keys.copy()
+        keys['_group'] = np.arange(keys.shape[0])
+        for i in range(3):
+            counts = permuter.counts(permuter.permuted_labels(seed_sequence(7),i))
+            expected = self.contacts.permute(phenotypes=['CD8','TUMOR'],random_state=7,permutation=i).frame_counts().merge(keys)
+            observed = [counts[g,codes[a],codes[b]] for g,a,b in zip(expected['_group'],expected['phenotype_label'],expected['neighbor_phenotype_label'])]
+            self.assertEqual(observed,expected['contact_count'].tolist())
+    def test_perm_mean_matches_permute(self):
+        n = 4
+        fc = self.contacts.permute_frame_counts(n_permutations=n,random_state=3)
+        mergeon = self.contacts.cdf.frame_columns+['region_label','phenotype_label','neighbor_phenotype_label']
+        perms = pd.concat([self.contacts.permute(random_state=3,permutation=i).frame_counts() for i in range(n)])
+        mean = perms.groupby(mergeon)['contact_count'].sum().div(n).rename('expected').reset_index()
+        check = fc.merge(mean,on=mergeon)
+        self.assertEqual(check.shape[0],fc.shape[0])
+        np.testing.assert_allclose(check['perm_mean'],check['expected'])
+    # workers reading the shared memory arrays draw the same permutations as one process
+    def test_parallel_frame_counts(self):
+        pd.testing.assert_frame_equal(self.contacts.permute_frame_counts(n_permutations=30,random_state=5),
+                                      self.contacts.permute_frame_counts(n_permutations=30,random_state=5,n_processes=2))
+    def test_parallel_sample_counts(self):
+        pd.testing.assert_frame_equal(self.contacts.permute_sample_counts(n_permutations=30,random_state=5),
+                                      self.contacts.permute_sample_counts(n_permutations=30,random_state=5,n_processes=2))
+
+class ContactEarlyStoppingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        warnings.simplefilter('ignore')
+        # cells only touch their own phenotype so many rows are far outside the permutations
+        self.contacts = synthetic_cdf(assortative=True).contacts()
+        self.n_permutations = 300
+        self.early = self.contacts.permute_frame_counts(n_permutations=self.n_permutations,random_state=2,
+                                                        min_exceedances=5,batch_size=40)
+    def test_extreme_rows_stop_early(self):
+        extreme = self.early.loc[np.minimum(self.early['perm_low_count'],self.early['perm_high_count'])==0]
+        self.assertTrue(extreme.shape[0] > 0)
+        self.assertTrue((extreme['n_perms'] < self.n_permutations).all())
+    def test_rows_settle_for_a_reason(self):
+        tail = np.minimum(self.early['perm_low_count'],self.early['perm_high_count'])
+        settled = self.early['n_perms'] < self.n_permutations
+        self.assertTrue(settled.any())
+        self.assertTrue(((tail>=5)|(tail/self.early['n_perms']<0.05))[settled].all())
+    # a row that settled after k permutations has the statistics of a run of k permutations
+    def test_settled_rows_match_shorter_runs(self):
+        mergeon = self.contacts.cdf.frame_columns+['region_label','phenotype_label','neighbor_phenotype_label']
+        for k in self.early['n_perms'].unique():
+            rows = self.early.loc[self.early['n_perms']==k]
+            full = self.contacts.permute_frame_counts(n_permutations=int(k),random_state=2).merge(rows[mergeon],on=mergeon)
+            pd.testing.assert_frame_equal(rows.reset_index(drop=True),full.reset_index(drop=True))
+
+if __name__ == '__main__':
+    unittest.main()
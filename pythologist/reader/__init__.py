@@ -5,7 +5,12 @@ from uuid import uuid4
 from pythologist.image_utilities import map_image_ids
 from pythologist.reader.qc import QC
 from pythologist import CellDataFrame
+from pythologist.adjacency import neighbor_dicts
+from pythologist.calls import CallMatrix
 from tempfile import SpooledTemporaryFile
+from collections.abc import MutableMapping
+from collections import OrderedDict, namedtuple
+from multiprocessing import Pool
 from pythologist import __version__
 
 """
@@ -30,6 +35,174 @@ class FrameMaskLabel(object):
     def labels(self):
         return self._mask_image_label_dictionary
 
+class ImageStore(MutableMapping):
+    """
+    The images of a frame, read from their hdf5 group only when they are asked for.
+
+    Nothing is decoded when the store is made.  An image is decoded from its dataset on first access
+    and, if cache is set, kept in memory from then on.  Images set on the store are held in memory and
+    take the place of the dataset of the same id.
+
+    Params:
+        h5file (str): path to the h5 file
+        location (str): the group holding the image datasets
+        image_ids (list): the ids of the images in the group
+        cache (bool): keep images once they are decoded (default True)
+    """
+    def __init__(self,h5file,location,image_ids,cache=True):
+        self._h5file = h5file
+        self._location = location
+        self._image_ids = list(image_ids)
+        self._loaded = {}
+        self.cache = cache
+
+    def __getitem__(self,image_id):
+        if image_id in self._loaded: return self._loaded[image_id]
+        if image_id not in self._image_ids: raise KeyError(image_id)
+        f = h5py.File(self._h5file,'r')
+        image = np.array(f[self._location][image_id])
+        f.close()
+        if self.cache: self._loaded[image_id] = image
+        return image
+    def __setitem__(self,image_id,image):
+        if image_id not in self._image_ids: self._image_ids.append(image_id)
+        self._loaded[image_id] = image
+    def __delitem__(self,image_id):
+        if image_id not in self._image_ids: raise KeyError(image_id)
+        self._image_ids.remove(image_id)
+        if image_id in self._loaded: del self._loaded[image_id]
+    def __contains__(self,image_id):
+        return image_id in self._image_ids
+    def __iter__(self):
+        return iter(list(self._image_ids))
+    def __len__(self):
+        return len(self._image_ids)
+
+    @property
+    def loaded(self):
+        """
+        Return the list of image ids held in memory
+        """
+        return list(self._loaded.keys())
+
+    def shape(self,image_id):
+        """
+        Args:
+            image_id (str): the image id
+
+        Returns:
+            tuple: the shape of the image, without decoding it if it is not already in memory
+        """
+        if image_id in self._loaded: return self._loaded[image_id].shape
+        if image_id not in self._image_ids: raise KeyError(image_id)
+        f = h5py.File(self._h5file,'r')
+        shape = f[self._location][image_id].shape
+        f.close()
+        return shape
+
+    def copy(self):
+        """
+        Returns:
+            ImageStore: a store over the same datasets sharing the images already in memory
+        """
+        them = self.__class__(self._h5file,self._location,self._image_ids,cache=self.cache)
+        them._loaded = self._loaded.copy()
+        return them
+
+CacheInfo = namedtuple('CacheInfo',('hits','misses','max_items','max_bytes','items','bytes'))
+
+class LRUCache(object):
+    """
+    A least recently used cache bounded by a number of entries, a number of bytes, or both.
+
+    Params:
+        max_items (int): the most entries to keep (None for no limit)
+        max_bytes (int): the most bytes to keep as measured by sizeof (None for no limit)
+        sizeof (function): returns the size in bytes of a value, measured when the entry is added
+        stamp (function): optional cheap function of a value that changes when its size may have (i.e. the number of images it has loaded),
+                          entries whose stamp changed are measured again before checking the bytes held
+    """
+    def __init__(self,max_items=None,max_bytes=None,sizeof=None,stamp=None):
+        if max_bytes is not None and sizeof is None: raise ValueError("sizeof is needed to bound a cache by bytes")
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._stamp = stamp
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self,key):
+        return key in self._entries
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self,key):
+        """
+        Args:
+            key: the key of the entry
+
+        Returns:
+            the value, or None if it is not cached (counted as a miss)
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self,key,value):
+        """
+        Add an entry as the most recently used, evicting the least recently used entries to stay in bounds.
+
+        Args:
+            key: the key of the entry
+            value: the value to keep
+        """
+        if key in self._entries: self._remove(key)
+        self._entries[key] = value
+        if self._sizeof is not None:
+            self._sizes[key] = (self._sizeof(value),None if self._stamp is None else self._stamp(value))
+            self._bytes += self._sizes[key][0]
+        if self.max_items is not None:
+            while len(self._entries) > self.max_items: self._remove(next(iter(self._entries)))
+        if self.max_bytes is not None:
+            self._measure_changed()
+            while len(self._entries) > 0 and self._bytes > self.max_bytes: self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        """
+        Remove every entry.  The hit and miss counts are kept.
+        """
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+
+    def info(self):
+        """
+        Returns:
+            CacheInfo: hits, misses, the bounds, and the number of entries and bytes held (bytes is None without sizeof)
+        """
+        if self._sizeof is not None: self._measure_changed()
+        nbytes = None if self._sizeof is None else self._bytes
+        return CacheInfo(self.hits,self.misses,self.max_items,self.max_bytes,len(self._entries),nbytes)
+
+    def _remove(self,key):
+        del self._entries[key]
+        if key in self._sizes: self._bytes -= self._sizes.pop(key)[0]
+
+    def _measure_changed(self):
+        if self._stamp is None: return
+        for key, value in self._entries.items():
+            size, stamp = self._sizes[key]
+            current = self._stamp(value)
+            if current == stamp: continue
+            self._sizes[key] = (self._sizeof(value),current)
+            self._bytes += self._sizes[key][0]-size
+
 class CellFrameGeneric(object):
     """
     A generic CellFrameData object
@@ -120,6 +293,7 @@ class CellFrameGeneric(object):
         """
         Returns the (tuple) shape of the image (rows,columns)
         """
+        if isinstance(self._images,ImageStore): return self._images.shape(self._processed_image_id)
         return self.processed_image.shape
     
     @property
@@ -317,7 +491,16 @@ class CellFrameGeneric(object):
         """
         return self._data[table_name].copy()
 
-    def read_hdf(self,h5file,location=''):
+    def read_hdf(self,h5file,location='',lazy=False,cache_images=True):
+        """
+        Read the frame from an h5 file
+
+        Args:
+            h5file (str): path to the h5 file
+            location (str): location of the frame in the h5 file
+            lazy (bool): default False, if True images are only decoded from the file when they are first accessed
+            cache_images (bool): default True, when lazy keep images in memory after they are first decoded
+        """
         if location != '': location = location.split('/')
         else: location = []
         f = h5py.File(h5file,'r')
@@ -331,8 +514,11 @@ class CellFrameGeneric(object):
             self.set_data(table_name,pd.read_hdf(h5file,loc))
         # now get images
         image_names = [x for x in subgroup['images']]
-        for image_name in image_names:
-            self._images[image_name] = np.array(subgroup['images'][image_name])
+        if lazy:
+            self._images = ImageStore(h5file,'/'.join(location+['images']),image_names,cache=cache_images)
+        else:
+            for image_name in image_names:
+                self._images[image_name] = np.array(subgroup['images'][image_name])
         self.frame_name = subgroup['meta'].attrs['frame_name']
         self._id = subgroup['meta'].attrs['id']
         self._version = subgroup['meta'].attrs['version']
@@ -553,12 +739,15 @@ class CellFrameGeneric(object):
         return None
         
 
-    def cdf(self,region_group=None,mutually_exclusive_phenotypes=None):
+    def cdf(self,region_group=None,mutually_exclusive_phenotypes=None,channel_values=True,neighbors=True):
         """
         Return the pythologist.CellDataFrame of the frame
 
         Args:
             region_group (str): A region group present in the h5
+            mutually_exclusive_phenotypes (list): phenotypes to convert from scored calls
+            channel_values (bool): default True, if False the channel_values column is left as NaN and no measurements are read
+            neighbors (bool): default True, if False the neighbors column is left as NaN and no cell interactions are read
 
         Returns:
             pythologist.CellDataFrame: the dataframe
@@ -586,7 +775,8 @@ class CellFrameGeneric(object):
 
 
         # get our cells
-        temp1 = self.get_data('cells').\
+        cells = self.get_data('cells')
+        temp1 = cells.\
             merge(self.get_data('cell_regions'),
                   left_index=True,
                   right_on='cell_index').\
@@ -594,112 +784,75 @@ class CellFrameGeneric(object):
                   left_on='region_index',
                   right_index=True).\
             drop(columns=['image_id','region_index','region_size','region_group_index'])
-        temp1['regions'] = temp1.apply(lambda x: region_sizes,1)
+        # every cell shares the same (read-only) dictionaries
+        temp1['regions'] = [region_sizes]*temp1.shape[0]
         temp1['phenotype_label'] = 'TOTAL'
-        temp1['phenotype_calls'] = temp1['phenotype_label'].apply(lambda x: {'TOTAL':1})
+        temp1['phenotype_calls'] = [{'TOTAL':1}]*temp1.shape[0]
 
+        # binary features are the ones defined by exactly the values 0 '-' and 1 '+'
         _fdt = self.get_data('feature_definitions')
-        _fdt['feature_tuple'] = _fdt.apply(lambda x: tuple([x['feature_value'],x['feature_value_label']]),1)
-        _fgt = _fdt.groupby('feature_index').apply(lambda x: set(x['feature_tuple']))
-        _binary_feature_index = _fgt.loc[_fgt=={(0, "-"), (1, "+")}].index
+        _fgt = _fdt[['feature_index','feature_value','feature_value_label']].drop_duplicates()
+        _fgt = pd.DataFrame({'feature_index':_fgt['feature_index'],
+                             'binary':((_fgt['feature_value']==0)&(_fgt['feature_value_label']=='-'))|\
+                                      ((_fgt['feature_value']==1)&(_fgt['feature_value_label']=='+'))}).\
+            groupby('feature_index')['binary'].agg(['all','size'])
+        _binary_feature_index = _fgt.loc[_fgt['all']&(_fgt['size']==2)].index
         # Filter to only binary features
-        _fdt = _fdt.loc[_fdt['feature_index'].isin(_binary_feature_index),:].copy().drop(columns=['feature_tuple'])
+        _fdt = _fdt.loc[_fdt['feature_index'].isin(_binary_feature_index),:]
         _fdt = self.get_data('features').merge(_fdt,left_index=True,right_on='feature_index').drop(columns=['feature_description'])
         _ft = _fdt.merge(self.get_data('cell_features'),left_index=True,right_on='feature_definition_index')
-        #print(_ft)
-        _df = _ft.pivot(index='cell_index',columns='feature_label',values='feature_value').fillna(0).astype(int).\
-            apply(lambda x: dict(zip(x.index,x)),1).reset_index().rename(columns={0:'scored_calls'})
+        _pt = _ft.pivot(index='cell_index',columns='feature_label',values='feature_value').fillna(0).astype(int)
+        _df = pd.DataFrame({'cell_index':_pt.index,
+                            'scored_calls':CallMatrix(_pt.columns,_pt.to_numpy()).to_series().to_numpy()})
 
         temp1 = temp1.merge(_df,on='cell_index')
-        temp4 = self.default_raw()
+        temp4 = self.default_raw() if channel_values else None
         if temp4 is not None:
-            temp4 = temp4.apply(lambda x:
-                dict(zip(
-                    list(x.index),
-                    list(x)
-                ))
-            ,1).reset_index().rename(columns={0:'channel_values'}).set_index('cell_index')
+            temp4 = pd.DataFrame({'channel_values':CallMatrix(temp4.columns,temp4.to_numpy()).to_series().to_numpy()},
+                                 index=temp4.index)
             temp1 = temp1.merge(temp4,left_on='cell_index',right_index=True)
         else:
             temp1['channel_values'] = np.nan
-        #return temp1
-
-        #temp5 = self.interaction_map().groupby('cell_index').\
-        #    apply(lambda x: json.dumps(list(sorted(x['neighbor_cell_index'])))).reset_index().\
-        #    rename(columns={0:'neighbor_cell_index'}).set_index('cell_index')
-
 
         # Get neighbor data .. may not be available for all cells
         #    Set a default of a null frame and only try and set if there are some neighbors present
-        neighbors = pd.DataFrame(index=self.get_data('cells').index)
-        #neighbors.index.name='cell_index'
-        neighbors = neighbors.reset_index()
-        if self.interaction_map().shape[0] > 0:
-            #neighbors = self.interaction_map().groupby('cell_index').\
-            #    apply(lambda x:
-            #        dict(zip(
-            #            x['neighbor_cell_index'].astype(int),x['pixel_count'].astype(int)
-            #        ))
-            #    ).reset_index().rename(columns={0:'neighbors'}).set_index('cell_index')
-            neighbors2 = pd.DataFrame(self.get_data('cell_interactions').groupby('cell_index').\
-                apply(lambda x: dict(zip(x['neighbor_cell_index'],x['pixel_count'])))).\
-                rename(columns={0:'neighbors'}).reset_index()
-            neighbors = neighbors.merge(neighbors2,on='cell_index',how='left').\
-                set_index('cell_index')
-            neighbors['neighbors'] = neighbors['neighbors'].\
-                apply(lambda x: {} if x!=x else x)
+        _nt = pd.DataFrame(index=cells.index).reset_index()
+        _it = self.get_data('cell_interactions') if neighbors else None
+        if _it is not None and _it.shape[0] > 0:
+            _nt['neighbors'] = neighbor_dicts(_it['cell_index'].to_numpy(),
+                                              _it['neighbor_cell_index'].to_numpy(),
+                                              _it['pixel_count'].to_numpy(),
+                                              _nt['cell_index'].to_numpy())
         else:
-            neighbors['neighbors'] = 1
-            neighbors['neighbors'] = neighbors.apply(lambda x: np.nan,1)
-            neighbors = neighbors.set_index('cell_index')
-        #print("neighbors:")
-        #print(neighbors)
-
-        #print("temp1")
-        #print(temp1)
-        # only do edges if we have them by setting a null value for default
-        edge_length = pd.DataFrame(index=self.get_data('cells').index,columns=['edge_length'])
-        if self.edge_map() is not None:
-            edge_length = self.edge_map().reset_index().groupby('cell_index').count()[['x']].\
-                rename(columns={'x':'edge_length'})
-            edge_length['edge_length'] = edge_length['edge_length'].astype(int)
-
-        cell_area = pd.DataFrame(index=self.get_data('cells').index,columns=['cell_area'])
-        if self.cell_map() is not None:
-            cell_area = self.cell_map().reset_index().groupby('cell_index').count()[['x']].\
-                rename(columns={'x':'cell_area'})
-            cell_area['cell_area'] = cell_area['cell_area'].astype(int)
+            _nt['neighbors'] = np.nan
+        _nt = _nt.set_index('cell_index')
+
+        # only do edges and areas if we have them by setting a null value for default
+        edge_image = self.edge_map_image()
+        cell_image = self.cell_map_image()
+        edge_length = pd.DataFrame(index=cells.index,columns=['edge_length'])
+        if edge_image is not None: edge_length = _label_pixel_counts(edge_image,'edge_length')
+        cell_area = pd.DataFrame(index=cells.index,columns=['cell_area'])
+        if cell_image is not None: cell_area = _label_pixel_counts(cell_image,'cell_area')
 
         temp5 = cell_area.merge(edge_length,left_index=True,right_index=True).\
-            merge(neighbors,left_index=True,right_index=True,how='left')
-        #temp5.loc[temp5['neighbors'].isna(),'neighbors'] = temp5.loc[temp5['neighbors'].isna(),'neighbors'].apply(lambda x: {}) # these are ones we actuall have measured
-        #print("temp5")
-        #print(temp5)
+            merge(_nt,left_index=True,right_index=True,how='left')
         # If we DO have cell_map, merge in
-        if self.cell_map() is not None:
+        if cell_image is not None:
             temp1 = temp1.drop(columns=['cell_area','edge_length']).merge(temp5,left_on='cell_index',right_index=True,how='left')
         else:
             temp1 = temp1.merge(temp5.drop(columns=['cell_area','edge_length']),left_on='cell_index',right_index=True,how='left')
-        #temp1.loc[temp1['neighbors'].isna(),'neighbors'] = np.nan # These we were not able to measure
 
 
         temp1['frame_name'] = self.frame_name
         temp1['frame_id'] = self.id
-        #temp1  = temp1.reset_index()
         temp1 = temp1.sort_values('cell_index').reset_index(drop=True)
         temp1['sample_name'] = 'undefined'
         temp1['project_name'] = 'undefined'
         temp1['sample_id'] = 'undefined'
         temp1['project_id'] = 'undefined'
-        def _get_phenotype(d):
-            if d!=d: return np.nan # set to null if there is nothing in phenotype calls
-            vals = [k for k,v in d.items() if v ==  1]
-            return np.nan if len(vals) == 0 else vals[0]
-        temp1['phenotype_label'] = temp1.apply(lambda x:
-                  _get_phenotype(x['phenotype_calls'])
-            ,1)
         # Let's tack on the image shape
-        temp1['frame_shape'] = temp1.apply(lambda x: self.shape,1)
+        temp1['frame_shape'] = [self.shape]*temp1.shape[0]
         cdf = CellDataFrame(temp1)
         if mutually_exclusive_phenotypes is not None:
             cdf = cdf.scored_to_phenotypes(mutually_exclusive_phenotypes).drop_scored_calls(mutually_exclusive_phenotypes)
@@ -787,13 +940,25 @@ class CellSampleGeneric(object):
         """
         return self._frames[frame_id]
 
-    def cdf(self,region_group=None,mutually_exclusive_phenotypes=None):
+    def cdf(self,region_group=None,mutually_exclusive_phenotypes=None,channel_values=True,neighbors=True):
         """
         Return the pythologist.CellDataFrame of the sample
+
+        Args:
+            region_group (str): A region group present in the h5
+            mutually_exclusive_phenotypes (list): phenotypes to convert from scored calls
+            channel_values (bool): default True, if False the channel_values column is left as NaN
+            neighbors (bool): default True, if False the neighbors column is left as NaN
+
+        Returns:
+            pythologist.CellDataFrame: the dataframe
         """
         output = []
         for frame_id in self.frame_ids:
-            temp = self.get_frame(frame_id).cdf(region_group=region_group,mutually_exclusive_phenotypes=mutually_exclusive_phenotypes)
+            temp = self.get_frame(frame_id).cdf(region_group=region_group,
+                                                mutually_exclusive_phenotypes=mutually_exclusive_phenotypes,
+                                                channel_values=channel_values,
+                                                neighbors=neighbors)
             temp['sample_name'] = self.sample_name
             temp['sample_id'] = self.id
             output.append(temp)
@@ -828,7 +993,16 @@ class CellSampleGeneric(object):
         self._key.to_hdf(h5file,location+'/info',mode='r+',format='table',complib='zlib',complevel=9)
 
 
-    def read_hdf(self,h5file,location=''):
+    def read_hdf(self,h5file,location='',lazy=False,cache_images=True):
+        """
+        Read the sample from an h5 file
+
+        Args:
+            h5file (str): path to the h5 file
+            location (str): location of the sample in the h5 file
+            lazy (bool): default False, if True frame images are only decoded from the file when they are first accessed
+            cache_images (bool): default True, when lazy keep images in memory after they are first decoded
+        """
         if location != '': location = location.split('/')
         else: location = []
         f = h5py.File(h5file,'r')
@@ -843,7 +1017,7 @@ class CellSampleGeneric(object):
             cellframe = self.create_cell_frame_class()
             loc = '/'.join(location+['frames',frame_id])
             #print(loc)
-            cellframe.read_hdf(h5file,location=loc)
+            cellframe.read_hdf(h5file,location=loc,lazy=lazy,cache_images=cache_images)
             self._frames[frame_id] = cellframe
             #self.frame_name = str(subgroup['frames'][frame_id]['meta']['frame_name'])
             #self._id = str(subgroup['frames'][frame_id]['meta']['id'])
@@ -919,19 +1093,31 @@ class CellSampleGeneric(object):
         return pd.concat(vals).set_index(['sample_name','sample_id','frame_name','frame_id','cell_index'])
 
 class CellProjectGeneric(object):
-    def __init__(self,h5path,mode='r'):
+    def __init__(self,h5path,mode='r',lazy_images=False,cache_images=True,
+                 sample_cache_size=1,sample_cache_bytes=None,frame_cache_size=16,frame_cache_bytes=None):
         """
         Create a CellProjectGeneric object or read from/add to an existing one
 
         Args:
             h5path (str): path to read/from or store/to, only use None for a dry_run read
             mode (str): 'r' read, 'a' append, 'w' create/write, 'r+' create/append if necessary
+            lazy_images (bool): default False, if True samples are read without decoding their images until they are accessed
+            cache_images (bool): default True, with lazy_images keep images in memory after they are first decoded
+            sample_cache_size (int): default 1, the most samples get_sample keeps in memory (None for no limit)
+            sample_cache_bytes (int): if set, the most bytes of samples get_sample keeps in memory
+            frame_cache_size (int): default 16, the most frames get_frame keeps in memory (None for no limit)
+            frame_cache_bytes (int): if set, the most bytes of frames get_frame keeps in memory
         """
         self._key = None
         self.h5path = h5path if h5path is not None else SpooledTemporaryFile(max_size=100*1e6)
         self.mode = mode
-        self._sample_cache_name = None
-        self._sample_cache = None
+        self.lazy_images = lazy_images
+        self.cache_images = cache_images
+        self._session_depth = 0
+        self._session_file = None
+        self._meta_cache = {}
+        self._sample_cache = LRUCache(sample_cache_size,sample_cache_bytes,_sample_nbytes,_sample_stamp)
+        self._frame_cache = LRUCache(frame_cache_size,frame_cache_bytes,_frame_nbytes,_frame_stamp)
         if mode =='r':
             if not os.path.exists(h5path): raise ValueError("Cannot read a file that does not exist")
         if mode == 'w' or mode == 'r+':
@@ -949,6 +1135,42 @@ class CellProjectGeneric(object):
             f.close()
         return
 
+    def __enter__(self):
+        """
+        Start a session on the project.  Within a session the h5 file is kept open for reading and metadata
+        (id, version, project_name, microns_per_pixel and key) is read only once.  Writes drop the cached metadata.
+
+        Sessions can be nested, the file is closed when the outermost one ends.
+        """
+        self._session_depth += 1
+        return self
+
+    def __exit__(self,*args):
+        self._session_depth -= 1
+        if self._session_depth == 0: self._invalidate()
+        return False
+
+    def _read_file(self):
+        # the session's read handle, opened on first use
+        if self._session_file is None: self._session_file = h5py.File(self.h5path,'r')
+        return self._session_file
+
+    def _invalidate(self):
+        # drop the cached metadata and the read handle so a write can open the file
+        self._meta_cache = {}
+        if self._session_file is not None:
+            self._session_file.close()
+            self._session_file = None
+
+    def _meta(self,name):
+        if self._session_depth == 0:
+            f = h5py.File(self.h5path,'r')
+            value = f['meta'].attrs[name]
+            f.close()
+            return value
+        if name not in self._meta_cache: self._meta_cache[name] = self._read_file()['meta'].attrs[name]
+        return self._meta_cache[name]
+
     def copy(self,path,overwrite=False,output_mode='r'):
         if os.path.exists(path) and overwrite is False: 
             raise ValueError("Cannot overwrite unless overwrite is set to True")
@@ -990,6 +1212,7 @@ class CellProjectGeneric(object):
             sample (CellSampleGeneric): sample object
         """
         if self.mode == 'r': raise ValueError("Error: cannot write to a path in read-only mode.")
+        self._invalidate()
         sample.to_hdf(self.h5path,location='samples/'+sample.id,mode='a')
         
         current = self.key
@@ -1003,6 +1226,7 @@ class CellProjectGeneric(object):
                                       'sample_id':sample.id,
                                       'sample_name':sample.sample_name}]).set_index('db_id')
             current = pd.concat([current,addition])
+        self._invalidate()
         current.to_hdf(self.h5path,'info',mode='r+',complib='zlib',complevel=9,format='table')
         return
 
@@ -1018,33 +1242,25 @@ class CellProjectGeneric(object):
         """
         Returns the (str) UUID4 string
         """
-        f = h5py.File(self.h5path,'r')
-        name = f['meta'].attrs['id']
-        f.close()
-        return name
+        return self._meta('id')
 
     @property
     def version(self):
         """
         Returns pythologist version the project was created under
         """
-        f = h5py.File(self.h5path,'r')
-        name = f['meta'].attrs['version']
-        f.close()
-        return name
+        return self._meta('version')
 
     @property 
     def project_name(self):
         """
         Return or set the (str) project_name
         """
-        f = h5py.File(self.h5path,'r')
-        name = f['meta'].attrs['project_name']
-        f.close()
-        return name
+        return self._meta('project_name')
     @project_name.setter
     def project_name(self,name):
         if self.mode == 'r': raise ValueError('cannot write if read only')
+        self._invalidate()
         f = h5py.File(self.h5path,'r+')
         f['meta'].attrs['project_name'] = name
         f.close()
@@ -1054,13 +1270,11 @@ class CellProjectGeneric(object):
         """
         Return or set the (float) microns_per_pixel
         """
-        f = h5py.File(self.h5path,'r')
-        name = f['meta'].attrs['microns_per_pixel']
-        f.close()
-        return name
+        return self._meta('microns_per_pixel')
     @microns_per_pixel.setter
     def microns_per_pixel(self,value):
         if self.mode == 'r': raise ValueError('cannot write if read only')
+        self._invalidate()
         f = h5py.File(self.h5path,'r+')
         f['meta'].attrs['microns_per_pixel'] = value
         f.close()
@@ -1073,25 +1287,49 @@ class CellProjectGeneric(object):
             name (str): project_id
         """
         if self.mode == 'r': raise ValueError('cannot write if read only')
+        self._invalidate()
         f = h5py.File(self.h5path,'r+')
         #dset = f.create_dataset('/meta', (100,), dtype=h5py.special_dtype(vlen=str))
         f['meta'].attrs['id'] = name
         f.close()
 
-    def cdf(self,region_group=None,mutually_exclusive_phenotypes=None):
+    def cdf(self,region_group=None,mutually_exclusive_phenotypes=None,n_processes=1,channel_values=True,neighbors=True):
         """
         Return the pythologist.CellDataFrame of the project
+
+        Args:
+            region_group (str): A region group present in the h5
+            mutually_exclusive_phenotypes (list): phenotypes to convert from scored calls
+            channel_values (bool): default True, if False the channel_values column is left as NaN
+            neighbors (bool): default True, if False the neighbors column is left as NaN
+            n_processes (int): default 1, if more than one, samples are built in this many worker processes that each read the h5 file read-only
+
+        Returns:
+            pythologist.CellDataFrame: the dataframe
         """
-        output = []
-        for sample_id in self.sample_ids:
-            temp = self.get_sample(sample_id).cdf(region_group=region_group,mutually_exclusive_phenotypes=mutually_exclusive_phenotypes)
-            temp['project_name'] = self.project_name
-            temp['project_id'] = self.id
-            output.append(temp)
+        with self:
+            if n_processes <= 1 or not isinstance(self.h5path,str):
+                output = [self.get_sample(sample_id).cdf(region_group=region_group,
+                                                         mutually_exclusive_phenotypes=mutually_exclusive_phenotypes,
+                                                         channel_values=channel_values,
+                                                         neighbors=neighbors) \
+                          for sample_id in self.sample_ids]
+            else:
+                sample_class = type(self.create_cell_sample_class())
+                tasks = [(sample_class,self.h5path,sample_id,region_group,mutually_exclusive_phenotypes,channel_values,neighbors) \
+                         for sample_id in self.sample_ids]
+                with Pool(processes=n_processes) as pool:
+                    output = pool.map(_sample_cdf_task,tasks,chunksize=1)
+            project_name = self.project_name
+            project_id = self.id
+            microns_per_pixel = self.microns_per_pixel
+        for temp in output:
+            temp['project_name'] = project_name
+            temp['project_id'] = project_id
         output = pd.concat(output).reset_index(drop=True)
         output.index.name = 'db_id'
         cdf = CellDataFrame(pd.DataFrame(output))
-        if self.microns_per_pixel: cdf.microns_per_pixel = self.microns_per_pixel
+        if microns_per_pixel: cdf.microns_per_pixel = microns_per_pixel
         return cdf
 
     def cell_df(self):
@@ -1153,19 +1391,48 @@ class CellProjectGeneric(object):
         Args:
             sample_id (str): set the sample id
         """
-        if self._sample_cache_name == sample_id:
-            return self._sample_cache
+        sample = self._sample_cache.get(sample_id)
+        if sample is not None: return sample
         sample = self.create_cell_sample_class()
-        sample.read_hdf(self.h5path,'samples/'+sample_id)
-        self._sample_cache_name = sample_id
-        self._sample_cache = sample
+        sample.read_hdf(self.h5path,'samples/'+sample_id,lazy=self.lazy_images,cache_images=self.cache_images)
+        self._sample_cache.put(sample_id,sample)
         return sample
 
+    def get_frame(self,sample_id,frame_id):
+        """
+        Get a frame without reading the rest of its sample (unless the sample is already in memory)
+
+        Args:
+            sample_id (str): unique sample id
+            frame_id (str): unique frame id
+
+        Returns:
+            CellFrameGeneric: the cell frame
+        """
+        if sample_id in self._sample_cache: return self.get_sample(sample_id).get_frame(frame_id)
+        frame = self._frame_cache.get((sample_id,frame_id))
+        if frame is not None: return frame
+        frame = self.create_cell_sample_class().create_cell_frame_class()
+        frame.read_hdf(self.h5path,'samples/'+sample_id+'/frames/'+frame_id,lazy=self.lazy_images,cache_images=self.cache_images)
+        self._frame_cache.put((sample_id,frame_id),frame)
+        return frame
+
+    def cache_info(self):
+        """
+        Returns:
+            dict: CacheInfo (hits, misses, max_items, max_bytes, items, bytes) for the 'samples' and 'frames' caches
+        """
+        return {'samples':self._sample_cache.info(),'frames':self._frame_cache.info()}
+
     @property
     def key(self):
         """
         Get info about the project
         """
+        if self._session_depth > 0:
+            if 'key' not in self._meta_cache:
+                self._meta_cache['key'] = None if 'info' not in self._read_file() else pd.read_hdf(self.h5path,'info')
+            return None if self._meta_cache['key'] is None else self._meta_cache['key'].copy()
         f = h5py.File(self.h5path,'r')
         val = False
         if 'info' in [x for x in f]: val = True
@@ -1223,9 +1490,7 @@ class CellProjectGeneric(object):
         Returns:
             numpy.array: 2d image array
         """
-        s = self.get_sample(sample_id)
-        f = s.get_frame(frame_id)
-        return f.get_image(image_id)
+        return self.get_frame(sample_id,frame_id).get_image(image_id)
 
     def get_labeled_raw(self,feature_label,statistic_label,all=False,channel_abbreviation=True):
         """
@@ -1241,3 +1506,38 @@ class CellProjectGeneric(object):
             df['project_id'] = self.id
             vals.append(df)
         return pd.concat(vals).set_index(['project_name','project_id','sample_name','sample_id','frame_name','frame_id','cell_index'])    
+
+def _frame_nbytes(frame):
+    # bytes of a frame's tables and the images it holds in memory
+    nbytes = sum([int(x.memory_usage(deep=True).sum()) for x in frame._data.values()])
+    if isinstance(frame._images,ImageStore):
+        return nbytes+sum([frame._images[x].nbytes for x in frame._images.loaded])
+    return nbytes+sum([np.asarray(x).nbytes for x in frame._images.values()])
+
+def _sample_nbytes(sample):
+    return sum([_frame_nbytes(x) for x in sample._frames.values()])
+
+def _frame_stamp(frame):
+    # changes when a lazy frame decodes (or drops) an image, the tables are only measured again then
+    if isinstance(frame._images,ImageStore): return len(frame._images.loaded)
+    return len(frame._images)
+
+def _sample_stamp(sample):
+    return tuple([_frame_stamp(x) for x in sample._frames.values()])
+
+def _sample_cdf_task(task):
+    # build one sample's CellDataFrame in a worker, only the images cdf uses are decoded
+    sample_class, h5path, sample_id, region_group, mutually_exclusive_phenotypes, channel_values, neighbors = task
+    sample = sample_class()
+    sample.read_hdf(h5path,'samples/'+sample_id,lazy=True)
+    return sample.cdf(region_group=region_group,
+                      mutually_exclusive_phenotypes=mutually_exclusive_phenotypes,
+                      channel_values=channel_values,
+                      neighbors=neighbors)
+
+def _label_pixel_counts(image,name):
+    # the number of pixels of each id in a label image, the same as counting map_image_ids(image) by id
+    ids = image.astype(float).ravel()
+    ids[~np.isfinite(ids)] = 0
+    ids, counts = np.unique(ids[ids!=0].astype(int),return_counts=True)
+    return pd.DataFrame({name:counts.astype(int)},index=pd.Index(ids,name='cell_index'))
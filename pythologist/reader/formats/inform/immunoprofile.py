@@ -118,6 +118,7 @@ class CellProjectInFormImmunoProfile(CellProjectInForm):
                                   )
 
         # Save the sample TO this project
+        self._invalidate()
         cellsample.to_hdf(self.h5path,location='samples/'+cellsample.id,mode='a')
         current = self.key
         if current is None:
@@ -130,6 +131,7 @@ class CellProjectInFormImmunoProfile(CellProjectInForm):
                                       'sample_id':cellsample.id,
                                       'sample_name':cellsample.sample_name}]).set_index('db_id')
             current = pd.concat([current,addition])
+        self._invalidate()
         current.to_hdf(self.h5path,'info',mode='r+',complib='zlib',complevel=9,format='table')
         return cellsample.id, cellsample.sample_name
 
@@ -49,8 +49,8 @@ class QCCompartmentConsistency(QCTestGeneric):
 
 
 class CellProjectInForm(CellProjectGeneric):
-    def __init__(self,h5path,mode='r'):
-        super().__init__(h5path,mode)
+    def __init__(self,h5path,mode='r',**kwargs):
+        super().__init__(h5path,mode,**kwargs)
         return
 
     def create_cell_sample_class(self):
@@ -137,6 +137,7 @@ class CellProjectInForm(CellProjectGeneric):
                                   **kwargs)
         if dry_run:
             return cellsample.id
+        self._invalidate()
         cellsample.to_hdf(self.h5path,location='samples/'+cellsample.id,mode='a')
         current = self.key
         if current is None:
@@ -149,6 +150,7 @@ class CellProjectInForm(CellProjectGeneric):
                                       'sample_id':cellsample.id,
                                       'sample_name':cellsample.sample_name}]).set_index('db_id')
             current = pd.concat([current,addition])
+        self._invalidate()
         current.to_hdf(self.h5path,'info',mode='r+',complib='zlib',complevel=9,format='table')
         return cellsample.id
 
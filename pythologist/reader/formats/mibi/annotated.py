@@ -6,8 +6,8 @@ import pandas as pd
 import numpy as np
 
 class CellProjectAnnotatedMIBI(CellProjectGeneric):
-    def __init__(self,h5path,mode='r'):
-        super().__init__(h5path,mode)
+    def __init__(self,h5path,mode='r',**kwargs):
+        super().__init__(h5path,mode,**kwargs)
         return
 
     def create_cell_sample_class(self):
@@ -21,6 +21,7 @@ class CellProjectAnnotatedMIBI(CellProjectGeneric):
         for sample_entry in input_data_json['samples']:
             csm = self.create_cell_sample_class()
             csm.read_json(sample_entry,run_parameters_json,verbose=verbose)
+            self._invalidate()
             csm.to_hdf(self.h5path,location='samples/'+csm.id,mode='a')
 
             current = self.key
@@ -34,6 +35,7 @@ class CellProjectAnnotatedMIBI(CellProjectGeneric):
                                       'sample_id':csm.id,
                                       'sample_name':csm.sample_name}]).set_index('db_id')
                 current = pd.concat([current,addition])
+            self._invalidate()
             current.to_hdf(self.h5path,'info',mode='r+',complib='zlib',complevel=9,format='table')
             if verbose: sys.stderr.write("Added Sample "+csm.id+"\n")
 
@@ -168,37 +168,28 @@ def execute_sample(files_json,inputs,run_id,verbose=False,cache_directory=None):
         percentage_populations.append(_pop)
 
     # Now calculate outputs for each region we are working with
-    fcnts = []
-    scnts = []
-    fpcnts = []
-    spcnts = []
+    # Each report region is a group of regions combined to the name specified, and every group is counted at once
+    region_groups = OrderedDict()
     for report_region_row in inputs['report']['region_selection']:
-        # Iterate over each region combining them to the name specified
-        report_region_name = report_region_row['report_region_name']
-        regions_to_combine = report_region_row['regions_to_combine']
-        logger.info("extracting data for region '"+str(report_region_name)+"' which is made up of "+str(regions_to_combine))
-        _cdf = cdf.combine_regions(regions_to_combine,report_region_name)
-        # Fetch counts based on qc constraints
-        _cnts = _cdf.counts(minimum_region_size_pixels=inputs['report']['parameters']['minimum_density_region_size_pixels'],
-                           minimum_denominator_count=inputs['report']['parameters']['minimum_denominator_count'])
-        logger.info("frame-level densities")
-        _fcnts = _cnts.frame_counts(subsets=density_populations)
-        _fcnts = _fcnts.loc[_fcnts['region_label']==report_region_name,:]
-        fcnts.append(_fcnts)
-        logger.info("sample-level densities")
-        _scnts = _cnts.sample_counts(subsets=density_populations)
-        _scnts = _scnts.loc[_scnts['region_label']==report_region_name,:]
-        scnts.append(_scnts)
-
-
-        logger.info("frame-level percentages")
-        _fpcnts = _cnts.frame_percentages(percentage_logic_list=percentage_populations)
-        _fpcnts = _fpcnts.loc[_fpcnts['region_label']==report_region_name,:]
-        fpcnts.append(_fpcnts)
-        logger.info("sample-level percentages")
-        _spcnts = _cnts.sample_percentages(percentage_logic_list=percentage_populations)
-        _spcnts = _spcnts.loc[_spcnts['region_label']==report_region_name,:]
-        spcnts.append(_spcnts)
+        region_groups[report_region_row['report_region_name']] = report_region_row['regions_to_combine']
+        logger.info("extracting data for region '"+str(report_region_row['report_region_name'])+"' which is made up of "+str(report_region_row['regions_to_combine']))
+    # Fetch counts based on qc constraints
+    _cnts = cdf.counts(minimum_region_size_pixels=inputs['report']['parameters']['minimum_density_region_size_pixels'],
+                       minimum_denominator_count=inputs['report']['parameters']['minimum_denominator_count'],
+                       region_groups=region_groups)
+    logger.info("frame-level densities")
+    _fcnts = _cnts.frame_counts(subsets=density_populations)
+    logger.info("sample-level densities")
+    _scnts = _cnts.sample_counts(subsets=density_populations)
+    logger.info("frame-level percentages")
+    _fpcnts = _cnts.frame_percentages(percentage_logic_list=percentage_populations)
+    logger.info("sample-level percentages")
+    _spcnts = _cnts.sample_percentages(percentage_logic_list=percentage_populations)
+
+    fcnts = [_fcnts.loc[_fcnts['region_label']==x,:] for x in region_groups]
+    scnts = [_scnts.loc[_scnts['region_label']==x,:] for x in region_groups]
+    fpcnts = [_fpcnts.loc[_fpcnts['region_label']==x,:] for x in region_groups]
+    spcnts = [_spcnts.loc[_spcnts['region_label']==x,:] for x in region_groups]
 
     fcnts = pd.concat(fcnts).reset_index(drop=True)
     scnts = pd.concat(scnts).reset_index(drop=True)
@@ -0,0 +1,50 @@
+"""
+Reproducible random streams for permutations.
+
+A root numpy.random.SeedSequence is given a child stream for every permutation of every frame region.
+A child stream is keyed by the permutation index and a 128 bit digest of the frame region,
+so a permutation of a frame region is the same no matter which other frames or permutations
+are run with it, or on which process or machine.
+"""
+
+import numpy as np
+import json, hashlib
+
+def seed_sequence(random_state=None):
+    """
+    Args:
+        random_state (int, numpy.random.SeedSequence or numpy.random.Generator): the root of the streams.
+            A Generator contributes the seed sequence it was created from.  If None, fresh entropy is used.
+
+    Returns:
+        numpy.random.SeedSequence
+    """
+    if isinstance(random_state,np.random.SeedSequence): return random_state
+    if isinstance(random_state,np.random.Generator): return random_state.bit_generator.seed_seq
+    if random_state is not None and not isinstance(random_state,(int,np.integer)):
+        raise ValueError("random_state must be an int, numpy.random.SeedSequence or numpy.random.Generator")
+    return np.random.SeedSequence(None if random_state is None else int(random_state))
+
+def region_key(values):
+    """
+    Args:
+        values (list): the identifiers of a frame region (i.e. project_id, sample_id, frame_id, region_label)
+
+    Returns:
+        tuple: the first 128 bits of a sha256 digest of the identifiers as four 32 bit words
+    """
+    digest = hashlib.sha256(json.dumps([str(x) for x in values]).encode('utf-8')).digest()
+    return tuple(int(x) for x in np.frombuffer(digest[:16],dtype='<u4'))
+
+def stream(seeds,permutation,key):
+    """
+    Args:
+        seeds (numpy.random.SeedSequence): the root of the streams
+        permutation (int): the permutation index
+        key (tuple): the frame region key from region_key
+
+    Returns:
+        numpy.random.Generator: the child stream for this permutation of this frame region
+    """
+    child = np.random.SeedSequence(seeds.entropy,spawn_key=tuple(seeds.spawn_key)+(int(permutation),)+tuple(int(x) for x in key))
+    return np.random.Generator(np.random.PCG64(child))
@@ -1,4 +1,5 @@
 import json
+import numpy as np
 class SubsetLogic(dict):
     def __init__(self,*args,**kwcopy):
         if 'label' not in kwcopy: kwcopy['label'] = None
@@ -33,3 +34,74 @@ class SubsetLogic(dict):
     def scored_calls(self,value):
         self['scored_calls'] = value
 
+
+    def compile(self,phenotype_names,scored_names):
+        """
+        Check the logic against the call names of a CellDataFrame and build a predicate over its call matrices
+
+        Args:
+            phenotype_names (list): the phenotype call names, in the column order of the phenotype call matrix
+            scored_names (list): the scored call names, in the column order of the scored call matrix
+
+        Returns:
+            CompiledSubsetLogic
+        """
+        return CompiledSubsetLogic([self],phenotype_names,scored_names)
+
+class CompiledSubsetLogic(object):
+    """
+    One or more SubsetLogic checked against the call names of a CellDataFrame, so they can be evaluated together
+    as boolean masks over the phenotype and scored call matrices.
+
+    A cell passes a logic if it is positive for any of its phenotypes (all phenotypes if none are listed)
+    and matches every one of its scored calls.
+
+    Params:
+        logics (list): list of SubsetLogic
+        phenotype_names (list): the phenotype call names, in the column order of the phenotype call matrix
+        scored_names (list): the scored call names, in the column order of the scored call matrix
+    """
+    def __init__(self,logics,phenotype_names,scored_names):
+        phenotype_names = list(phenotype_names)
+        scored_names = list(scored_names)
+        self._logics = list(logics)
+        # (names x logics) weights, so every logic is evaluated with one product over the calls
+        self._phenotypes = np.zeros((len(phenotype_names),len(self._logics)),dtype=np.float32)
+        self._positive = np.zeros((len(scored_names),len(self._logics)),dtype=np.float32)
+        self._negative = np.zeros((len(scored_names),len(self._logics)),dtype=np.float32)
+        for j,logic in enumerate(self._logics):
+            phenotypes = logic.phenotypes if len(logic.phenotypes) > 0 else phenotype_names
+            for k in phenotypes:
+                if k not in phenotype_names: raise ValueError("phenotype must exist in defined")
+                self._phenotypes[phenotype_names.index(k),j] = 1
+            for k,v in logic.scored_calls.items():
+                if k not in scored_names: raise ValueError("Scored name must exist in defined")
+                if v == '-': self._negative[scored_names.index(k),j] = 1
+                else: self._positive[scored_names.index(k),j] = 1
+        self._required = self._positive.sum(axis=0)+self._negative.sum(axis=0)
+
+    @property
+    def logics(self):
+        return self._logics.copy()
+
+    def masks(self,phenotype_calls,scored_calls):
+        """
+        Args:
+            phenotype_calls (CallMatrix): the phenotype calls
+            scored_calls (CallMatrix): the scored calls
+
+        Returns:
+            numpy.array: (cells x logics) boolean array of which cells pass each logic
+        """
+        pos = (phenotype_calls.present&(phenotype_calls.values==1)).astype(np.float32)
+        spos = (scored_calls.present&(scored_calls.values==1)).astype(np.float32)
+        sneg = (scored_calls.present&(scored_calls.values==0)).astype(np.float32)
+        matched = spos.dot(self._positive)+sneg.dot(self._negative)
+        return (pos.dot(self._phenotypes)>0)&(matched==self._required)
+
+    def __call__(self,phenotype_calls,scored_calls):
+        """
+        Returns:
+            numpy.array: boolean array of which cells pass the first logic
+        """
+        return self.masks(phenotype_calls,scored_calls)[:,0]
@@ -0,0 +1,225 @@
+"""
+Typed, columnar storage of a CellDataFrame inside an hdf5 group.
+
+Each column is written to its own subgroup with a 'kind' attribute describing how it is laid out
+
+* numeric: the values as a single dataset
+* categorical: integer codes and a dataset of the distinct strings (ids, names and labels)
+* matrix: a column of dictionaries with a fixed set of keys stored as a (cells x names) matrix (i.e. phenotype_calls, scored_calls, regions, channel_values)
+* csr: a column of dictionaries with integer keys stored as index and value arrays (i.e. neighbors)
+* tuple: a column of equal length tuples stored as the distinct tuples and codes (i.e. frame_shape)
+* json: anything else, one json string per row
+"""
+
+import pandas as pd
+import numpy as np
+import json
+from itertools import chain
+from pythologist.calls import CallMatrix, unique_objects
+from pythologist.adjacency import neighbor_arrays
+import h5py
+
+FORMAT = 'pythologist-columnar'
+FORMAT_VERSION = 1
+
+_MATRIX_DTYPES = {
+    'phenotype_calls':np.int8,
+    'scored_calls':np.int8,
+    'regions':np.int64,
+    'channel_values':np.float64
+}
+
+def is_columnar(group):
+    """
+    Args:
+        group (h5py.Group): the hdf5 group to check
+
+    Returns:
+        bool: True if the group was written by write_columns
+    """
+    return group.attrs.get('format',None) == FORMAT
+
+def write_columns(group,df,compression='gzip',compression_opts=4,matrix_dtypes=None):
+    """
+    Write a dataframe to an (empty) hdf5 group as typed columns.
+
+    Args:
+        group (h5py.Group): the group to write to
+        df (pandas.DataFrame): the data to write
+        compression (str): hdf5 compression filter (default gzip)
+        compression_opts (int): compression level (default 4)
+        matrix_dtypes (dict): dtypes to store matrix columns as by column name, over the defaults
+                              (i.e. {'channel_values':numpy.float32} halves its size but is not an exact round trip)
+    """
+    dtypes = dict(_MATRIX_DTYPES)
+    if matrix_dtypes is not None: dtypes.update(matrix_dtypes)
+    group.attrs['format'] = FORMAT
+    group.attrs['format_version'] = FORMAT_VERSION
+    group.attrs['columns'] = json.dumps([str(x) for x in df.columns])
+    group.attrs['rows'] = df.shape[0]
+    options = {'compression':compression,'compression_opts':compression_opts,'shuffle':True}
+    _write_column(group.create_group('index'),df.index.to_series(index=None),None,options)
+    columns = group.create_group('columns')
+    for name in df.columns:
+        _write_column(columns.create_group(str(name)),df[name],name,options,dtypes.get(name,None))
+
+def read_columns(group):
+    """
+    Read a dataframe written by write_columns.
+
+    Args:
+        group (h5py.Group): the group to read from
+
+    Returns:
+        pandas.DataFrame
+    """
+    if not is_columnar(group): raise ValueError("hdf5 group was not written as "+FORMAT)
+    if group.attrs['format_version'] > FORMAT_VERSION:
+        raise ValueError("hdf5 group was written with a newer format version ("+str(group.attrs['format_version'])+")")
+    index = pd.Index(_read_column(group['index']))
+    data = {}
+    for name in json.loads(group.attrs['columns']):
+        data[name] = pd.Series(_read_column(group['columns'][name]),index=index,dtype=None)
+    return pd.DataFrame(data,index=index,columns=json.loads(group.attrs['columns']))
+
+def _dataset(group,name,values,options):
+    values = np.asarray(values)
+    if values.size == 0:
+        return group.create_dataset(name,data=values)
+    return group.create_dataset(name,data=values,**options)
+
+def _string_dataset(group,name,values):
+    return group.create_dataset(name,data=np.array(values,dtype=object),dtype=h5py.string_dtype())
+
+def _write_column(group,s,name,options,preferred=None):
+    if isinstance(s.dtype,pd.CategoricalDtype):
+        categories = list(s.cat.categories)
+        if all([isinstance(x,str) for x in categories]):
+            group.attrs['kind'] = 'categorical'
+            _dataset(group,'codes',s.cat.codes.to_numpy().astype(np.int32),options)
+            _string_dataset(group,'categories',categories)
+            return
+        s = pd.Series(np.asarray(s,dtype=object),index=s.index)
+    elif isinstance(s.dtype,pd.api.extensions.ExtensionDtype):
+        s = pd.Series(_extension_values(s),index=s.index)
+    if s.dtype != object and (np.issubdtype(s.dtype,np.number) or np.issubdtype(s.dtype,np.bool_)):
+        group.attrs['kind'] = 'numeric'
+        _dataset(group,'values',s.to_numpy(),options)
+        return
+    objs = np.asarray(s,dtype=object)
+    # the first value picks the layout to try, and every distinct value has to fit it
+    sample = next((x for x in objs if not _is_missing(x)),None)
+    if isinstance(sample,dict):
+        uobjs = [x for x in objs[unique_objects(objs)[1]] if not _is_missing(x)]
+        if all([isinstance(x,dict) for x in uobjs]):
+            csr = None if name != 'neighbors' else _csr_arrays(objs)
+            if csr is not None:
+                group.attrs['kind'] = 'csr'
+                for k,v in csr.items(): _dataset(group,k,v,options)
+                return
+            dtype = _matrix_dtype(uobjs,preferred)
+            if dtype is not None:
+                calls = CallMatrix.from_series(objs,dtype=dtype)
+                group.attrs['kind'] = 'matrix'
+                group.create_dataset('keys',data=json.dumps(calls.names),dtype=h5py.string_dtype())
+                _dataset(group,'values',calls.values,options)
+                _dataset(group,'present',calls.present,options)
+                _dataset(group,'defined',calls.defined,options)
+                return
+    elif sample is None or isinstance(sample,str):
+        codes, categories = pd.factorize(pd.Series(objs,dtype=object))
+        if all([isinstance(x,str) for x in categories]):
+            group.attrs['kind'] = 'categorical'
+            _dataset(group,'codes',codes.astype(np.int32),options)
+            _string_dataset(group,'categories',list(categories))
+            return
+    elif isinstance(sample,tuple):
+        codes, uniques = pd.factorize(pd.Series(objs,dtype=object))
+        if all([isinstance(x,tuple) and len(x)==len(sample) for x in uniques]) and \
+           all([isinstance(y,(int,float,np.number)) and not isinstance(y,bool) for x in uniques for y in x]):
+            group.attrs['kind'] = 'tuple'
+            _dataset(group,'codes',codes.astype(np.int32),options)
+            _dataset(group,'values',np.array(list(uniques)).reshape(len(uniques),len(sample)),options)
+            return
+    group.attrs['kind'] = 'json'
+    _string_dataset(group,'values',[json.dumps(x,default=_json_default) for x in objs])
+
+def _read_column(group):
+    kind = group.attrs['kind']
+    if kind == 'numeric':
+        return group['values'][()]
+    if kind == 'categorical':
+        codes = group['codes'][()]
+        categories = np.array(list(group['categories'].asstr()[()]),dtype=object)
+        output = np.empty(codes.shape[0],dtype=object)
+        output[:] = np.nan
+        output[codes>=0] = categories[codes[codes>=0]]
+        return output
+    if kind == 'matrix':
+        calls = CallMatrix(json.loads(group['keys'].asstr()[()]),
+                           group['values'][()],
+                           group['present'][()],
+                           group['defined'][()])
+        return calls.to_series().to_numpy()
+    if kind == 'csr':
+        return _read_csr(group)
+    if kind == 'tuple':
+        codes = group['codes'][()]
+        values = group['values'][()].tolist()
+        # the last entry is for missing values (code -1)
+        uniques = np.empty(len(values)+1,dtype=object)
+        for i,x in enumerate(values): uniques[i] = tuple(x)
+        uniques[-1] = np.nan
+        return uniques[codes]
+    if kind == 'json':
+        return np.array([json.loads(x) for x in group['values'].asstr()[()]],dtype=object)
+    raise ValueError("unknown column kind '"+str(kind)+"'")
+
+def _matrix_dtype(dicts,preferred):
+    # pick a dtype that holds every value, or None if the values are not all numbers
+    if preferred is not None and np.issubdtype(preferred,np.floating):
+        return preferred
+    values = list(chain.from_iterable([d.values() for d in dicts]))
+    if not all([isinstance(x,(int,float,np.number)) and not isinstance(x,bool) for x in values]):
+        return None
+    values = np.array(values)
+    if values.shape[0] == 0: return preferred if preferred is not None else np.int8
+    if np.issubdtype(values.dtype,np.floating): return np.float64
+    if preferred is not None and np.can_cast(np.min_scalar_type(values.min()),preferred) and \
+       np.can_cast(np.min_scalar_type(values.max()),preferred):
+        return preferred
+    return np.int64
+
+def _extension_values(s):
+    # numpy values of a pandas extension column (i.e. nullable integers or strings), missing values become NaN
+    if not s.isna().any(): return s.to_numpy()
+    if pd.api.types.is_numeric_dtype(s.dtype): return s.to_numpy(dtype=np.float64,na_value=np.nan)
+    return s.to_numpy(dtype=object,na_value=np.nan)
+
+def _json_default(x):
+    # numpy scalars and arrays become python values, anything else its string
+    if isinstance(x,np.generic): return x.item()
+    if isinstance(x,np.ndarray): return x.tolist()
+    return str(x)
+
+def _is_missing(x):
+    return x is None or (isinstance(x,float) and np.isnan(x))
+
+def _csr_arrays(objs):
+    # index and value arrays for a column of {int:int} dictionaries, or None if they are not all integers
+    rows, indices, data, defined = neighbor_arrays(objs)
+    if indices.dtype.kind not in 'iu' or data.dtype.kind not in 'iu': return None
+    return {'indptr':np.concatenate([[0],np.cumsum(np.bincount(rows,minlength=len(objs)))]).astype(np.int64),
+            'indices':indices.astype(np.int64),
+            'data':data.astype(np.int64),
+            'defined':defined}
+
+def _read_csr(group):
+    indptr = group['indptr'][()]
+    indices = group['indices'][()].tolist()
+    data = group['data'][()].tolist()
+    defined = group['defined'][()]
+    output = np.empty(defined.shape[0],dtype=object)
+    output[:] = [dict(zip(indices[indptr[i]:indptr[i+1]],data[indptr[i]:indptr[i+1]])) if defined[i] else np.nan
+                 for i in range(defined.shape[0])]
+    return output